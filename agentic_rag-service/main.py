@@ -1,9 +1,18 @@
 import os
 import json
+import gzip
+import base64
+import hashlib
 import logging
-from typing import List, Dict, Any
-from fastapi import FastAPI, Body, HTTPException
+import threading
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import List, Dict, Any, Optional, Tuple
+from fastapi import FastAPI, Body, HTTPException, Request, Query
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response, StreamingResponse
 from pydantic import BaseModel
+import numpy as np
 import chromadb
 from sentence_transformers import SentenceTransformer
 from pathlib import Path
@@ -17,6 +26,21 @@ class QueryRequest(BaseModel):
     query: str
     max_results: int = 3
 
+# Configuración de la carta (/catalog)
+CATALOG_DEFAULT_LIMIT = int(os.getenv("CATALOG_DEFAULT_LIMIT", "50"))
+CATALOG_MAX_LIMIT = int(os.getenv("CATALOG_MAX_LIMIT", "200"))
+CATALOG_MAX_AGE = int(os.getenv("CATALOG_MAX_AGE", "300"))
+CATALOG_MAX_CACHED_PAGES = int(os.getenv("CATALOG_MAX_CACHED_PAGES", "256"))
+CATALOG_FIELDS = (
+    "name", "type", "winery", "region", "grape", "alcohol", "temperature",
+    "crianza", "price", "rating", "pairing", "description"
+)
+CATALOG_DEFAULT_FIELDS = ("name", "type", "region", "grape", "price", "description")
+
+# Exportación de chunks (/debug/chunks)
+CHUNKS_MAX_LIMIT = int(os.getenv("CHUNKS_MAX_LIMIT", "500"))
+CHUNKS_EXPORT_PAGE_SIZE = int(os.getenv("CHUNKS_EXPORT_PAGE_SIZE", "100"))
+
 class RAGService:
     """Servicio RAG que gestiona embeddings y búsqueda semántica."""
     def __init__(self):
@@ -27,8 +51,123 @@ class RAGService:
             name="wine_knowledge_v2",
             metadata={"hnsw:space": "cosine"}
         )
+        self.index_version = ""
+        self.index_updated_at = datetime.now(timezone.utc)
+        self._catalog: List[Tuple[str, Dict]] = []
+        self._catalog_pages: Dict[Tuple, Dict[str, Any]] = {}
+        # Los handlers síncronos de /catalog corren en el threadpool: la carta y sus páginas se cambian con el lock
+        self._catalog_lock = threading.Lock()
         self._load_initial_data()
 
+    def _refresh_index_version(self):
+        """Recalcula la versión del índice y precalcula la carta para esa versión."""
+        data = self.collection.get(include=["documents", "metadatas"])
+        digest = hashlib.sha256()
+        for doc_id, document in sorted(zip(data['ids'], data['documents'] or [])):
+            digest.update(doc_id.encode('utf-8'))
+            digest.update(b"\0")
+            digest.update((document or "").encode('utf-8'))
+            digest.update(b"\0")
+        version = digest.hexdigest()[:16]
+        if version == self.index_version:
+            return
+
+        # La carta se ordena por id para poder paginar por clave (keyset)
+        catalog = sorted((
+            (doc_id, metadata)
+            for doc_id, metadata in zip(data['ids'], data['metadatas'] or [])
+            if metadata and metadata.get('type_content') == 'wine'
+        ), key=lambda item: item[0])
+        with self._catalog_lock:
+            self.index_version = version
+            # Los headers HTTP trabajan con precisión de segundos
+            self.index_updated_at = datetime.now(timezone.utc).replace(microsecond=0)
+            self._catalog = catalog
+            self._catalog_pages = {}
+        # Precalcular la primera página por defecto: la UI la pide sin límite explícito al abrir la carta
+        self.get_catalog_page(None, CATALOG_DEFAULT_LIMIT, CATALOG_DEFAULT_FIELDS)
+        logger.info(f"📇 Índice versión {self.index_version} ({len(self._catalog)} vinos en carta)")
+
+    def get_catalog_page(self, after: Optional[str], limit: int, fields: Tuple[str, ...]) -> Dict[str, Any]:
+        """Devuelve una página de la carta ya serializada y comprimida.
+
+        Las páginas se memorizan por (versión, cursor, límite, campos), de forma que
+        servir la carta tiene coste constante hasta que cambia el índice.
+        """
+        with self._catalog_lock:
+            index_version, catalog = self.index_version, self._catalog
+            key = (index_version, after, limit, fields)
+            page = self._catalog_pages.get(key)
+        if page is not None:
+            return page
+
+        start = 0
+        if after is not None:
+            # Búsqueda binaria del primer id estrictamente mayor que el cursor
+            lo, hi = 0, len(catalog)
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if catalog[mid][0] <= after:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            start = lo
+
+        items = catalog[start:start + limit]
+        has_more = start + limit < len(catalog)
+        body = json.dumps({
+            "index_version": index_version,
+            "wines": [
+                {"id": doc_id, **{field: metadata.get(field) for field in fields}}
+                for doc_id, metadata in items
+            ],
+            "next_cursor": _encode_cursor(items[-1][0]) if items and has_more else None,
+            "total": len(catalog)
+        }, ensure_ascii=False, separators=(",", ":")).encode('utf-8')
+
+        etag = hashlib.sha256(b"%s|%s" % (index_version.encode(), body)).hexdigest()[:24]
+        page = {
+            "body": body,
+            # mtime=0 para que el gzip sea determinista y el ETag estable entre réplicas
+            "gzip": gzip.compress(body, compresslevel=9, mtime=0),
+            "etag": f'"{etag}"',
+            "etag_gzip": f'"{etag}-gz"',
+        }
+        with self._catalog_lock:
+            if index_version != self.index_version:
+                # El índice ha cambiado mientras se serializaba: no guardar una página de otra versión
+                return page
+            if len(self._catalog_pages) >= CATALOG_MAX_CACHED_PAGES:
+                # Combinaciones raras de cursor/campos: descartar la más antigua,
+                # conservando siempre la página por defecto precalculada
+                default_key = (index_version, None, CATALOG_DEFAULT_LIMIT, CATALOG_DEFAULT_FIELDS)
+                oldest = next((k for k in self._catalog_pages if k != default_key), None)
+                if oldest is not None:
+                    self._catalog_pages.pop(oldest)
+            self._catalog_pages[key] = page
+        return page
+
+    def get_chunks(self, offset: int, limit: int, include_embeddings: bool = False) -> List[Dict[str, Any]]:
+        """Lee una página de chunks de la colección en orden de inserción."""
+        include = ['documents', 'metadatas'] + (['embeddings'] if include_embeddings else [])
+        results = self.collection.get(offset=offset, limit=limit, include=include)
+        embeddings = results.get('embeddings') if include_embeddings else None
+
+        chunks = []
+        for i, chunk_id in enumerate(results['ids']):
+            chunk = {
+                "id": chunk_id,
+                "content": results['documents'][i],
+                "metadata": results['metadatas'][i] if results['metadatas'] else None
+            }
+            if embeddings is not None:
+                # float32 little-endian en base64: ~4x más compacto que una lista JSON
+                vector = np.asarray(embeddings[i], dtype='<f4')
+                chunk["embedding"] = base64.b64encode(vector.tobytes()).decode('ascii')
+                chunk["embedding_dim"] = int(vector.shape[0])
+            chunks.append(chunk)
+        return chunks
+
     def _process_enology_simple(self, text_path: Path):
         """Procesa el texto de maestría enológica con estrategia simple por párrafos."""
         logger.info(f"📖 Procesando maestría enológica desde {text_path}...")
@@ -313,6 +452,7 @@ class RAGService:
         
         total_docs = self.collection.count()
         logger.info(f"✅ Base de conocimiento cargada. Total documentos: {total_docs}")
+        self._refresh_index_version()
 
     def search(self, query: str, max_results: int = 3) -> List[Dict]:
         """Realiza una búsqueda semántica en la colección con filtros inteligentes."""
@@ -380,8 +520,37 @@ class RAGService:
         # Limitar a los resultados solicitados
         return formatted_results[:max_results]
 
+def _accepts_gzip(accept_encoding: str) -> bool:
+    """Indica si Accept-Encoding admite gzip (respetando q=0, que lo rechaza)."""
+    for coding in accept_encoding.lower().split(","):
+        name, _, params = coding.partition(";")
+        if name.strip() not in ("gzip", "x-gzip"):
+            continue
+        quality = 1.0
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        return quality > 0
+    return False
+
+def _encode_cursor(doc_id: str) -> str:
+    return base64.urlsafe_b64encode(doc_id.encode('utf-8')).decode('ascii').rstrip("=")
+
+def _decode_cursor(cursor: str) -> str:
+    try:
+        padding = "=" * (-len(cursor) % 4)
+        return base64.b64decode(cursor + padding, altchars=b"-_", validate=True).decode('utf-8')
+    except Exception:
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+
 # Inicialización del servicio
 app = FastAPI(title="Agentic RAG Service", version="1.0.0")
+# La UI consume /catalog directamente desde el navegador
+app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["GET"], allow_headers=["*"], expose_headers=["ETag", "Last-Modified", "X-Index-Version"])
 rag_service = RAGService()
 
 @app.get("/health")
@@ -389,32 +558,128 @@ async def health():
     """Health check endpoint."""
     return {"status": "healthy", "service": "agentic-rag"}
 
+@app.get("/catalog")
+def catalog(
+    request: Request,
+    cursor: Optional[str] = None,
+    limit: int = Query(CATALOG_DEFAULT_LIMIT, ge=1, le=CATALOG_MAX_LIMIT),
+    fields: Optional[str] = None
+):
+    """Carta de vinos paginada por clave, con proyección de campos y caché HTTP."""
+    if fields:
+        selected = tuple(dict.fromkeys(f.strip() for f in fields.split(",") if f.strip()))
+        unknown = [f for f in selected if f not in CATALOG_FIELDS]
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Campos no válidos: {', '.join(unknown)}")
+    else:
+        selected = CATALOG_DEFAULT_FIELDS
+
+    after = _decode_cursor(cursor) if cursor else None
+    page = rag_service.get_catalog_page(after, limit, selected)
+
+    use_gzip = _accepts_gzip(request.headers.get("accept-encoding", ""))
+    etag = page["etag_gzip"] if use_gzip else page["etag"]
+    headers = {
+        "ETag": etag,
+        "Last-Modified": format_datetime(rag_service.index_updated_at, usegmt=True),
+        "Cache-Control": f"public, max-age={CATALOG_MAX_AGE}",
+        "Vary": "Accept-Encoding",
+        "X-Index-Version": rag_service.index_version,
+    }
+
+    # Validación condicional: If-None-Match tiene prioridad sobre If-Modified-Since
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        candidates = {tag.strip() for tag in if_none_match.split(",")}
+        if etag in candidates or "*" in candidates:
+            return Response(status_code=304, headers=headers)
+    elif request.headers.get("if-modified-since"):
+        try:
+            since = parsedate_to_datetime(request.headers["if-modified-since"])
+            if since >= rag_service.index_updated_at:
+                return Response(status_code=304, headers=headers)
+        except (TypeError, ValueError):
+            pass
+
+    if use_gzip:
+        headers["Content-Encoding"] = "gzip"
+        return Response(content=page["gzip"], media_type="application/json", headers=headers)
+    return Response(content=page["body"], media_type="application/json", headers=headers)
+
+def _encode_chunks_cursor(offset: int) -> str:
+    return _encode_cursor(f"{rag_service.index_version}:{offset}")
+
+def _decode_chunks_cursor(cursor: str) -> int:
+    """Valida que el cursor pertenece a la versión actual del índice."""
+    version, _, offset = _decode_cursor(cursor).rpartition(":")
+    if not offset.isdigit():
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+    if version != rag_service.index_version:
+        raise HTTPException(status_code=409, detail="El índice ha cambiado; reinicia la paginación")
+    return int(offset)
+
 @app.get("/debug/chunks")
-async def debug_chunks(limit: int = 5):
-    """Debug endpoint para ver chunks."""
+def debug_chunks(
+    limit: int = Query(5, ge=1, le=CHUNKS_MAX_LIMIT),
+    cursor: Optional[str] = None,
+    include_embeddings: bool = False
+):
+    """Debug endpoint para ver chunks, paginado por cursor."""
+    offset = _decode_chunks_cursor(cursor) if cursor else 0
     try:
-        results = rag_service.collection.get(limit=limit, include=['documents', 'metadatas'])
+        chunks = rag_service.get_chunks(offset, limit, include_embeddings)
+        next_offset = offset + len(chunks)
+        has_more = len(chunks) == limit and next_offset < rag_service.collection.count()
         return {
-            "total_chunks": len(results['ids']),
-            "sample_chunks": [
-                {
-                    "id": results['ids'][i],
-                    "content": results['documents'][i],
-                    "metadata": results['metadatas'][i] if results['metadatas'] else None
-                }
-                for i in range(min(limit, len(results['ids'])))
-            ]
+            "total_chunks": len(chunks),
+            "sample_chunks": chunks,
+            "next_cursor": _encode_chunks_cursor(next_offset) if has_more else None,
+            "index_version": rag_service.index_version
         }
     except Exception as e:
         logger.error(f"Error en debug_chunks: {e}")
         return {"error": str(e)}
 
+@app.get("/debug/chunks/export")
+def export_chunks(
+    page_size: int = Query(CHUNKS_EXPORT_PAGE_SIZE, ge=1, le=CHUNKS_MAX_LIMIT),
+    include_embeddings: bool = False
+):
+    """Exporta la colección completa como NDJSON (un chunk por línea).
+
+    Recorre la colección en páginas de tamaño fijo, por lo que la memoria usada
+    no depende del tamaño de la colección.
+    """
+    version = rag_service.index_version
+
+    def generate_lines():
+        offset = 0
+        while True:
+            if rag_service.index_version != version:
+                # El índice cambió a mitad de exportación: cerrar con un marcador explícito
+                yield json.dumps({"error": "index_changed", "exported": offset}) + "\n"
+                return
+            chunks = rag_service.get_chunks(offset, page_size, include_embeddings)
+            for chunk in chunks:
+                yield json.dumps(chunk, ensure_ascii=False) + "\n"
+            offset += len(chunks)
+            if len(chunks) < page_size:
+                logger.info(f"📤 Exportación de chunks completada: {offset} chunks")
+                return
+
+    return StreamingResponse(
+        generate_lines(),
+        media_type="application/x-ndjson",
+        headers={"X-Index-Version": version}
+    )
+
 @app.post("/search")
 def search_endpoint(request: QueryRequest = Body(...)):
     """Endpoint para realizar búsquedas semánticas."""
     try:
         results = rag_service.search(request.query, request.max_results)
-        return {"wines": results}
+        # La versión del índice permite a los clientes invalidar lo que hayan cacheado
+        return {"wines": results, "index_version": rag_service.index_version}
     except Exception as e:
         logger.error(f"Error en el endpoint de búsqueda RAG: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -0,0 +1,200 @@
+# sumiller-service/admission.py
+
+# Control de admisión para las llamadas a Vertex AI: límite de llamadas en vuelo
+# por etapa, cola acotada con espera máxima y rechazo temprano (503 + Retry-After).
+import os
+import math
+import time
+import asyncio
+import logging
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Deque, Dict, Optional
+
+from hedging import LatencyTracker
+
+logger = logging.getLogger(__name__)
+
+# 0 en la concurrencia desactiva el límite de la etapa
+ADMISSION_CLASSIFICATION_CONCURRENCY = int(os.getenv("ADMISSION_CLASSIFICATION_CONCURRENCY", "16"))
+ADMISSION_GENERATION_CONCURRENCY = int(os.getenv("ADMISSION_GENERATION_CONCURRENCY", "8"))
+ADMISSION_CLASSIFICATION_QUEUE = int(os.getenv("ADMISSION_CLASSIFICATION_QUEUE", "64"))
+ADMISSION_GENERATION_QUEUE = int(os.getenv("ADMISSION_GENERATION_QUEUE", "32"))
+ADMISSION_MAX_WAIT_MS = float(os.getenv("ADMISSION_MAX_WAIT_MS", "3000"))
+
+
+class AdmissionRejected(Exception):
+    """No hay hueco para la llamada: la petición se rechaza con 503."""
+
+    def __init__(self, stage: str, reason: str, retry_after: int):
+        super().__init__(f"Etapa '{stage}' saturada ({reason})")
+        self.stage = stage
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """Limita las llamadas en vuelo de una etapa.
+
+    Hasta `max_in_flight` llamadas pasan directamente; las siguientes esperan en
+    una cola FIFO de `queue_size` plazas durante un máximo de `max_wait_ms`. Si la
+    cola está llena o se agota la espera se lanza AdmissionRejected con una
+    estimación de cuándo reintentar. Al liberar un hueco se entrega directamente
+    al primero de la cola.
+    """
+
+    def __init__(self, stage: str, max_in_flight: int, queue_size: int, max_wait_ms: float = ADMISSION_MAX_WAIT_MS):
+        self.stage = stage
+        self.max_in_flight = max_in_flight
+        self.queue_size = queue_size
+        self.max_wait_ms = max_wait_ms
+        self.in_flight = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+        self.wait_ms = LatencyTracker(window=500)
+        self._avg_hold_ms = 0.0
+        self._stats = {"admitted": 0, "queued": 0, "shed_queue_full": 0, "shed_timeout": 0, "max_queue_depth": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_in_flight > 0
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiters)
+
+    def _has_capacity(self) -> bool:
+        return self.in_flight < self.max_in_flight and not self.queue_depth
+
+    # --- Cola de espera (FIFO; las subclases pueden cambiar el orden de servicio) ---
+    def _enqueue(self, waiter: asyncio.Future, ticket: Dict[str, Any]):
+        self._waiters.append(waiter)
+
+    def _discard(self, waiter: asyncio.Future, ticket: Dict[str, Any]):
+        self._waiters.remove(waiter)
+
+    def _next_waiter(self) -> Optional[asyncio.Future]:
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                return waiter
+        return None
+
+    def _check_ticket(self, ticket: Dict[str, Any]):
+        """Límites adicionales por petición antes de encolar."""
+
+    def _record_wait(self, wait_ms: float, ticket: Dict[str, Any]):
+        self.wait_ms.record(wait_ms)
+
+    def retry_after(self) -> int:
+        """Segundos estimados hasta que se vacíe la cola actual."""
+        hold_s = (self._avg_hold_ms or self.max_wait_ms) / 1000
+        return max(1, math.ceil(hold_s * (self.queue_depth + 1) / max(self.max_in_flight, 1)))
+
+    def _shed(self, reason: str):
+        self._stats[f"shed_{reason}"] = self._stats.get(f"shed_{reason}", 0) + 1
+        logger.warning(f"🚦 Etapa '{self.stage}' saturada ({reason}): {self.in_flight} en vuelo, {self.queue_depth} en cola")
+        raise AdmissionRejected(self.stage, reason, self.retry_after())
+
+    def check(self, **ticket: Any):
+        """Rechaza de antemano si la petición no tendría ni sitio en la cola."""
+        if not self.enabled or self._has_capacity():
+            return
+        if self.queue_depth >= self.queue_size:
+            self._shed("queue_full")
+        self._check_ticket(ticket)
+
+    async def acquire(self, **ticket: Any):
+        if not self.enabled:
+            self._stats["admitted"] += 1
+            return
+        if self._has_capacity():
+            self.in_flight += 1
+            self._stats["admitted"] += 1
+            self._record_wait(0.0, ticket)
+            return
+        if self.queue_depth >= self.queue_size:
+            self._shed("queue_full")
+        self._check_ticket(ticket)
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._enqueue(waiter, ticket)
+        self._stats["queued"] += 1
+        self._stats["max_queue_depth"] = max(self._stats["max_queue_depth"], self.queue_depth)
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.max_wait_ms / 1000)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.done() and not waiter.cancelled():
+                # El hueco llegó a la vez que el plazo o la cancelación
+                if isinstance(e, asyncio.CancelledError):
+                    self.release()
+                    raise
+            else:
+                waiter.cancel()
+                self._discard(waiter, ticket)
+                if isinstance(e, asyncio.CancelledError):
+                    raise
+                self._record_wait((time.perf_counter() - start) * 1000, ticket)
+                self._shed("timeout")
+        self._record_wait((time.perf_counter() - start) * 1000, ticket)
+        self._stats["admitted"] += 1
+
+    def try_acquire(self) -> bool:
+        """Reserva un hueco solo si hay uno libre ahora mismo, sin pasar por la cola.
+
+        Para llamadas opcionales (la copia de una llamada con hedging): si no hay
+        sitio se devuelve False y no se llama. Quien lo obtiene debe llamar a `release()`.
+        """
+        if not self.enabled:
+            self._stats["admitted"] += 1
+            return True
+        if not self._has_capacity():
+            return False
+        self.in_flight += 1
+        self._stats["admitted"] += 1
+        return True
+
+    def release(self):
+        if not self.enabled:
+            return
+        # El hueco pasa directamente al siguiente en la cola (in_flight no cambia)
+        waiter = self._next_waiter()
+        if waiter is not None:
+            waiter.set_result(None)
+            return
+        self.in_flight -= 1
+
+    @asynccontextmanager
+    async def slot(self, **ticket: Any) -> AsyncIterator[None]:
+        """Reserva un hueco durante la llamada al modelo."""
+        await self.acquire(**ticket)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            hold_ms = (time.perf_counter() - start) * 1000
+            # Media móvil del tiempo de ocupación, para estimar el Retry-After
+            self._avg_hold_ms = hold_ms if not self._avg_hold_ms else 0.9 * self._avg_hold_ms + 0.1 * hold_ms
+            self.release()
+
+    def get_stats(self) -> Dict[str, Any]:
+        p95 = self.wait_ms.percentile(0.95)
+        p50 = self.wait_ms.percentile(0.5)
+        return {
+            "enabled": self.enabled,
+            "max_in_flight": self.max_in_flight,
+            "queue_size": self.queue_size,
+            "max_wait_ms": self.max_wait_ms,
+            "in_flight": self.in_flight,
+            "queue_depth": self.queue_depth,
+            **self._stats,
+            "wait_p50_ms": round(p50, 2) if p50 is not None else None,
+            "wait_p95_ms": round(p95, 2) if p95 is not None else None,
+            "avg_hold_ms": round(self._avg_hold_ms, 2),
+        }
+
+
+# La generación pasa por el planificador justo de scheduler.py, que extiende este control
+classification_admission = AdmissionController(
+    "classification", ADMISSION_CLASSIFICATION_CONCURRENCY, ADMISSION_CLASSIFICATION_QUEUE
+)
@@ -0,0 +1,93 @@
+# sumiller-service/fake_model.py
+
+# Modelo falso con la interfaz de GenerativeModel para pruebas sin Vertex AI.
+import os
+import re
+import json
+import random
+import asyncio
+from typing import AsyncIterator, Optional
+
+
+class FakeUsageMetadata:
+    def __init__(self, prompt_token_count: int, candidates_token_count: int):
+        self.prompt_token_count = prompt_token_count
+        self.candidates_token_count = candidates_token_count
+        self.total_token_count = prompt_token_count + candidates_token_count
+
+
+class FakeResponse:
+    def __init__(self, text: str, usage_metadata: Optional[FakeUsageMetadata] = None):
+        self.text = text
+        self.usage_metadata = usage_metadata
+
+
+class FakeGenerativeModel:
+    """Simula la latencia de Gemini con una distribución de cola pesada.
+
+    Cada llamada tarda `latency_ms` ± `jitter_ms`; con probabilidad
+    `tail_probability` tarda además `tail_ms` (las llamadas lentas que el
+    hedging intenta recortar). Las consultas de clasificación reciben un JSON
+    válido, el prompt unificado una cabecera JSON seguida de `text` y el resto,
+    `text` (troceado por palabras en modo streaming).
+    """
+
+    def __init__(self, latency_ms: float = 200.0, jitter_ms: float = 50.0, tail_ms: float = 2000.0,
+                 tail_probability: float = 0.05, text: str = "Respuesta de prueba del modelo local.",
+                 seed: Optional[int] = None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.tail_ms = tail_ms
+        self.tail_probability = tail_probability
+        self.text = text
+        self.calls = 0
+        self._random = random.Random(seed)
+
+    @classmethod
+    def from_env(cls) -> "FakeGenerativeModel":
+        return cls(
+            latency_ms=float(os.getenv("FAKE_LLM_LATENCY_MS", "200")),
+            jitter_ms=float(os.getenv("FAKE_LLM_JITTER_MS", "50")),
+            tail_ms=float(os.getenv("FAKE_LLM_TAIL_MS", "2000")),
+            tail_probability=float(os.getenv("FAKE_LLM_TAIL_PROBABILITY", "0.05")),
+        )
+
+    def sample_latency_ms(self) -> float:
+        latency = self.latency_ms + self._random.uniform(-self.jitter_ms, self.jitter_ms)
+        if self._random.random() < self.tail_probability:
+            latency += self.tail_ms
+        return max(latency, 0.0)
+
+    def _answer(self, prompt: str) -> str:
+        if "\nConsultas:\n" in prompt:
+            # Prompt de clasificación por lotes: un objeto por consulta numerada
+            ids = re.findall(r'^(\d+)\. "', prompt.split("\nConsultas:\n", 1)[1], flags=re.MULTILINE)
+            return json.dumps([
+                {"id": int(i), "category": "WINE_SEARCH", "confidence": 0.9, "reasoning": "Modelo local de pruebas"}
+                for i in ids
+            ])
+        if '"needs_retrieval"' in prompt:
+            # Prompt unificado: cabecera de clasificación, separador y respuesta sin RAG
+            header = {"category": "WINE_THEORY", "confidence": 0.9, "reasoning": "Modelo local de pruebas",
+                      "needs_retrieval": False}
+            return json.dumps(header) + "\n---\n" + self.text
+        if '\nConsulta: "' in prompt:
+            # Prompt de clasificación
+            return json.dumps({"category": "WINE_SEARCH", "confidence": 0.9, "reasoning": "Modelo local de pruebas"})
+        return self.text
+
+    async def generate_content_async(self, prompt: str, stream: bool = False, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.sample_latency_ms() / 1000)
+        answer = self._answer(prompt)
+        # Como Vertex AI: el uso va en la respuesta o, en streaming, en el último fragmento
+        usage = FakeUsageMetadata(len(prompt) // 4 + 1, len(answer) // 4 + 1)
+        if not stream:
+            return FakeResponse(answer, usage)
+        return self._stream(answer, usage)
+
+    async def _stream(self, answer: str, usage: FakeUsageMetadata) -> AsyncIterator[FakeResponse]:
+        words = answer.split(" ")
+        for i, word in enumerate(words):
+            await asyncio.sleep(0.005)
+            yield FakeResponse(word + " ", usage if i == len(words) - 1 else None)
@@ -0,0 +1,227 @@
+# sumiller-service/generation_profiles.py
+
+# Perfiles de generación por categoría (modelo, longitud, temperatura, paradas)
+# y respuestas pregeneradas para las consultas fuera de tema.
+import os
+import json
+import random
+import asyncio
+import logging
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from hedging import LatencyTracker
+from llm import generation_config
+from prompt_builder import estimate_tokens
+from prompt_registry import prompt_registry
+from text_similarity import cosine, text_vector
+
+logger = logging.getLogger(__name__)
+
+BASELINE_MODEL = "gemini-2.0-flash"
+
+# Cada categoría hereda de DEFAULT. Se pueden sobrescribir con
+# GENERATION_PROFILES='{"WINE_THEORY": {"max_output_tokens": 400}}'
+# El pool de respuestas pregeneradas sustituye a la generación: se activa por perfil,
+# p. ej. GENERATION_PROFILES='{"OFF_TOPIC": {"response_pool": true}}'
+DEFAULT_GENERATION_PROFILES: Dict[str, Dict[str, Any]] = {
+    "DEFAULT": {"model": BASELINE_MODEL, "max_output_tokens": 1024, "temperature": 0.7, "stop_sequences": []},
+    "WINE_SEARCH": {"max_output_tokens": 900},
+    "WINE_THEORY": {"max_output_tokens": 600, "temperature": 0.4},
+    "SECRET_MESSAGE": {"max_output_tokens": 400, "temperature": 0.9},
+    "OFF_TOPIC": {"model": "gemini-2.0-flash-lite", "max_output_tokens": 160, "temperature": 0.8},
+}
+# Fracción de peticiones que usan el perfil de su categoría; el resto usa el modelo
+# base sin configuración (lo de antes), para comparar ambos en las métricas
+GENERATION_PROFILES_ROLLOUT = float(os.getenv("GENERATION_PROFILES_ROLLOUT", "1.0"))
+RESPONSE_POOL_FILE = "off_topic_pool.txt"
+RESPONSE_POOL_MIN_SIMILARITY = float(os.getenv("RESPONSE_POOL_MIN_SIMILARITY", "0.25"))
+
+
+class GenerationProfile:
+    def __init__(self, name: str, model: str = BASELINE_MODEL, max_output_tokens: Optional[int] = None,
+                 temperature: Optional[float] = None, stop_sequences: Optional[List[str]] = None,
+                 response_pool: bool = False):
+        self.name = name
+        self.model = model
+        self.max_output_tokens = max_output_tokens
+        self.temperature = temperature
+        self.stop_sequences = stop_sequences or []
+        self.response_pool = response_pool
+        self._request_kwargs: Optional[Dict[str, Any]] = None
+
+    @property
+    def prepared(self) -> bool:
+        return self._request_kwargs is not None
+
+    def request_kwargs(self) -> Dict[str, Any]:
+        """Argumentos extra de generate_content_async (ninguno para el perfil base).
+
+        El GenerationConfig se construye una vez y se reutiliza. La primera vez
+        puede importar vertexai: se hace en el calentamiento, fuera del event loop.
+        """
+        if self._request_kwargs is None:
+            config = {}
+            if self.max_output_tokens:
+                config["max_output_tokens"] = self.max_output_tokens
+            if self.temperature is not None:
+                config["temperature"] = self.temperature
+            if self.stop_sequences:
+                config["stop_sequences"] = self.stop_sequences
+            self._request_kwargs = {"generation_config": generation_config(**config)} if config else {}
+        return self._request_kwargs
+
+    def describe(self) -> Dict[str, Any]:
+        return {
+            "model": self.model,
+            "max_output_tokens": self.max_output_tokens,
+            "temperature": self.temperature,
+            "stop_sequences": self.stop_sequences,
+            "response_pool": self.response_pool,
+        }
+
+
+BASELINE_PROFILE = GenerationProfile("baseline")
+
+
+def _load_profiles() -> Dict[str, GenerationProfile]:
+    raw = {category: dict(values) for category, values in DEFAULT_GENERATION_PROFILES.items()}
+    overrides = os.getenv("GENERATION_PROFILES")
+    if overrides:
+        try:
+            for category, values in json.loads(overrides).items():
+                raw.setdefault(category, {}).update(values)
+        except (ValueError, AttributeError) as e:
+            logger.error(f"❌ GENERATION_PROFILES no es un JSON válido, usando valores por defecto: {e}")
+    profiles = {}
+    for category, values in raw.items():
+        merged = {**raw["DEFAULT"], **values} if category != "DEFAULT" else values
+        try:
+            profiles[category] = GenerationProfile(category, **merged)
+        except TypeError as e:
+            logger.error(f"❌ Perfil de generación '{category}' no válido, se usa DEFAULT: {e}")
+    profiles.setdefault("DEFAULT", GenerationProfile("DEFAULT"))
+    return profiles
+
+
+class ResponsePool:
+    """Respuestas pregeneradas (prompts/off_topic_pool.txt) elegidas por tema.
+
+    Se reconstruye cuando cambia la versión del fichero en el registro de prompts.
+    """
+
+    def __init__(self, file_name: str = RESPONSE_POOL_FILE, min_similarity: float = RESPONSE_POOL_MIN_SIMILARITY):
+        self.file_name = file_name
+        self.min_similarity = min_similarity
+        self._version: Optional[str] = None
+        self._topical: List[Tuple[List[Dict[str, float]], str]] = []
+        self._generic: List[str] = []
+
+    def _refresh(self):
+        version = prompt_registry.version(self.file_name)
+        if version == self._version:
+            return
+        self._version = version
+        self._topical, self._generic = [], []
+        for block in prompt_registry.text(self.file_name).split("\n---"):
+            lines = [line for line in block.strip().splitlines() if line.strip() and not line.startswith("#")]
+            if not lines:
+                continue
+            if lines[0].upper().startswith("TEMAS:"):
+                topics = [text_vector(t) for t in lines[0].split(":", 1)[1].split(",") if t.strip()]
+                self._topical.append((topics, "\n".join(lines[1:]).strip()))
+            else:
+                self._generic.append("\n".join(lines).strip())
+
+    def __len__(self) -> int:
+        self._refresh()
+        return len(self._topical) + len(self._generic)
+
+    def pick(self, query: str) -> Optional[str]:
+        self._refresh()
+        vector = text_vector(query)
+        best, best_score = None, self.min_similarity
+        for topics, response in self._topical:
+            score = max((cosine(vector, topic) for topic in topics), default=0.0)
+            if score >= best_score:
+                best, best_score = response, score
+        if best is not None:
+            return best
+        return random.choice(self._generic) if self._generic else None
+
+
+class GenerationProfiles:
+    """Elige perfil y modelo por categoría y mide salida y latencia de cada perfil."""
+
+    def __init__(self, model_factory: Callable[[str], Any], rollout: float = GENERATION_PROFILES_ROLLOUT):
+        self.model_factory = model_factory
+        self.rollout = rollout
+        self.profiles = _load_profiles()
+        self.pool = ResponsePool()
+        self._models: Dict[str, Any] = {}
+        self._stats: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        self._pool_stats = {"served": 0, "misses": 0}
+
+    def select(self, category: Optional[str]) -> GenerationProfile:
+        if self.rollout < 1.0 and random.random() >= self.rollout:
+            return BASELINE_PROFILE
+        return self.profiles.get(category or "", self.profiles["DEFAULT"])
+
+    def prepare(self):
+        """Construye el GenerationConfig de todos los perfiles (se llama en un hilo al arrancar)."""
+        for profile in (*self.profiles.values(), BASELINE_PROFILE):
+            profile.request_kwargs()
+
+    async def request_kwargs(self, profile: GenerationProfile) -> Dict[str, Any]:
+        """Argumentos del perfil sin bloquear el event loop si el calentamiento aún no los ha preparado."""
+        if profile.prepared:
+            return profile.request_kwargs()
+        return await asyncio.to_thread(profile.request_kwargs)
+
+    def model(self, profile: GenerationProfile):
+        # Un cliente por nombre de modelo, compartido entre categorías
+        if profile.model not in self._models:
+            self._models[profile.model] = self.model_factory(profile.model)
+        return self._models[profile.model]
+
+    def pooled_response(self, category: Optional[str], query: str) -> Optional[str]:
+        """Respuesta pregenerada si el perfil de la categoría usa el pool, o None."""
+        profile = self.profiles.get(category or "")
+        if profile is None or not profile.response_pool or (self.rollout < 1.0 and random.random() >= self.rollout):
+            return None
+        response = self.pool.pick(query)
+        self._pool_stats["served" if response else "misses"] += 1
+        return response
+
+    def record(self, category: Optional[str], profile: GenerationProfile, latency_ms: float,
+               output_text: str, output_tokens: Optional[int] = None):
+        arm = "baseline" if profile is BASELINE_PROFILE else "profile"
+        stats = self._stats.setdefault(category or "UNKNOWN", {}).setdefault(arm, {
+            "calls": 0, "output_tokens_total": 0, "output_tokens_max": 0, "latency": LatencyTracker(window=500)
+        })
+        tokens = output_tokens if output_tokens is not None else estimate_tokens(output_text)
+        stats["calls"] += 1
+        stats["output_tokens_total"] += tokens
+        stats["output_tokens_max"] = max(stats["output_tokens_max"], tokens)
+        stats["latency"].record(latency_ms)
+
+    def get_stats(self) -> Dict[str, Any]:
+        def summary(stats: Dict[str, Any]) -> Dict[str, Any]:
+            latency: LatencyTracker = stats["latency"]
+            p50, p95 = latency.percentile(0.5), latency.percentile(0.95)
+            return {
+                "calls": stats["calls"],
+                "avg_output_tokens": round(stats["output_tokens_total"] / stats["calls"], 1),
+                "max_output_tokens": stats["output_tokens_max"],
+                "latency_p50_ms": round(p50, 2) if p50 is not None else None,
+                "latency_p95_ms": round(p95, 2) if p95 is not None else None,
+            }
+
+        return {
+            "rollout": self.rollout,
+            "profiles": {category: profile.describe() for category, profile in self.profiles.items()},
+            "response_pool": {"size": len(self.pool), **self._pool_stats},
+            "by_category": {
+                category: {arm: summary(stats) for arm, stats in arms.items()}
+                for category, arms in self._stats.items()
+            },
+        }
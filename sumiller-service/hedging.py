@@ -0,0 +1,166 @@
+# sumiller-service/hedging.py
+
+# Peticiones "hedged" a Gemini: si una llamada tarda más que el p95 de su etapa,
+# se lanza una segunda idéntica y gana la primera que responda.
+import os
+import math
+import time
+import asyncio
+import logging
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+LLM_HEDGING_ENABLED = os.getenv("LLM_HEDGING_ENABLED", "false").lower() == "true"
+# Fracción máxima de llamadas que pueden lanzar una copia (ventana deslizante)
+LLM_HEDGE_MAX_RATE = float(os.getenv("LLM_HEDGE_MAX_RATE", "0.1"))
+# Muestras necesarias antes de fiarse del p95
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+# Espera mínima antes de lanzar la copia, aunque el p95 sea menor
+LLM_HEDGE_MIN_DELAY_MS = float(os.getenv("LLM_HEDGE_MIN_DELAY_MS", "100"))
+LLM_HEDGE_WINDOW = int(os.getenv("LLM_HEDGE_WINDOW", "200"))
+
+
+class LatencyTracker:
+    """Latencias recientes de una etapa para estimar su p95."""
+
+    def __init__(self, window: int = LLM_HEDGE_WINDOW):
+        self._samples: Deque[float] = deque(maxlen=window)
+
+    def record(self, latency_ms: float):
+        self._samples.append(latency_ms)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def percentile(self, q: float) -> Optional[float]:
+        if not self._samples:
+            return None
+        ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, max(0, math.ceil(q * len(ordered)) - 1))
+        return ordered[index]
+
+
+class Hedger:
+    """Aplica hedging a las llamadas de una etapa.
+
+    `call(factory)` lanza `factory()`; si no ha terminado cuando se cumple el p95
+    actual de la etapa (y el ritmo de copias está por debajo del límite) lanza
+    una segunda llamada igual. Se devuelve el primer resultado correcto y la otra
+    llamada se cancela. Los resultados descartados que ya habían terminado se
+    entregan a `discard` (p. ej. para cerrar un stream). Con `admission`, la copia
+    necesita su propio hueco (`try_acquire`, sin esperar en cola) y lo libera al
+    terminar; si no hay hueco libre no se lanza.
+    """
+
+    def __init__(self, stage: str, enabled: bool = LLM_HEDGING_ENABLED, max_rate: float = LLM_HEDGE_MAX_RATE,
+                 min_samples: int = LLM_HEDGE_MIN_SAMPLES, min_delay_ms: float = LLM_HEDGE_MIN_DELAY_MS,
+                 window: int = LLM_HEDGE_WINDOW):
+        self.stage = stage
+        self.enabled = enabled
+        self.max_rate = max_rate
+        self.min_samples = min_samples
+        self.min_delay_ms = min_delay_ms
+        self.latencies = LatencyTracker(window)
+        self._recent_hedges: Deque[bool] = deque(maxlen=window)
+        self._stats = {"calls": 0, "hedges_fired": 0, "hedges_won": 0, "hedges_skipped_rate": 0,
+                       "hedges_skipped_admission": 0, "losers_cancelled": 0, "errors": 0}
+
+    def hedge_delay_ms(self) -> Optional[float]:
+        """Espera antes de lanzar la copia, o None si no se debe hacer hedging."""
+        if not self.enabled or len(self.latencies) < self.min_samples:
+            return None
+        return max(self.latencies.percentile(0.95), self.min_delay_ms)
+
+    def _hedge_allowed(self) -> bool:
+        # Ritmo de copias contando la que se lanzaría ahora
+        return (sum(self._recent_hedges) + 1) / (len(self._recent_hedges) + 1) <= self.max_rate
+
+    async def call(self, factory: Callable[[], Awaitable[Any]],
+                   discard: Optional[Callable[[Any], Awaitable[None]]] = None, admission: Any = None) -> Any:
+        self._stats["calls"] += 1
+        delay_ms = self.hedge_delay_ms()
+        start = time.perf_counter()
+        primary = asyncio.ensure_future(factory())
+        tasks = {primary: start}
+        hedged = False
+        try:
+            if delay_ms is not None:
+                done, _ = await asyncio.wait({primary}, timeout=delay_ms / 1000)
+                if not done:
+                    if not self._hedge_allowed():
+                        self._stats["hedges_skipped_rate"] += 1
+                    elif admission is not None and not admission.try_acquire():
+                        # La copia no puede superar el límite de llamadas en vuelo de la etapa
+                        self._stats["hedges_skipped_admission"] += 1
+                    else:
+                        hedged = True
+                        self._stats["hedges_fired"] += 1
+                        hedge = asyncio.ensure_future(factory())
+                        if admission is not None:
+                            hedge.add_done_callback(lambda _: admission.release())
+                        tasks[hedge] = time.perf_counter()
+            self._recent_hedges.append(hedged)
+
+            pending = set(tasks)
+            error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        winner = task
+                        break
+                    error = task.exception()
+                else:
+                    continue
+                break
+            else:
+                self._stats["errors"] += 1
+                raise error
+
+            self.latencies.record((time.perf_counter() - tasks[winner]) * 1000)
+            if winner is not primary:
+                self._stats["hedges_won"] += 1
+            # Resultados de la llamada perdedora que hayan terminado a la vez
+            for task in tasks:
+                if task is not winner and task.done() and not task.cancelled() and task.exception() is None and discard:
+                    await discard(task.result())
+            return winner.result()
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+                    self._stats["losers_cancelled"] += 1
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def get_stats(self) -> Dict[str, Any]:
+        calls = self._stats["calls"]
+        fired = self._stats["hedges_fired"]
+        p95 = self.latencies.percentile(0.95)
+        return {
+            "enabled": self.enabled,
+            **self._stats,
+            "hedge_rate": round(fired / calls, 3) if calls else 0.0,
+            "hedge_win_rate": round(self._stats["hedges_won"] / fired, 3) if fired else 0.0,
+            "p95_ms": round(p95, 2) if p95 is not None else None,
+            "samples": len(self.latencies),
+        }
+
+
+_hedgers: Dict[str, Hedger] = {}
+
+
+def get_hedger(stage: str) -> Hedger:
+    """Hedger compartido de una etapa (clasificación, generación...)."""
+    if stage not in _hedgers:
+        _hedgers[stage] = Hedger(stage)
+    return _hedgers[stage]
+
+
+def get_hedging_stats() -> Dict[str, Any]:
+    return {
+        "max_rate": LLM_HEDGE_MAX_RATE,
+        "min_samples": LLM_HEDGE_MIN_SAMPLES,
+        "stages": {stage: hedger.get_stats() for stage, hedger in _hedgers.items()},
+    }
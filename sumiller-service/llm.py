@@ -0,0 +1,92 @@
+# sumiller-service/llm.py
+
+# Cliente de Gemini compartido por clasificación, generación y resúmenes.
+# vertexai (y google-cloud-aiplatform debajo) tarda en importarse e inicializarse:
+# se hace la primera vez que se necesita un modelo, no al importar el servicio.
+import os
+import time
+import asyncio
+import logging
+import threading
+from typing import Any, Dict, Optional
+
+from fake_model import FakeGenerativeModel
+
+logger = logging.getLogger(__name__)
+
+# La autenticación es automática en Cloud Run
+PROJECT_ID = os.getenv("GCP_PROJECT")
+LOCATION = os.getenv("GCP_REGION", "europe-west1")
+# USE_FAKE_LLM=true usa un modelo local para pruebas (sin importar vertexai)
+USE_FAKE_LLM = os.getenv("USE_FAKE_LLM", "false").lower() == "true"
+DEFAULT_MODEL = "gemini-2.0-flash"
+
+_lock = threading.Lock()
+_models: Dict[str, Any] = {}
+_fake_model: Optional[FakeGenerativeModel] = None
+_stats: Dict[str, Any] = {"vertex_init_ms": None, "models_created": 0}
+
+
+def _init_vertex():
+    if _stats["vertex_init_ms"] is not None:
+        return
+    start = time.perf_counter()
+    import vertexai
+    vertexai.init(project=PROJECT_ID, location=LOCATION)
+    _stats["vertex_init_ms"] = round((time.perf_counter() - start) * 1000, 2)
+    logger.info(f"✅ Vertex AI inicializado en {_stats['vertex_init_ms']} ms")
+
+
+def get_model(name: str = DEFAULT_MODEL):
+    """Cliente del modelo `name`, creado la primera vez y compartido por todos los módulos."""
+    global _fake_model
+    model = _models.get(name)
+    if model is not None:
+        return model
+    # Puede llamarse desde el calentamiento en un hilo y desde una petición a la vez
+    with _lock:
+        if name not in _models:
+            if USE_FAKE_LLM:
+                if _fake_model is None:
+                    _fake_model = FakeGenerativeModel.from_env()
+                _models[name] = _fake_model
+            else:
+                _init_vertex()
+                from vertexai.generative_models import GenerativeModel
+                _models[name] = GenerativeModel(name)
+            _stats["models_created"] += 1
+        return _models[name]
+
+
+def generation_config(**config):
+    """GenerationConfig de Vertex AI (importado solo cuando hay configuración que enviar)."""
+    if USE_FAKE_LLM:
+        return config
+    from vertexai.generative_models import GenerationConfig
+    return GenerationConfig(**config)
+
+
+class LazyModel:
+    """Referencia a un modelo que no crea el cliente hasta la primera llamada."""
+
+    def __init__(self, name: str = DEFAULT_MODEL):
+        self.name = name
+
+    async def generate_content_async(self, *args, **kwargs):
+        model = _models.get(self.name)
+        if model is None:
+            # La primera creación importa vertexai: fuera del event loop
+            model = await asyncio.to_thread(get_model, self.name)
+        return await model.generate_content_async(*args, **kwargs)
+
+
+def warm_up(*names: str) -> float:
+    """Crea los clientes de antemano (se lanza en segundo plano al arrancar). Devuelve los ms empleados."""
+    start = time.perf_counter()
+    for name in names or (DEFAULT_MODEL,):
+        get_model(name)
+    return round((time.perf_counter() - start) * 1000, 2)
+
+
+def get_llm_stats() -> Dict[str, Any]:
+    return {"fake": USE_FAKE_LLM, "models": sorted(_models), **_stats}
@@ -1,47 +1,147 @@
 # sumiller-service/main.py
 import os
 import json
+import time
+import asyncio
 import logging
-from typing import Dict, List, Any, Optional, AsyncGenerator
+from typing import Dict, List, Any, Optional, AsyncGenerator, Tuple, Callable
 from datetime import datetime
-from fastapi import FastAPI, HTTPException, Body
+from contextlib import asynccontextmanager
+
+# Perfil de arranque: la importación del servicio se mide desde aquí
+_IMPORT_START = time.perf_counter()
+from fastapi import FastAPI, HTTPException, Body, Response, Header, Query
 from fastapi.middleware.cors import CORSMiddleware
-from starlette.responses import StreamingResponse
+from starlette.responses import StreamingResponse, JSONResponse, PlainTextResponse
 from pydantic import BaseModel
-import httpx
 from pathlib import Path
-import vertexai
-from vertexai.generative_models import GenerativeModel
 
-from query_filter import filter_and_classify_query, CATEGORY_RESPONSES, load_prompt_from_file
+from query_filter import (
+    filter_and_classify_query, CATEGORY_RESPONSES, get_classifier_stats, get_classification_cache_stats,
+    peek_classification, classify_with_llm, remember_classification, get_classification_batch_stats
+)
 from memory import SumillerMemory
-from migrate_db import migrate_database
+from rag_client import RAGClient
+from prompt_registry import prompt_registry
+from prompt_builder import prompt_builder, estimate_tokens
+from summarizer import ConversationSummarizer
+from session_store import SessionStore
+from response_cache import SemanticResponseCache, stream_cached, RESPONSE_CACHE_ENABLED
+from streaming import coalesce_frames, get_streaming_stats, StreamFlight
+from cache import SingleFlight
+from text_similarity import normalize_text
+from hedging import get_hedger, get_hedging_stats
+from admission import AdmissionRejected, classification_admission
+from scheduler import generation_scheduler
+from llm import LazyModel, warm_up, get_llm_stats
+from generation_profiles import GenerationProfiles, BASELINE_MODEL
+from usage import extract_usage, record_usage, summarize_usage
+from metrics import Gauge, register, record_timings, render_metrics, requests_total
+from resilience import (
+    CircuitBreaker, FaultInjector, STAGE_DEADLINES_MS, with_deadline, stage_deadline, mark_degraded, get_deadline_stats
+)
 
-# --- INICIALIZACIÓN DE VERTEX AI ---
 logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
 logger = logging.getLogger(__name__)
 
-# La autenticación es automática en Cloud Run
-PROJECT_ID = os.getenv("GCP_PROJECT")
-LOCATION = os.getenv("GCP_REGION", "europe-west1")
-vertexai.init(project=PROJECT_ID, location=LOCATION)
-
-# Cargar el modelo de IA para generación
-generation_model = GenerativeModel("gemini-2.0-flash")
+# --- MODELOS DE VERTEX AI ---
+# Los clientes se crean en la primera llamada (o en el calentamiento tras arrancar) y se
+# comparten con la clasificación (llm.py); USE_FAKE_LLM=true usa un modelo local para pruebas
+generation_model = LazyModel(BASELINE_MODEL)
+# Modelo y configuración de generación por categoría (el pool de OFF_TOPIC evita la llamada)
+generation_profiles = GenerationProfiles(LazyModel)
+# Crear los clientes de Gemini en segundo plano nada más arrancar, sin retrasar el primer /health
+LLM_WARMUP = os.getenv("LLM_WARMUP", "true").lower() == "true"
 
 # Configuración del servicio
 SEARCH_SERVICE_URL = os.getenv("SEARCH_SERVICE_URL")
-app = FastAPI(title="Sumiller Service V2 (Vertex AI)")
+# Token opcional para los endpoints de administración
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+# Máximo de filas que devuelve /stats/usage por petición
+USAGE_STATS_MAX_LIMIT = 1000
+# Lanzar la búsqueda RAG en paralelo a la clasificación (se cancela si no hace falta)
+RAG_PREFETCH = os.getenv("RAG_PREFETCH", "true").lower() == "true"
+# Modo unificado: una sola llamada a Gemini clasifica y responde (solo /query)
+MERGED_CLASSIFY_ANSWER = os.getenv("MERGED_CLASSIFY_ANSWER", "false").lower() == "true"
+# Peticiones idénticas en curso comparten búsqueda RAG y, si no son personalizadas, generación
+COALESCE_REQUESTS = os.getenv("COALESCE_REQUESTS", "true").lower() == "true"
+rag_client = RAGClient(SEARCH_SERVICE_URL)
+# Tras varios fallos seguidos se deja de llamar al RAG y se responde sin contexto de vinos
+rag_breaker = CircuitBreaker(
+    "rag",
+    failure_threshold=int(os.getenv("RAG_BREAKER_FAILURES", "5")),
+    reset_timeout=float(os.getenv("RAG_BREAKER_RESET_SECONDS", "30"))
+)
+# Solo para pruebas locales: latencia y errores artificiales en la etapa RAG
+rag_faults = FaultInjector(
+    "rag",
+    latency_ms=float(os.getenv("RAG_FAULT_LATENCY_MS", "0")),
+    jitter_ms=float(os.getenv("RAG_FAULT_JITTER_MS", "0")),
+    error_rate=float(os.getenv("RAG_FAULT_ERROR_RATE", "0"))
+)
+# El endpoint /admin/faults/rag solo existe con ENABLE_FAULT_INJECTION=true y exige ADMIN_TOKEN
+ENABLE_FAULT_INJECTION = os.getenv("ENABLE_FAULT_INJECTION", "false").lower() == "true"
+
+# Duración de cada fase del arranque (ms), expuesta en /stats/performance
+_startup_profile: Dict[str, Any] = {}
+
+async def _warm_up_llm():
+    models = {BASELINE_MODEL, *(profile.model for profile in generation_profiles.profiles.values())}
+    try:
+        _startup_profile["llm_warmup_ms"] = await asyncio.to_thread(warm_up, *sorted(models))
+        # GenerationConfig de cada perfil, construido una vez fuera del event loop
+        await asyncio.to_thread(generation_profiles.prepare)
+        logger.info(f"🔥 Clientes de Gemini listos en {_startup_profile['llm_warmup_ms']} ms")
+    except Exception as e:
+        # La primera petición lo volverá a intentar
+        logger.warning(f"⚠️ No se pudo calentar el cliente de Gemini: {e}")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    start = time.perf_counter()
+    # Solo se crean tablas y se migra si la versión del esquema ha cambiado
+    migrated = await _timed(asyncio.to_thread(memory.ensure_schema), _startup_profile, "database")
+    _startup_profile["schema_migrated"] = migrated
+    # Un único cliente HTTP para todas las consultas al RAG (pool + keep-alive)
+    await _timed(rag_client.start(), _startup_profile, "rag_client")
+    # Las plantillas ya están en memoria; solo se vigila su mtime en segundo plano
+    prompt_registry.start_watcher()
+    warmup_task = asyncio.create_task(_warm_up_llm()) if LLM_WARMUP else None
+    _startup_profile["lifespan_ms"] = round((time.perf_counter() - start) * 1000, 2)
+    _startup_profile["ready_ms"] = round((time.perf_counter() - _IMPORT_START) * 1000, 2)
+    logger.info(
+        f"🚀 Arranque en {_startup_profile['ready_ms']} ms (importación {_startup_profile['import_ms']} ms, "
+        f"base de datos {_startup_profile['database_ms']} ms{', migrada' if migrated else ''}, "
+        f"cliente RAG {_startup_profile['rag_client_ms']} ms)"
+    )
+    yield
+    await _cancel(warmup_task)
+    await summarizer.close()
+    await prompt_registry.stop_watcher()
+    await rag_client.close()
+
+app = FastAPI(title="Sumiller Service V2 (Vertex AI)", lifespan=lifespan)
 app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
 
-# Ejecutar migración de base de datos al inicio
-try:
-    migrate_database()
-    logger.info("✅ Migración de base de datos completada")
-except Exception as e:
-    logger.error(f"❌ Error en migración de base de datos: {e}")
+@app.exception_handler(AdmissionRejected)
+async def admission_rejected_handler(request, exc: AdmissionRejected):
+    """Sobrecarga: 503 inmediato con Retry-After en lugar de esperar a un 429 de Vertex AI."""
+    requests_total.inc(request.url.path, "rejected")
+    return JSONResponse(
+        status_code=503,
+        content={"detail": BUSY_MESSAGE, "stage": exc.stage, "reason": exc.reason},
+        headers={"Retry-After": str(exc.retry_after)}
+    )
 
-memory = SumillerMemory()
+# Las tablas y migraciones se comprueban en el arranque (lifespan), no al importar
+memory = SumillerMemory(initialize=False)
+# Resumen acumulado por sesión, actualizado en segundo plano tras cada turno
+summarizer = ConversationSummarizer(generation_model, memory, BASELINE_MODEL)
+# Últimos turnos de cada sesión en el servidor (el cliente solo envía session_id)
+session_store = SessionStore(memory)
+# Respuestas reutilizables entre usuarios (categorías no personalizadas)
+response_cache = SemanticResponseCache()
+prompt_registry.on_reload(lambda names: response_cache.invalidate(f"prompts recargados: {', '.join(names)}"))
 
 class ConversationMessage(BaseModel):
     role: str
@@ -51,6 +151,8 @@ class QueryRequest(BaseModel):
     query: str
     user_id: Optional[str] = None
     user_name: Optional[str] = None
+    session_id: Optional[str] = None
+    # Compatibilidad: si se envía, se usa en lugar del estado de sesión del servidor
     conversation_history: List[ConversationMessage] = []
 
 class QueryResponse(BaseModel):
@@ -58,32 +160,78 @@ class QueryResponse(BaseModel):
     metadata: Dict[str, Any]
 
 # --- Lógica de Streaming con Vertex AI ---
+# Búsquedas RAG en curso por consulta normalizada; se cancelan si nadie las espera ya
+_rag_flight = SingleFlight(cancel_when_abandoned=True)
+# Generaciones en curso de respuestas no personalizadas, con reparto a todos los suscriptores
+generation_flight = StreamFlight()
+
 async def search_wines(query: str) -> tuple[List[Dict], Dict]:
-    """Busca vinos y retorna tanto los resultados como metadatos de trazabilidad"""
+    """Busca vinos; las búsquedas idénticas simultáneas comparten una sola llamada al RAG."""
+    if not COALESCE_REQUESTS:
+        return await _search_wines(query)
+    wines, metadata = await _rag_flight.do(normalize_text(query), lambda: _search_wines(query))
+    # Copias: cada petición anota sus propios metadatos
+    return list(wines), dict(metadata)
+
+async def _search_wines(query: str) -> tuple[List[Dict], Dict]:
+    """Busca vinos y retorna tanto los resultados como metadatos de trazabilidad.
+
+    La etapa tiene su propio plazo y pasa por el circuit breaker: si el RAG no
+    responde a tiempo o el circuito está abierto, se devuelve una lista vacía
+    marcada como degradada y la respuesta se genera sin contexto de vinos.
+    """
     if not SEARCH_SERVICE_URL: 
         return [], {"source": "none", "rag_used": False, "reason": "SEARCH_SERVICE_URL no configurada"}
+    if not rag_breaker.allow():
+        return [], {"source": "none", "rag_used": False, "degraded": True, "reason": "RAG circuit open"}
     
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(f"{SEARCH_SERVICE_URL}/search", json={"query": query}, timeout=10.0)
-            if response.status_code == 200:
-                wines_data = response.json().get("wines", [])
-                
-                # Analizar las fuentes de los datos
-                source_analysis = analyze_data_sources(wines_data)
-                
-                return wines_data, {
-                    "source": "rag",
-                    "rag_used": True,
-                    "total_results": len(wines_data),
-                    "sources": source_analysis,
-                    "rag_service_url": SEARCH_SERVICE_URL
-                }
-            else:
-                return [], {"source": "none", "rag_used": False, "reason": f"RAG error: {response.status_code}"}
+        response, timings = await with_deadline(_post_search(query), "rag")
+    except asyncio.CancelledError:
+        # Petición cancelada (cliente desconectado, prefetch descartado): no dice nada del RAG,
+        # pero si era la prueba del circuito semiabierto hay que liberarla
+        rag_breaker.release()
+        raise
+    except asyncio.TimeoutError:
+        rag_breaker.record_failure()
+        return [], {
+            "source": "none", "rag_used": False, "degraded": True,
+            "reason": f"RAG deadline exceeded ({STAGE_DEADLINES_MS['rag']:.0f} ms)"
+        }
     except Exception as e:
+        rag_breaker.record_failure()
         logger.error(f"Error buscando vinos: {e}")
-        return [], {"source": "none", "rag_used": False, "reason": f"RAG exception: {str(e)}"}
+        return [], {"source": "none", "rag_used": False, "degraded": True, "reason": f"RAG exception: {str(e)}"}
+
+    if response.status_code != 200:
+        if response.status_code >= 500:
+            rag_breaker.record_failure()
+        else:
+            rag_breaker.record_success()
+        return [], {"source": "none", "rag_used": False, "degraded": True, "reason": f"RAG error: {response.status_code}", "timings": timings}
+    rag_breaker.record_success()
+
+    data = response.json()
+    wines_data = data.get("wines", [])
+    response_cache.observe_index_version(data.get("index_version"))
+    
+    # Analizar las fuentes de los datos
+    source_analysis = analyze_data_sources(wines_data)
+    
+    return wines_data, {
+        "source": "rag",
+        "rag_used": True,
+        "total_results": len(wines_data),
+        "sources": source_analysis,
+        "rag_service_url": SEARCH_SERVICE_URL,
+        "index_version": data.get("index_version"),
+        "timings": timings
+    }
+
+async def _post_search(query: str):
+    await rag_faults.inject()
+    # El timeout HTTP no supera el plazo de la etapa
+    return await rag_client.post("/search", {"query": query}, timeout=stage_deadline("rag"))
 
 def analyze_data_sources(wines_data: List[Dict]) -> Dict:
     """Analiza las fuentes de datos en los resultados del RAG"""
@@ -121,219 +269,790 @@ def analyze_data_sources(wines_data: List[Dict]) -> Dict:
         "details": sources_detail[:3]  # Solo los primeros 3 para no sobrecargar
     }
 
-async def generate_complete_response(query: str, wines: List[Dict], context: Dict, conversation_history: List[ConversationMessage], category: str = None) -> str:
+GENERATION_ERROR_MESSAGE = "Parece que he tenido un problema conectando con mi sabiduría vinícola."
+BUSY_MESSAGE = "Ahora mismo estoy atendiendo muchas consultas. Inténtalo de nuevo en unos segundos."
+
+def _generation_lane(category: Optional[str], streaming: bool) -> str:
+    """Carril del planificador: las respuestas cortas de plantilla primero, luego streaming y después batch."""
+    if category == "OFF_TOPIC":
+        return "predefined"
+    return "stream" if streaming else "batch"
+
+async def generate_complete_response(query: str, wines: List[Dict], context: Dict, conversation_history: List[ConversationMessage], category: str = None, trace: Optional[Dict[str, Any]] = None, user_id: Optional[str] = None) -> str:
     """Genera una respuesta completa sin streaming"""
-    # Usar prompt específico según la categoría
-    if category == "SECRET_MESSAGE":
-        base_prompt = load_prompt_from_file("secret_message_generation.txt")
-    elif category == "OFF_TOPIC":
-        base_prompt = load_prompt_from_file("off_topic_response.txt")
-    else:
-        base_prompt = load_prompt_from_file("sumiller_generacion.txt")
+    build_start = time.perf_counter()
+    full_prompt = prompt_builder.build_generation(query, wines, context, conversation_history, category, trace=trace)
+    if trace is not None:
+        trace["prompt_build_ms"] = round((time.perf_counter() - build_start) * 1000, 2)
+    profile = generation_profiles.select(category)
+    model = generation_profiles.model(profile)
+    request_kwargs = await generation_profiles.request_kwargs(profile)
     
-    # Adaptar el historial para el modelo Gemini
-    history = [f"{msg.role}: {msg.content}" for msg in conversation_history[-8:]]
-    history_str = "\n".join(history)
-    
-    wines_str = f"Vinos encontrados:\n{json.dumps(wines, indent=2, ensure_ascii=False)}" if wines else "No se encontraron vinos específicos."
-    
-    # Para mensajes secretos, incluir información específica
-    if category == "SECRET_MESSAGE":
-        # El destinatario SIEMPRE es Vicky, el remitente es quien hace la consulta
-        sender_name = context.get('sender_name', 'Tu sumiller')
-        sender_first_name = sender_name.split()[0] if sender_name else "Tu sumiller"
-        
-        full_prompt = f"""{base_prompt}
+    try:
+        # --- LLAMADA A VERTEX AI (sin streaming) ---
+        async with generation_scheduler.slot(user_id=user_id, lane=_generation_lane(category, False), cost=estimate_tokens(full_prompt)):
+            start = time.perf_counter()
+            response = await with_deadline(
+                get_hedger("generation").call(
+                    lambda: model.generate_content_async(full_prompt, **request_kwargs),
+                    admission=generation_scheduler
+                ),
+                "generation"
+            )
+        usage = extract_usage(response, full_prompt, response.text, profile.model)
+        record_usage(trace, "generation", usage)
+        generation_profiles.record(category, profile, (time.perf_counter() - start) * 1000, response.text, usage["output_tokens"])
+        return response.text
+    except AdmissionRejected:
+        raise
+    except asyncio.TimeoutError:
+        mark_degraded(trace, "generation")
+        return GENERATION_ERROR_MESSAGE
+    except Exception as e:
+        logger.error(f"Error en Vertex AI: {e}")
+        return GENERATION_ERROR_MESSAGE
 
-INFORMACIÓN DEL MENSAJE:
-- Destinatario: Vicky (SIEMPRE)
-- Remitente: {sender_first_name}
-- Consulta original: {query}
+async def _close_stream(result):
+    """Cierra el stream de una llamada duplicada que ha perdido la carrera."""
+    chunks, _ = result
+    if hasattr(chunks, "aclose"):
+        await chunks.aclose()
 
-CONTEXTO ADICIONAL:
-{json.dumps(context, ensure_ascii=False)}
+async def generate_streaming_response(query: str, wines: List[Dict], context: Dict, conversation_history: List[ConversationMessage], category: str = None, trace: Optional[Dict[str, Any]] = None, user_id: Optional[str] = None) -> AsyncGenerator[str, None]:
+    build_start = time.perf_counter()
+    full_prompt = prompt_builder.build_generation(query, wines, context, conversation_history, category, trace=trace)
+    if trace is not None:
+        trace["prompt_build_ms"] = round((time.perf_counter() - build_start) * 1000, 2)
+    profile = generation_profiles.select(category)
+    model = generation_profiles.model(profile)
+    request_kwargs = await generation_profiles.request_kwargs(profile)
+    
+    async def first_chunk():
+        stream = await model.generate_content_async(full_prompt, stream=True, **request_kwargs)
+        chunks = stream.__aiter__()
+        return chunks, await anext(chunks, None)
 
-HISTORIAL RECIENTE:
-{history_str}
+    try:
+        # --- LLAMADA DE STREAMING A VERTEX AI ---
+        # El hueco de admisión se mantiene mientras dure el stream del modelo
+        async with generation_scheduler.slot(user_id=user_id, lane=_generation_lane(category, True), cost=estimate_tokens(full_prompt)):
+            # El plazo (y el hedging) cubren hasta el primer fragmento; a partir de ahí manda el ritmo del cliente
+            start = time.perf_counter()
+            chunks, first = await with_deadline(
+                get_hedger("generation_first_chunk").call(first_chunk, discard=_close_stream, admission=generation_scheduler),
+                "generation"
+            )
+            if trace is not None:
+                # Tiempo hasta el primer fragmento del modelo y duración total del stream (sin la espera en cola)
+                trace["generation_first_chunk_ms"] = round((time.perf_counter() - start) * 1000, 2)
+            parts: List[str] = []
+            # Vertex AI envía el uso en el último fragmento; si el stream se corta se estima
+            last = first
+            try:
+                if first is not None:
+                    parts.append(first.text)
+                    yield first.text
+                    async for chunk in chunks:
+                        last = chunk
+                        parts.append(chunk.text)
+                        yield chunk.text
+            finally:
+                usage = extract_usage(last, full_prompt, "".join(parts), profile.model)
+                record_usage(trace, "generation", usage)
+                if trace is not None:
+                    trace["generation_stream_ms"] = round((time.perf_counter() - start) * 1000, 2)
+            generation_profiles.record(category, profile, (time.perf_counter() - start) * 1000, "".join(parts), usage["output_tokens"])
+    except AdmissionRejected:
+        # Las cabeceras ya se han enviado: no se puede responder 503
+        mark_degraded(trace, "admission")
+        yield BUSY_MESSAGE
+    except asyncio.TimeoutError:
+        mark_degraded(trace, "generation")
+        yield GENERATION_ERROR_MESSAGE
+    except Exception as e:
+        logger.error(f"Error en el streaming de Vertex AI: {e}")
+        yield GENERATION_ERROR_MESSAGE
 
-Genera un mensaje secreto ÚNICO y ORIGINAL usando las instrucciones anteriores.
-"""
-    else:
-        full_prompt = f"""{base_prompt}
+# --- Modo unificado (clasificación + respuesta en una llamada) ---
+MERGED_PENDING_MARKER = "PENDIENTE"
 
-CONTEXTO DEL USUARIO:
-{json.dumps(context, ensure_ascii=False)}
+# Comparativa de llamadas a Gemini y latencia entre el flujo en dos etapas y el unificado
+_pipeline_stats = {
+    mode: {"requests": 0, "llm_calls": 0, "total_ms": 0.0, "second_calls": 0, "parse_failures": 0}
+    for mode in ("two_stage", "merged")
+}
 
-HISTORIAL DE CONVERSACIÓN:
-{history_str}
+def parse_merged_response(text: str) -> Tuple[Optional[Dict[str, Any]], str]:
+    """Separa la cabecera JSON y el cuerpo de una respuesta del modo unificado."""
+    header_text, separator, body = text.strip().partition("\n---")
+    if not separator:
+        return None, text
+    header_text = header_text.replace("```json", "").replace("```", "").strip()
+    try:
+        header = json.loads(header_text)
+    except ValueError:
+        return None, text
+    if not isinstance(header, dict) or "category" not in header or "confidence" not in header:
+        return None, text
+    return header, body.lstrip("-").strip()
 
-CONSULTA ACTUAL:
-{query}
+async def classify_and_answer(request: QueryRequest, context_task: asyncio.Task, timings: Dict[str, Any]) -> Tuple[Dict[str, Any], Optional[str]]:
+    """Clasifica y, si no hace falta RAG, responde con una única llamada a Gemini.
 
-VINOS ENCONTRADOS (si aplica):
-{wines_str}
+    Si la caché o el clasificador local ya resuelven la categoría no se usa el
+    prompt unificado (la clasificación no costaría ninguna llamada). Devuelve la
+    clasificación y el borrador de respuesta, o None si hace falta una segunda
+    llamada (con contexto RAG o con el prompt de mensaje secreto).
+    """
+    has_history = bool(request.conversation_history)
+    classification = peek_classification(request.query, has_history, trace=timings)
+    if classification is not None:
+        return classification, None
 
-RESPUESTA:
-"""
-    
+    user_context = await asyncio.shield(context_task)
+    full_prompt = prompt_builder.build_merged(request.query, user_context, request.conversation_history, trace=timings)
+
+    timings["merged_calls"] = 1
+    header = None
     try:
-        # --- LLAMADA A VERTEX AI (sin streaming) ---
-        response = await generation_model.generate_content_async(full_prompt)
-        return response.text
+        async with generation_scheduler.slot(user_id=request.user_id, lane="batch", cost=estimate_tokens(full_prompt)):
+            response = await with_deadline(generation_model.generate_content_async(full_prompt), "generation")
+        record_usage(timings, "merged", extract_usage(response, full_prompt, response.text, BASELINE_MODEL))
+        header, body = parse_merged_response(response.text)
+    except AdmissionRejected:
+        raise
     except Exception as e:
-        logger.error(f"Error en Vertex AI: {e}")
-        return "Parece que he tenido un problema conectando con mi sabiduría vinícola."
-
-async def generate_streaming_response(query: str, wines: List[Dict], context: Dict, conversation_history: List[ConversationMessage], category: str = None) -> AsyncGenerator[str, None]:
-    # Usar prompt específico según la categoría
-    if category == "SECRET_MESSAGE":
-        base_prompt = load_prompt_from_file("secret_message_generation.txt")
-    elif category == "OFF_TOPIC":
-        base_prompt = load_prompt_from_file("off_topic_response.txt")
-    else:
-        base_prompt = load_prompt_from_file("sumiller_generacion.txt")
-    
-    # Adaptar el historial para el modelo Gemini
-    history = [f"{msg.role}: {msg.content}" for msg in conversation_history[-8:]]
-    history_str = "\n".join(history)
-    
-    wines_str = f"Vinos encontrados:\n{json.dumps(wines, indent=2, ensure_ascii=False)}" if wines else "No se encontraron vinos específicos."
-    
-    # Para mensajes secretos, incluir información específica
-    if category == "SECRET_MESSAGE":
-        # El destinatario SIEMPRE es Vicky, el remitente es quien hace la consulta
-        sender_name = context.get('sender_name', 'Tu sumiller')
-        sender_first_name = sender_name.split()[0] if sender_name else "Tu sumiller"
-        
-        full_prompt = f"""{base_prompt}
+        logger.error(f"❌ Error en la llamada unificada a Vertex AI: {e}")
+    if header is None:
+        # Cabecera ilegible: volver a la clasificación dedicada
+        _pipeline_stats["merged"]["parse_failures"] += 1
+        return await classify_with_llm(request.query, has_history, trace=timings), None
 
-INFORMACIÓN DEL MENSAJE:
-- Destinatario: Vicky (SIEMPRE)
-- Remitente: {sender_first_name}
-- Consulta original: {query}
+    category = header["category"]
+    classification = {
+        "category": category,
+        "confidence": header["confidence"],
+        "reasoning": header.get("reasoning", "")
+    }
+    remember_classification(request.query, has_history, classification)
+    classification["should_use_rag"] = bool(header.get("needs_retrieval")) and category in ["WINE_SEARCH", "WINE_THEORY"]
+    timings["classification_source"] = "merged"
 
-CONTEXTO ADICIONAL:
-{json.dumps(context, ensure_ascii=False)}
+    if classification["should_use_rag"] or category == "SECRET_MESSAGE" or not body or body == MERGED_PENDING_MARKER:
+        return classification, None
+    return classification, body
 
-HISTORIAL RECIENTE:
-{history_str}
+def _record_pipeline(mode: str, timings: Dict[str, Any], generated: bool):
+    stats = _pipeline_stats[mode]
+    stats["requests"] += 1
+    calls = timings.get("merged_calls", 0) + (1 if generated else 0)
+    if timings.get("classification_source") in ("llm", "batch", "fallback"):
+        calls += 1
+    stats["llm_calls"] += calls
+    stats["total_ms"] += timings.get("total_ms", 0.0)
+    if mode == "merged" and generated and timings.get("merged_calls"):
+        stats["second_calls"] += 1
+    timings["llm_calls"] = calls
 
-Genera un mensaje secreto ÚNICO y ORIGINAL usando las instrucciones anteriores.
-"""
-    else:
-        full_prompt = f"""{base_prompt}
+def get_pipeline_stats() -> Dict[str, Any]:
+    summary = {"merged_mode_enabled": MERGED_CLASSIFY_ANSWER}
+    for mode, stats in _pipeline_stats.items():
+        requests = stats["requests"]
+        summary[mode] = {
+            **{k: round(v, 2) for k, v in stats.items()},
+            "avg_llm_calls": round(stats["llm_calls"] / requests, 3) if requests else 0.0,
+            "avg_total_ms": round(stats["total_ms"] / requests, 2) if requests else 0.0,
+        }
+    return summary
 
-CONTEXTO DEL USUARIO:
-{json.dumps(context, ensure_ascii=False)}
+# --- Preparación concurrente de la consulta ---
+async def _timed(coro, timings: Dict[str, float], stage: str):
+    """Ejecuta una corrutina registrando su duración en milisegundos."""
+    start = time.perf_counter()
+    try:
+        return await coro
+    finally:
+        timings[f"{stage}_ms"] = round((time.perf_counter() - start) * 1000, 2)
 
-HISTORIAL DE CONVERSACIÓN:
-{history_str}
+async def _cancel(task: Optional[asyncio.Task]):
+    if task is not None and not task.done():
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
 
-CONSULTA ACTUAL:
-{query}
+def _is_predefined(category: str) -> bool:
+    # Para SECRET_MESSAGE y OFF_TOPIC, siempre generar dinámicamente
+    return category in CATEGORY_RESPONSES and category not in ["SECRET_MESSAGE", "OFF_TOPIC"]
 
-VINOS ENCONTRADOS (si aplica):
-{wines_str}
+async def _classify_only(request: QueryRequest, timings: Dict[str, Any]) -> Tuple[Dict[str, Any], Optional[str]]:
+    classification = await filter_and_classify_query(
+        request.query, has_history=bool(request.conversation_history), trace=timings
+    )
+    return classification, None
 
-RESPUESTA:
-"""
-    
+async def resolve_history(request: QueryRequest) -> int:
+    """Rellena el historial desde el estado de sesión si el cliente no lo envía.
+
+    Devuelve la posición del primer mensaje del historial dentro de la sesión.
+    """
+    if not request.session_id or request.conversation_history:
+        return 0
+    state = await session_store.get(request.session_id, request.user_id)
+    # Los mensajes ya se validaron al entrar en la sesión
+    request.conversation_history = [ConversationMessage.model_construct(**msg) for msg in state.messages]
+    return state.offset
+
+async def load_user_context(request: QueryRequest, history_offset: int = 0) -> Dict[str, Any]:
+    """Contexto del usuario más, si la petición trae sesión, su resumen acumulado."""
+    if not request.session_id:
+        return await memory.get_user_context(request.user_id)
+    user_context, summary = await asyncio.gather(
+        memory.get_user_context(request.user_id),
+        memory.get_session_summary(request.session_id, request.user_id)
+    )
+    if summary:
+        # Posición relativa al historial disponible en esta petición
+        summary["messages_summarized"] = max(summary["messages_summarized"] - history_offset, 0)
+        user_context["session_summary"] = summary
+    return user_context
+
+async def _load_context_within_deadline(request: QueryRequest, history_offset: int, timings: Dict[str, Any]) -> Dict[str, Any]:
     try:
-        # --- LLAMADA DE STREAMING A VERTEX AI ---
-        stream = await generation_model.generate_content_async(full_prompt, stream=True)
-        async for chunk in stream:
-            yield chunk.text
-    except Exception as e:
-        logger.error(f"Error en el streaming de Vertex AI: {e}")
-        yield "Parece que he tenido un problema conectando con mi sabiduría vinícola."
+        return await with_deadline(load_user_context(request, history_offset), "memory")
+    except asyncio.TimeoutError:
+        # Sin memoria a tiempo se responde como a un usuario sin historial guardado
+        mark_degraded(timings, "memory")
+        return {"user_id": request.user_id, "recent_conversations": [], "preferences": {}, "favorite_wines": [], "top_rated_wines": []}
 
-# --- Endpoints de la API ---
-@app.post("/query", response_model=QueryResponse)
-async def query(request: QueryRequest):
-    classification = await filter_and_classify_query(request.query)
+async def finish_turn(request: QueryRequest, full_response: str, wines: List[Dict], history_offset: int = 0,
+                      category: Optional[str] = None, usage: Optional[Dict[str, Any]] = None,
+                      trace: Optional[Dict[str, Any]] = None):
+    """Persiste el turno (con su uso de Gemini), actualiza el estado de sesión y programa el resumen."""
+    save_start = time.perf_counter()
+    await memory.save_conversation(
+        user_id=request.user_id,
+        query=request.query,
+        response=full_response,
+        wines_recommended=wines,
+        session_id=request.session_id,
+        user_name=request.user_name,
+        category=category,
+        usage=usage
+    )
+    if trace is not None:
+        trace["save_ms"] = round((time.perf_counter() - save_start) * 1000, 2)
+    session_store.append_turn(request.session_id, request.user_id, request.query, full_response)
+    messages = [{"role": msg.role, "content": msg.content} for msg in request.conversation_history]
+    # El cliente puede incluir ya la consulta actual como último mensaje del historial
+    if not messages or messages[-1] != {"role": "user", "content": request.query}:
+        messages.append({"role": "user", "content": request.query})
+    messages.append({"role": "assistant", "content": full_response})
+    summarizer.schedule(request.session_id, request.user_id, messages, history_offset)
+
+async def prepare_query(request: QueryRequest, allow_merged: bool = False,
+                        emit: Optional[Callable[[str, Dict[str, Any]], None]] = None) -> Dict[str, Any]:
+    """Clasifica la consulta y obtiene RAG y contexto de usuario de forma concurrente.
+
+    La búsqueda RAG se lanza especulativamente mientras la clasificación está en
+    curso y se cancela si la categoría final no la necesita. El contexto del usuario
+    tampoco depende de la categoría, así que se lee en paralelo. Si se indica
+    `emit`, se le notifica cada etapa en cuanto termina (eventos SSE).
+    """
+    timings: Dict[str, Any] = {}
+    start = time.perf_counter()
+    merged = allow_merged and MERGED_CLASSIFY_ANSWER
+    timings["pipeline_mode"] = "merged" if merged else "two_stage"
+
+    rag_task = None
+    if RAG_PREFETCH and SEARCH_SERVICE_URL:
+        rag_task = asyncio.create_task(_timed(search_wines(request.query), timings, "rag"))
+    # La clasificación necesita saber si hay historial: se resuelve antes (en memoria salvo la primera vez)
+    try:
+        history_offset = await _timed(resolve_history(request), timings, "session")
+    except BaseException:
+        await _cancel(rag_task)
+        raise
+
+    context_task = asyncio.create_task(_timed(_load_context_within_deadline(request, history_offset, timings), timings, "context"))
+    classify_coro = classify_and_answer(request, context_task, timings) if merged else _classify_only(request, timings)
+    classify_task = asyncio.create_task(_timed(classify_coro, timings, "classification"))
+
+    try:
+        classification, draft_response = await classify_task
+    except BaseException:
+        await _cancel(rag_task)
+        await _cancel(context_task)
+        raise
     category = classification.get("category", "OFF_TOPIC")
-    
-    full_response = ""
-    wines = []
-    rag_metadata = {"source": "none", "rag_used": False}
-    
-    # Para SECRET_MESSAGE y OFF_TOPIC, siempre generar dinámicamente
-    if category in CATEGORY_RESPONSES and category not in ["SECRET_MESSAGE", "OFF_TOPIC"]:
-        full_response = CATEGORY_RESPONSES[category]
+    if timings.get("classification_source") == "fallback":
+        mark_degraded(timings, "classification")
+    if emit:
+        emit("classification", {
+            "category": category,
+            "classification": classification,
+            "source": timings.get("classification_source"),
+            "classification_ms": timings.get("classification_ms")
+        })
+
+    wines: List[Dict] = []
+    rag_metadata: Dict[str, Any] = {"source": "none", "rag_used": False}
+    user_context: Dict[str, Any] = {}
+
+    # La caché se consulta con la última versión conocida del índice, antes de esperar al RAG
+    cached_response = None
+    if draft_response is None and not _is_predefined(category):
+        cached_response = _lookup_cached_response(request, category)
+    try:
+        if cached_response is not None:
+            await _cancel(rag_task)
+            await _cancel(context_task)
+            rag_metadata["source"] = "response_cache"
+            timings["rag_prefetch"] = "cancelled" if rag_task else "disabled"
+        else:
+            wines, rag_metadata, user_context = await _gather_sources(
+                request, classification, rag_task, context_task, timings, rag_metadata
+            )
+    except BaseException:
+        await _cancel(rag_task)
+        await _cancel(context_task)
+        raise
+    if emit:
+        emit("rag", {**rag_metadata, "rag_ms": timings.get("rag_ms"), "rag_prefetch": timings.get("rag_prefetch")})
+
+    timings["preparation_ms"] = round((time.perf_counter() - start) * 1000, 2)
+    return {
+        "classification": classification,
+        "category": category,
+        "wines": wines,
+        "rag_metadata": rag_metadata,
+        "user_context": user_context,
+        "draft_response": draft_response,
+        "cached_response": cached_response,
+        "history_offset": history_offset,
+        "timings": timings,
+        "started_at": start,
+    }
+
+async def _gather_sources(request: QueryRequest, classification: Dict[str, Any], rag_task: Optional[asyncio.Task],
+                          context_task: asyncio.Task, timings: Dict[str, Any], rag_metadata: Dict[str, Any]):
+    """Espera (o descarta) la búsqueda RAG y el contexto según la categoría."""
+    category = classification.get("category", "OFF_TOPIC")
+    wines: List[Dict] = []
+    user_context: Dict[str, Any] = {}
+
+    if _is_predefined(category):
+        await _cancel(rag_task)
+        await _cancel(context_task)
         rag_metadata["source"] = "predefined_response"
+        timings["rag_prefetch"] = "cancelled" if rag_task else "disabled"
     else:
-        # Usar RAG si es necesario
         if classification.get("should_use_rag"):
-            wines, rag_metadata = await search_wines(request.query)
-        
-        user_context = await memory.get_user_context(request.user_id)
-        
+            if rag_task is None:
+                rag_task = asyncio.create_task(_timed(search_wines(request.query), timings, "rag"))
+                timings["rag_prefetch"] = "disabled"
+            else:
+                timings["rag_prefetch"] = "used"
+            wines, rag_metadata = await rag_task
+            if rag_metadata.get("degraded"):
+                mark_degraded(timings, "rag")
+        else:
+            await _cancel(rag_task)
+            timings["rag_prefetch"] = "cancelled" if rag_task else "disabled"
+        if _is_shared_generation(request, category):
+            # La respuesta se reutiliza para otros usuarios: no puede llevar sus preferencias ni favoritos
+            await _cancel(context_task)
+            timings["context_skipped"] = "shared_generation"
+        else:
+            user_context = await context_task
+
         # Añadir información del usuario al contexto para mensajes secretos
         if category == "SECRET_MESSAGE" and request.user_name:
             user_context['sender_name'] = request.user_name
-        
+    return wines, rag_metadata, user_context
+
+def _is_shared_generation(request: QueryRequest, category: str) -> bool:
+    """Respuestas que se cachean o se comparten entre peticiones: se generan sin contexto de usuario."""
+    return (RESPONSE_CACHE_ENABLED or COALESCE_REQUESTS) and response_cache.is_shareable(
+        category, bool(request.conversation_history)
+    )
+
+def _response_cache_version() -> tuple:
+    """Versión de prompts y última versión conocida del índice RAG.
+
+    No depende de la búsqueda de la petición: así un acierto no espera al RAG.
+    Un cambio de índice se detecta en la siguiente búsqueda que llegue al RAG.
+    """
+    return (prompt_registry.version(), response_cache.index_version)
+
+def _lookup_cached_response(request: QueryRequest, category: str) -> Optional[Dict[str, Any]]:
+    if not response_cache.is_cacheable(category, bool(request.conversation_history)):
+        return None
+    return response_cache.lookup(request.query, category, _response_cache_version())
+
+def _store_cached_response(request: QueryRequest, prepared: Dict[str, Any], full_response: str,
+                           generation_trace: Optional[Dict[str, Any]] = None):
+    """Guarda la respuesta generada si se puede reutilizar.
+
+    `generation_trace` es la traza de la generación cuando no es la de la
+    preparación (streaming): ahí se anotan la admisión rechazada o el plazo agotado.
+    """
+    category = prepared["category"]
+    if not response_cache.is_cacheable(category, bool(request.conversation_history)):
+        return
+    if not full_response or full_response.endswith((GENERATION_ERROR_MESSAGE, BUSY_MESSAGE)):
+        return
+    # Una respuesta generada sin contexto RAG (o con otra etapa degradada) no se reutiliza
+    if prepared["timings"].get("degraded") or (generation_trace or {}).get("degraded"):
+        return
+    index_version = prepared["rag_metadata"].get("index_version")
+    if index_version and index_version != response_cache.index_version:
+        return  # El índice cambió durante la generación: el contexto usado ya no es el actual
+    response_cache.store(request.query, full_response, category, _response_cache_version())
+
+def _generation_key(request: QueryRequest, prepared: Dict[str, Any]) -> Optional[tuple]:
+    """Clave para compartir la generación entre peticiones idénticas en curso, o None si es personalizada."""
+    if not COALESCE_REQUESTS or not _is_shared_generation(request, prepared["category"]):
+        return None
+    # Solo se comparte un prompt construido sin contexto de usuario: lo leerán otros usuarios
+    if prepared["user_context"]:
+        return None
+    return (normalize_text(request.query), prepared["category"], prompt_registry.version())
+
+def _check_generation_capacity(request: QueryRequest, key: Optional[tuple]):
+    """Rechaza (503) antes de empezar si esta petición va a llamar a Gemini y la cola de generación está llena.
+
+    Se comprueba tras clasificar: las respuestas predefinidas, del pool, de caché o
+    compartidas con una generación en curso no ocupan hueco y no se rechazan.
+    """
+    if key is None or not generation_flight.is_inflight(key):
+        generation_scheduler.check(user_id=request.user_id)
+
+async def _collect(chunks: AsyncGenerator[str, None]) -> str:
+    return "".join([chunk async for chunk in chunks])
+
+def _server_timing(timings: Dict[str, Any]) -> str:
+    """Formatea las duraciones de cada etapa como cabecera Server-Timing."""
+    return ", ".join(
+        f"{key[:-3]};dur={value}" for key, value in timings.items() if key.endswith("_ms")
+    )
+
+# --- Endpoints de la API ---
+@app.post("/query", response_model=QueryResponse)
+async def query(request: QueryRequest, response: Response):
+    prepared = await prepare_query(request, allow_merged=True)
+    classification = prepared["classification"]
+    category = prepared["category"]
+    wines = prepared["wines"]
+    rag_metadata = prepared["rag_metadata"]
+    timings = prepared["timings"]
+    
+    generated = False
+    cached = None
+    if _is_predefined(category):
+        full_response = CATEGORY_RESPONSES[category]
+        response_source = "predefined"
+    elif prepared["draft_response"] is not None:
+        # Modo unificado: la respuesta llegó junto con la clasificación
+        full_response = prepared["draft_response"]
+        response_source = "vertex_ai"
+    elif (pooled := generation_profiles.pooled_response(category, request.query)) is not None:
+        full_response = pooled
+        response_source = "response_pool"
+    elif (cached := prepared["cached_response"]) is not None:
+        full_response = cached["response"]
+        response_source = "response_cache"
+    else:
         # Generar respuesta (no streaming para incluir metadatos)
-        full_response = await generate_complete_response(request.query, wines, user_context, request.conversation_history, category)
+        def generate():
+            return generate_complete_response(
+                request.query, wines, prepared["user_context"], request.conversation_history, category, trace=timings, user_id=request.user_id
+            )
+        key = _generation_key(request, prepared)
+        _check_generation_capacity(request, key)
+        coalesced = False
+        if key is None:
+            full_response = await _timed(generate(), timings, "generation")
+        else:
+            async def complete():
+                yield await generate()
+            # Si ya se está generando la misma respuesta, se espera a esa en lugar de llamar a Gemini
+            chunks, coalesced = generation_flight.join(key, complete)
+            full_response = await _timed(_collect(chunks), timings, "generation")
+        generated = not coalesced
+        response_source = "coalesced" if coalesced else "vertex_ai"
+        if generated:
+            _store_cached_response(request, prepared, full_response)
     
+    # Tokens y coste de las llamadas a Gemini de esta petición (cero si no hubo ninguna)
+    usage = summarize_usage(timings.pop("usage", None))
     # Guardar conversación
-    await memory.save_conversation(
-        user_id=request.user_id,
-        query=request.query,
-        response=full_response,
-        wines_recommended=wines,
-        user_name=request.user_name
-    )
+    await finish_turn(request, full_response, wines, prepared["history_offset"], category, usage, trace=timings)
+    timings["total_ms"] = round((time.perf_counter() - prepared["started_at"]) * 1000, 2)
+    _record_pipeline(timings["pipeline_mode"], timings, generated)
+    record_timings("/query", timings, response_source)
+    response.headers["Server-Timing"] = _server_timing(timings)
     
+    # Tamaño del prompt enviado a Gemini (si lo hubo), fuera de las duraciones por etapa
+    prompt_stats = timings.pop("prompt", None)
+    degraded_stages = timings.pop("degraded", [])
+
     # Construir metadatos completos
     metadata = {
         "classification": classification,
         "rag_data": rag_metadata,
-        "response_source": "vertex_ai" if category not in CATEGORY_RESPONSES else "predefined",
+        "response_source": response_source,
         "timestamp": datetime.now().isoformat(),
-        "category": category
+        "category": category,
+        "stage_timings": timings,
+        "prompt_stats": prompt_stats,
+        "response_cache": cached and {k: v for k, v in cached.items() if k != "response"},
+        "usage": usage,
+        "degraded": bool(degraded_stages),
+        "degraded_stages": degraded_stages
     }
     
     return QueryResponse(response=full_response, metadata=metadata)
 
+async def _single_chunk(text: str) -> AsyncGenerator[str, None]:
+    yield text
+
+def stream_answer(request: QueryRequest, prepared: Dict[str, Any], trace: Dict[str, Any]) -> Tuple[str, Optional[Dict[str, Any]], AsyncGenerator[str, None]]:
+    """Elige la fuente de la respuesta en streaming: predefinida, pool, caché, Gemini o una generación idéntica en curso.
+
+    Devuelve la fuente, la entrada de caché (si la hay) y el generador de tramas
+    (fragmentos agrupados por tamaño/tiempo). Lanza AdmissionRejected si hay que
+    llamar a Gemini y la cola de generación está llena.
+    """
+    category = prepared["category"]
+    if _is_predefined(category):
+        return "predefined", None, _single_chunk(CATEGORY_RESPONSES[category])
+    pooled = generation_profiles.pooled_response(category, request.query)
+    if pooled is not None:
+        return "response_pool", None, coalesce_frames(stream_cached(pooled))
+    cached = prepared["cached_response"]
+    if cached is not None:
+        # Respuesta cacheada: se reproduce en fragmentos como si viniera del modelo
+        return "response_cache", cached, coalesce_frames(stream_cached(cached["response"]))
+    def generate():
+        return generate_streaming_response(
+            request.query, prepared["wines"], prepared["user_context"], request.conversation_history, category,
+            trace=trace, user_id=request.user_id
+        )
+    key = _generation_key(request, prepared)
+    _check_generation_capacity(request, key)
+    if key is None:
+        # Lectura directa con cola acotada: si el cliente es lento se deja de leer del modelo
+        return "vertex_ai", None, coalesce_frames(generate())
+    # Las peticiones idénticas en curso se suscriben a la misma generación (búfer compartido)
+    chunks, coalesced = generation_flight.join(key, generate)
+    return ("coalesced" if coalesced else "vertex_ai"), None, coalesce_frames(chunks)
+
 @app.post("/query/stream")
 async def query_stream(request: QueryRequest):
     """Endpoint con streaming para compatibilidad"""
-    classification = await filter_and_classify_query(request.query)
-    category = classification.get("category", "OFF_TOPIC")
+    prepared = await prepare_query(request)
+    category = prepared["category"]
+    wines = prepared["wines"]
+
+    prompt_trace: Dict[str, Any] = {}
+    source, cached, chunks = stream_answer(request, prepared, prompt_trace)
 
     async def stream_generator():
-        full_response = ""
-        wines = []
+        timings = prepared["timings"]
+        parts: List[str] = []
+        stream_start = time.perf_counter()
+        async for frame in chunks:
+            if not parts:
+                timings["first_token_ms"] = round((time.perf_counter() - prepared["started_at"]) * 1000, 2)
+            yield frame
+            parts.append(frame)
+        timings["stream_ms"] = round((time.perf_counter() - stream_start) * 1000, 2)
+        full_response = "".join(parts)
+        if source == "vertex_ai":
+            _store_cached_response(request, prepared, full_response, prompt_trace)
         
-        # Para SECRET_MESSAGE y OFF_TOPIC, siempre generar dinámicamente
-        if category in CATEGORY_RESPONSES and category not in ["SECRET_MESSAGE", "OFF_TOPIC"]:
-            response_content = CATEGORY_RESPONSES[category]
-            yield response_content
-            full_response = response_content
-        else:
-            if classification.get("should_use_rag"):
-                wines, _ = await search_wines(request.query)
-            
-            user_context = await memory.get_user_context(request.user_id)
-            
-            # Añadir información del usuario al contexto para mensajes secretos
-            if category == "SECRET_MESSAGE" and request.user_name:
-                user_context['sender_name'] = request.user_name
-            
-            async for chunk in generate_streaming_response(request.query, wines, user_context, request.conversation_history, category):
-                yield chunk
-                full_response += chunk
-        
-        await memory.save_conversation(
-            user_id=request.user_id,
-            query=request.query,
-            response=full_response,
-            wines_recommended=wines,
-            user_name=request.user_name
+        timings.update({k: v for k, v in prompt_trace.items() if k.endswith("_ms")})
+        usage = summarize_usage(timings.get("usage"), prompt_trace.get("usage"))
+        await finish_turn(request, full_response, wines, prepared["history_offset"], category, usage, trace=timings)
+        timings["total_ms"] = round((time.perf_counter() - prepared["started_at"]) * 1000, 2)
+        _record_pipeline(timings["pipeline_mode"], timings, source == "vertex_ai")
+        record_timings("/query/stream", timings, source)
+        if prompt_trace:
+            logger.info(f"📏 Prompt de streaming ({category}): {prompt_trace['prompt']['tokens_est']} tokens estimados")
+    # Las etapas previas a la generación ya han terminado: se exponen como cabecera
+    headers = {"Server-Timing": _server_timing(prepared["timings"])}
+    if cached is not None:
+        headers["X-Response-Cache"] = "hit"
+    return StreamingResponse(stream_generator(), media_type="text/plain; charset=utf-8", headers=headers)
+
+def _sse(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+@app.post("/query/events")
+async def query_events(request: QueryRequest):
+    """Streaming con Server-Sent Events: progreso de cada etapa, tokens y métricas.
+
+    Eventos: accepted (inmediato), classification, rag, token (uno por fragmento),
+    stats (al final, con las duraciones por etapa) y error.
+    """
+    async def event_generator():
+        yield _sse("accepted", {"query": request.query, "session_id": request.session_id, "timestamp": datetime.now().isoformat()})
+
+        events: asyncio.Queue = asyncio.Queue()
+        prepare_task = asyncio.create_task(
+            prepare_query(request, emit=lambda name, data: events.put_nowait((name, data)))
         )
-    return StreamingResponse(stream_generator(), media_type="text/plain; charset=utf-8")
+        prepare_task.add_done_callback(lambda _: events.put_nowait(None))
+        try:
+            while (item := await events.get()) is not None:
+                yield _sse(*item)
+            prepared = prepare_task.result()
+        except asyncio.CancelledError:
+            raise
+        except AdmissionRejected as e:
+            yield _sse("error", {"detail": BUSY_MESSAGE, "retry_after": e.retry_after})
+            return
+        except Exception as e:
+            logger.error(f"❌ Error preparando la consulta SSE: {e}")
+            yield _sse("error", {"detail": "No he podido procesar tu consulta."})
+            return
+        finally:
+            # Si el cliente se desconecta, no seguir clasificando ni buscando
+            await _cancel(prepare_task)
+
+        timings = prepared["timings"]
+        prompt_trace: Dict[str, Any] = {}
+        try:
+            source, cached, chunks = stream_answer(request, prepared, prompt_trace)
+        except AdmissionRejected as e:
+            yield _sse("error", {"detail": BUSY_MESSAGE, "retry_after": e.retry_after})
+            return
+        parts: List[str] = []
+        generation_start = time.perf_counter()
+        async for frame in chunks:
+            if not parts:
+                timings["first_token_ms"] = round((time.perf_counter() - prepared["started_at"]) * 1000, 2)
+            parts.append(frame)
+            yield _sse("token", {"text": frame})
+        full_response = "".join(parts)
+        if source == "vertex_ai":
+            timings["generation_ms"] = round((time.perf_counter() - generation_start) * 1000, 2)
+            _store_cached_response(request, prepared, full_response, prompt_trace)
+        timings.update({k: v for k, v in prompt_trace.items() if k.endswith("_ms")})
+
+        timings["total_ms"] = round((time.perf_counter() - prepared["started_at"]) * 1000, 2)
+        _record_pipeline(timings["pipeline_mode"], timings, source == "vertex_ai")
+        degraded_stages = timings.pop("degraded", []) + prompt_trace.get("degraded", [])
+        usage = summarize_usage(timings.pop("usage", None), prompt_trace.get("usage"))
+        yield _sse("stats", {
+            "category": prepared["category"],
+            "response_source": source,
+            "stage_timings": timings,
+            "prompt_stats": prompt_trace.get("prompt"),
+            "response_cache": cached and {k: v for k, v in cached.items() if k != "response"},
+            "usage": usage,
+            "degraded": bool(degraded_stages),
+            "degraded_stages": degraded_stages
+        })
+        await finish_turn(request, full_response, prepared["wines"], prepared["history_offset"], prepared["category"], usage, trace=timings)
+        # El guardado ocurre después del evento stats: solo llega a las métricas
+        record_timings("/query/events", timings, source)
+
+    # Sin búfer intermedio en proxies para que cada evento llegue en cuanto se emite
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return StreamingResponse(event_generator(), media_type="text/event-stream", headers=headers)
+
+@app.get("/stats/performance")
+def performance_stats():
+    """Métricas internas de rendimiento del servicio."""
+    return {
+        "rag_client": rag_client.get_stats(),
+        "classifier": get_classifier_stats(),
+        "classification_cache": get_classification_cache_stats(),
+        "classification_batching": get_classification_batch_stats(),
+        "prompts": prompt_registry.get_stats(),
+        "prompt_sizes": prompt_builder.get_stats(),
+        "generation_profiles": generation_profiles.get_stats(),
+        "pipeline": get_pipeline_stats(),
+        "summarizer": summarizer.get_stats(),
+        "sessions": session_store.get_stats(),
+        "response_cache": response_cache.get_stats(),
+        "streaming": get_streaming_stats(),
+        "resilience": {
+            "deadlines": get_deadline_stats(),
+            "rag_breaker": rag_breaker.get_stats(),
+            "rag_faults": rag_faults.get_stats()
+        },
+        "hedging": get_hedging_stats(),
+        "coalescing": {
+            "enabled": COALESCE_REQUESTS,
+            "rag": _rag_flight.get_stats(),
+            "generation": generation_flight.get_stats()
+        },
+        "admission": {
+            "classification": classification_admission.get_stats(),
+            "generation": generation_scheduler.get_stats()
+        },
+        "startup": {**_startup_profile, "llm": get_llm_stats()}
+    }
+
+@app.get("/stats/usage")
+async def usage_stats(group_by: str = "category", days: int = Query(7, ge=1, le=366),
+                      limit: int = Query(50, ge=1, le=USAGE_STATS_MAX_LIMIT), x_admin_token: Optional[str] = Header(None)):
+    """Tokens y coste de Gemini agregados por categoría, usuario o día (últimos `days` días)."""
+    if ADMIN_TOKEN and x_admin_token != ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Token de administración no válido")
+    if group_by not in ("category", "user", "day"):
+        raise HTTPException(status_code=400, detail="group_by debe ser 'category', 'user' o 'day'")
+    # El desglose por usuario expone user_ids: sin ADMIN_TOKEN configurado no se sirve
+    if group_by == "user" and not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="El uso por usuario requiere ADMIN_TOKEN")
+    rows = await memory.get_usage(group_by, days, limit)
+    return {"group_by": group_by, "days": days, "rows": rows}
+
+# Estado de las colas de admisión en cada scrape
+register(Gauge(
+    "sumiller_admission_in_flight", "Llamadas a Gemini en curso por etapa.", ("stage",),
+    lambda: {(c.stage,): c.in_flight for c in (classification_admission, generation_scheduler)}
+))
+register(Gauge(
+    "sumiller_admission_queue_depth", "Llamadas a Gemini esperando hueco por etapa.", ("stage",),
+    lambda: {(c.stage,): c.queue_depth for c in (classification_admission, generation_scheduler)}
+))
+
+@app.get("/metrics")
+def prometheus_metrics():
+    """Histogramas de duración por etapa y contadores en formato de texto de Prometheus."""
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.post("/admin/prompts/reload")
+async def reload_prompts(x_admin_token: Optional[str] = Header(None)):
+    """Fuerza la recarga de las plantillas de prompts."""
+    if ADMIN_TOKEN and x_admin_token != ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Token de administración no válido")
+    changed = await prompt_registry.reload_async(force=True)
+    return {"reloaded": changed, "version": prompt_registry.version()}
+
+class FaultConfig(BaseModel):
+    latency_ms: float = 0.0
+    jitter_ms: float = 0.0
+    error_rate: float = 0.0
+
+@app.post("/admin/faults/rag")
+async def configure_rag_faults(config: FaultConfig, x_admin_token: Optional[str] = Header(None)):
+    """Configura la inyección de latencia/errores en la etapa RAG (todo a 0 la desactiva)."""
+    if not ENABLE_FAULT_INJECTION:
+        raise HTTPException(status_code=404, detail="Inyección de fallos desactivada")
+    # Sin token configurado no se permite: degradaría el servicio para todos los usuarios
+    if not ADMIN_TOKEN or x_admin_token != ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Token de administración no válido")
+    rag_faults.configure(config.latency_ms, config.jitter_ms, config.error_rate)
+    return rag_faults.get_stats()
 
 @app.get("/health")
 def health_check():
     return {"status": "healthy", "service": "Sumiller Service V2 (Vertex AI)", "timestamp": datetime.now().isoformat()}
 
+_startup_profile["import_ms"] = round((time.perf_counter() - _IMPORT_START) * 1000, 2)
@@ -3,25 +3,41 @@
 # Módulo de Memoria Integrada para Sumiller Service usando SQLite.
 import sqlite3
 import json
+import asyncio
 import logging
 import os
 from datetime import datetime
-from typing import Dict, List, Any
+from typing import Dict, List, Any, Optional, Tuple
 from pathlib import Path
 
+from migrate_db import SCHEMA_VERSION, get_schema_version, migrate_database
+
 logger = logging.getLogger(__name__)
 
+# Tablas de agregados de uso: usage_daily_by_category y usage_daily_by_user
+USAGE_ROLLUP_DIMENSIONS = ("category", "user")
+UNKNOWN_USAGE_KEY = "unknown"
+
 class SumillerMemory:
     """Gestión de memoria conversacional y preferencias del usuario."""
     
-    def __init__(self, db_path: str = None):
+    def __init__(self, db_path: str = None, initialize: bool = True):
         if db_path is None:
             # Crea el archivo de la BD en un subdirectorio para mantener el proyecto limpio.
             db_dir = Path("./database")
             db_dir.mkdir(exist_ok=True)
             db_path = db_dir / "sumiller.db"
         self.db_path = Path(db_path)
+        # El servicio lo deja para el arranque (ensure_schema) en lugar de hacerlo al importar
+        if initialize:
+            self._init_database()
+
+    def ensure_schema(self) -> bool:
+        """Crea las tablas y migra solo si la versión del esquema ha cambiado; devuelve si hubo cambios."""
+        if get_schema_version(self.db_path) >= SCHEMA_VERSION:
+            return False
         self._init_database()
+        return migrate_database(self.db_path)
     
     def _init_database(self):
         """Inicializa la base de datos SQLite y sus tablas si no existen."""
@@ -37,7 +53,13 @@ class SumillerMemory:
                     response TEXT NOT NULL,
                     wines_recommended TEXT,
                     timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    session_id TEXT
+                    session_id TEXT,
+                    category TEXT,
+                    llm_calls REAL DEFAULT 0,
+                    prompt_tokens INTEGER DEFAULT 0,
+                    output_tokens INTEGER DEFAULT 0,
+                    cost_usd REAL DEFAULT 0,
+                    usage_detail TEXT
                 )
             """)
             # CORRECCIÓN: Añadida la columna 'total_interactions' a la tabla 'user_preferences'.
@@ -63,19 +85,53 @@ class SumillerMemory:
                     timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
                 )
             """)
+            # Reconstrucción del estado de sesión desde SQLite
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_conversations_session ON conversations(session_id)")
+            # Resumen acumulado de cada sesión: cubre los primeros `messages_summarized`
+            # mensajes del historial; los posteriores se envían literalmente
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS session_summaries (
+                    session_id TEXT PRIMARY KEY,
+                    user_id TEXT,
+                    summary TEXT NOT NULL,
+                    messages_summarized INTEGER NOT NULL DEFAULT 0,
+                    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            # Agregados diarios de uso de Gemini, actualizados en la misma transacción
+            # que cada conversación (sin recorrer la tabla conversations al consultar)
+            for dimension in USAGE_ROLLUP_DIMENSIONS:
+                cursor.execute(f"""
+                    CREATE TABLE IF NOT EXISTS usage_daily_by_{dimension} (
+                        day TEXT NOT NULL,
+                        {dimension} TEXT NOT NULL,
+                        requests INTEGER NOT NULL DEFAULT 0,
+                        llm_calls REAL NOT NULL DEFAULT 0,
+                        prompt_tokens INTEGER NOT NULL DEFAULT 0,
+                        output_tokens INTEGER NOT NULL DEFAULT 0,
+                        cost_usd REAL NOT NULL DEFAULT 0,
+                        PRIMARY KEY (day, {dimension})
+                    )
+                """)
             conn.commit()
             logger.info(f"✅ Base de datos de memoria inicializada en: {self.db_path}")
 
-    async def save_conversation(self, user_id: str, query: str, response: str, wines_recommended: List[Dict] = None, session_id: str = None, user_name: str = None):
-        """Guarda una interacción en la memoria."""
+    async def save_conversation(self, user_id: str, query: str, response: str, wines_recommended: List[Dict] = None, session_id: str = None, user_name: str = None,
+                                category: str = None, usage: Dict[str, Any] = None):
+        """Guarda una interacción en la memoria, con el uso de Gemini del turno (summarize_usage)."""
         try:
             wines_json = json.dumps(wines_recommended or [])
+            usage = usage or {}
             with sqlite3.connect(self.db_path) as conn:
                 conn.execute("""
                     INSERT INTO conversations 
-                    (user_id, user_name, query, response, wines_recommended, session_id) 
-                    VALUES (?, ?, ?, ?, ?, ?)
-                """, (user_id, user_name, query, response, wines_json, session_id))
+                    (user_id, user_name, query, response, wines_recommended, session_id,
+                     category, llm_calls, prompt_tokens, output_tokens, cost_usd, usage_detail) 
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """, (user_id, user_name, query, response, wines_json, session_id,
+                      category, usage.get("llm_calls", 0), usage.get("prompt_tokens", 0), usage.get("output_tokens", 0),
+                      usage.get("cost_usd", 0.0), json.dumps(usage.get("by_stage", {}))))
+                self._add_usage_sync(conn, user_id, category, usage, requests=1)
                 
                 # Este código ahora funcionará porque la columna existe.
                 conn.execute("""
@@ -90,8 +146,71 @@ class SumillerMemory:
         except Exception as e:
             logger.error(f"Error al guardar la conversación: {e}")
 
+    def _add_usage_sync(self, conn: sqlite3.Connection, user_id: Optional[str], category: Optional[str],
+                        usage: Dict[str, Any], requests: int):
+        """Suma el uso a los agregados del día (UTC, como CURRENT_TIMESTAMP)."""
+        values = (requests, usage.get("llm_calls", 0), usage.get("prompt_tokens", 0),
+                  usage.get("output_tokens", 0), usage.get("cost_usd", 0.0))
+        keys = {"category": category or UNKNOWN_USAGE_KEY, "user": user_id or UNKNOWN_USAGE_KEY}
+        for dimension in USAGE_ROLLUP_DIMENSIONS:
+            conn.execute(f"""
+                INSERT INTO usage_daily_by_{dimension}
+                (day, {dimension}, requests, llm_calls, prompt_tokens, output_tokens, cost_usd)
+                VALUES (date('now'), ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(day, {dimension}) DO UPDATE SET
+                    requests = requests + excluded.requests,
+                    llm_calls = llm_calls + excluded.llm_calls,
+                    prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+                    output_tokens = output_tokens + excluded.output_tokens,
+                    cost_usd = cost_usd + excluded.cost_usd
+            """, (keys[dimension], *values))
+
+    async def record_usage(self, user_id: Optional[str], category: str, usage: Dict[str, Any]):
+        """Anota en los agregados el uso de una llamada que no es un turno (p. ej. resúmenes)."""
+        await asyncio.to_thread(self._record_usage_sync, user_id, category, usage)
+
+    def _record_usage_sync(self, user_id: Optional[str], category: str, usage: Dict[str, Any]):
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                self._add_usage_sync(conn, user_id, category, usage, requests=0)
+                conn.commit()
+        except Exception as e:
+            logger.error(f"Error al registrar el uso de Gemini: {e}")
+
+    async def get_usage(self, group_by: str = "category", days: int = 7, limit: int = 50) -> List[Dict[str, Any]]:
+        """Uso agregado de los últimos `days` días por categoría, usuario o día."""
+        return await asyncio.to_thread(self._get_usage_sync, group_by, days, limit)
+
+    def _get_usage_sync(self, group_by: str, days: int, limit: int) -> List[Dict[str, Any]]:
+        if group_by not in ("category", "user", "day"):
+            raise ValueError("group_by debe ser 'category', 'user' o 'day'.")
+        # Los totales por día salen de la tabla por categoría (cada petición está en ambas)
+        table = "usage_daily_by_user" if group_by == "user" else "usage_daily_by_category"
+        order = "day" if group_by == "day" else "cost_usd DESC, prompt_tokens + output_tokens DESC"
+        with sqlite3.connect(self.db_path) as conn:
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute(f"""
+                SELECT {group_by},
+                       SUM(requests) AS requests, SUM(llm_calls) AS llm_calls,
+                       SUM(prompt_tokens) AS prompt_tokens, SUM(output_tokens) AS output_tokens,
+                       SUM(cost_usd) AS cost_usd
+                FROM {table}
+                WHERE day >= date('now', ?)
+                GROUP BY {group_by}
+                ORDER BY {order}
+                LIMIT ?
+            """, (f"-{max(days, 1) - 1} days", limit)).fetchall()
+        return [
+            {**dict(row), "llm_calls": round(row["llm_calls"], 3), "cost_usd": round(row["cost_usd"], 6)}
+            for row in rows
+        ]
+
     async def get_user_context(self, user_id: str, limit: int = 5) -> Dict[str, Any]:
         """Obtiene el contexto completo de un usuario."""
+        # La lectura de SQLite es bloqueante: se ejecuta en un hilo para no frenar el event loop
+        return await asyncio.to_thread(self._get_user_context_sync, user_id, limit)
+
+    def _get_user_context_sync(self, user_id: str, limit: int) -> Dict[str, Any]:
         try:
             with sqlite3.connect(self.db_path) as conn:
                 conn.row_factory = sqlite3.Row
@@ -137,6 +256,66 @@ class SumillerMemory:
                 "top_rated_wines": []
             }
             
+    async def get_session_turns(self, session_id: str, user_id: str = None, limit: int = 8) -> Tuple[List[Dict[str, Any]], int]:
+        """Últimos turnos de una sesión en orden cronológico y número total de turnos."""
+        return await asyncio.to_thread(self._get_session_turns_sync, session_id, user_id, limit)
+
+    def _get_session_turns_sync(self, session_id: str, user_id: str, limit: int) -> Tuple[List[Dict[str, Any]], int]:
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                conn.row_factory = sqlite3.Row
+                # Se filtra también por usuario: un session_id ajeno no da acceso a la conversación
+                total = conn.execute("""
+                    SELECT COUNT(*) FROM conversations
+                    WHERE session_id = ? AND user_id IS ?
+                """, (session_id, user_id)).fetchone()[0]
+                rows = conn.execute("""
+                    SELECT query, response
+                    FROM conversations
+                    WHERE session_id = ? AND user_id IS ?
+                    ORDER BY id DESC
+                    LIMIT ?
+                """, (session_id, user_id, limit)).fetchall()
+                return [dict(row) for row in reversed(rows)], total
+        except Exception as e:
+            logger.error(f"Error al obtener los turnos de la sesión: {e}")
+            return [], 0
+
+    async def get_session_summary(self, session_id: str, user_id: str = None) -> Optional[Dict[str, Any]]:
+        """Obtiene el resumen acumulado de una sesión, o None si aún no existe."""
+        return await asyncio.to_thread(self._get_session_summary_sync, session_id, user_id)
+
+    def _get_session_summary_sync(self, session_id: str, user_id: str) -> Optional[Dict[str, Any]]:
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                conn.row_factory = sqlite3.Row
+                row = conn.execute("""
+                    SELECT summary, messages_summarized, updated_at
+                    FROM session_summaries
+                    WHERE session_id = ? AND user_id IS ?
+                """, (session_id, user_id)).fetchone()
+                return dict(row) if row else None
+        except Exception as e:
+            logger.error(f"Error al obtener el resumen de la sesión: {e}")
+            return None
+
+    async def save_session_summary(self, session_id: str, user_id: str, summary: str, messages_summarized: int):
+        """Guarda (o reemplaza) el resumen acumulado de una sesión."""
+        await asyncio.to_thread(self._save_session_summary_sync, session_id, user_id, summary, messages_summarized)
+
+    def _save_session_summary_sync(self, session_id: str, user_id: str, summary: str, messages_summarized: int):
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                conn.execute("""
+                    INSERT OR REPLACE INTO session_summaries
+                    (session_id, user_id, summary, messages_summarized, updated_at)
+                    VALUES (?, ?, ?, ?, ?)
+                """, (session_id, user_id, summary, messages_summarized, datetime.now()))
+                conn.commit()
+            logger.info(f"🧾 Resumen de la sesión {session_id} actualizado ({messages_summarized} mensajes)")
+        except Exception as e:
+            logger.error(f"Error al guardar el resumen de la sesión: {e}")
+
     async def update_preferences(self, user_id: str, preferences: Dict[str, Any], user_name: str = None):
         """Crea o actualiza las preferencias de un usuario."""
         try:
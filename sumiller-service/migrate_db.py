@@ -1,7 +1,10 @@
 #!/usr/bin/env python3
 """
 Script de migración para actualizar la base de datos de Sumiller
-Añade las columnas faltantes: user_name y total_interactions
+Añade las columnas faltantes: user_name, total_interactions y las de uso de Gemini
+
+La versión del esquema se guarda en PRAGMA user_version: al arrancar solo se
+migra si la base de datos está en una versión anterior a SCHEMA_VERSION.
 """
 
 import sqlite3
@@ -11,84 +14,80 @@ from pathlib import Path
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def migrate_database():
-    """Migra la base de datos añadiendo las columnas faltantes."""
-    db_dir = Path("./database")
-    db_dir.mkdir(exist_ok=True)
-    db_path = db_dir / "sumiller.db"
-    
+# Subir al añadir una migración a MIGRATIONS o una tabla a SumillerMemory._init_database
+SCHEMA_VERSION = 2
+DEFAULT_DB_PATH = Path("./database") / "sumiller.db"
+
+# (versión, tabla, columna, definición)
+MIGRATIONS = [
+    (1, "conversations", "user_name", "TEXT"),
+    (1, "user_preferences", "total_interactions", "INTEGER DEFAULT 0"),
+    (1, "user_preferences", "user_name", "TEXT"),
+    (1, "wine_ratings", "user_name", "TEXT"),
+    (1, "user_preferences", "favorite_wines", "TEXT"),
+    (1, "user_preferences", "last_session_id", "TEXT"),
+    # Uso de Gemini (tokens y coste) en conversations
+    (2, "conversations", "category", "TEXT"),
+    (2, "conversations", "llm_calls", "REAL DEFAULT 0"),
+    (2, "conversations", "prompt_tokens", "INTEGER DEFAULT 0"),
+    (2, "conversations", "output_tokens", "INTEGER DEFAULT 0"),
+    (2, "conversations", "cost_usd", "REAL DEFAULT 0"),
+    (2, "conversations", "usage_detail", "TEXT"),
+]
+
+
+def get_schema_version(db_path=DEFAULT_DB_PATH) -> int:
+    """Versión del esquema de la base de datos (0 si no existe o nunca se migró)."""
+    if not Path(db_path).exists():
+        return 0
+    with sqlite3.connect(db_path) as conn:
+        return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def _add_column(cursor: sqlite3.Cursor, table: str, column: str, definition: str):
+    try:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+        logger.info(f"✅ Columna '{column}' añadida a la tabla '{table}'")
+    except sqlite3.OperationalError as e:
+        if "duplicate column name" in str(e):
+            logger.info(f"ℹ️ Columna '{column}' ya existe en '{table}'")
+        else:
+            raise
+
+
+def migrate_database(db_path=DEFAULT_DB_PATH) -> bool:
+    """Migra la base de datos añadiendo las columnas faltantes.
+
+    Devuelve False si el esquema ya estaba en SCHEMA_VERSION. Las tablas que aún
+    no existen se omiten: SumillerMemory las crea ya con todas las columnas.
+    """
+    db_path = Path(db_path)
+    db_path.parent.mkdir(exist_ok=True)
+
     try:
         with sqlite3.connect(db_path) as conn:
             cursor = conn.cursor()
-            
-            # Verificar si las columnas existen antes de añadirlas
-            
-            # 1. Añadir user_name a conversations si no existe
-            try:
-                cursor.execute("ALTER TABLE conversations ADD COLUMN user_name TEXT")
-                logger.info("✅ Columna 'user_name' añadida a la tabla 'conversations'")
-            except sqlite3.OperationalError as e:
-                if "duplicate column name" in str(e):
-                    logger.info("ℹ️ Columna 'user_name' ya existe en 'conversations'")
-                else:
-                    raise
-            
-            # 2. Añadir total_interactions a user_preferences si no existe
-            try:
-                cursor.execute("ALTER TABLE user_preferences ADD COLUMN total_interactions INTEGER DEFAULT 0")
-                logger.info("✅ Columna 'total_interactions' añadida a la tabla 'user_preferences'")
-            except sqlite3.OperationalError as e:
-                if "duplicate column name" in str(e):
-                    logger.info("ℹ️ Columna 'total_interactions' ya existe en 'user_preferences'")
-                else:
-                    raise
-            
-            # 3. Añadir user_name a user_preferences si no existe
-            try:
-                cursor.execute("ALTER TABLE user_preferences ADD COLUMN user_name TEXT")
-                logger.info("✅ Columna 'user_name' añadida a la tabla 'user_preferences'")
-            except sqlite3.OperationalError as e:
-                if "duplicate column name" in str(e):
-                    logger.info("ℹ️ Columna 'user_name' ya existe en 'user_preferences'")
-                else:
-                    raise
-            
-            # 4. Añadir user_name a wine_ratings si no existe
-            try:
-                cursor.execute("ALTER TABLE wine_ratings ADD COLUMN user_name TEXT")
-                logger.info("✅ Columna 'user_name' añadida a la tabla 'wine_ratings'")
-            except sqlite3.OperationalError as e:
-                if "duplicate column name" in str(e):
-                    logger.info("ℹ️ Columna 'user_name' ya existe en 'wine_ratings'")
-                else:
-                    raise
-            
-            # 5. Añadir favorite_wines a user_preferences si no existe
-            try:
-                cursor.execute("ALTER TABLE user_preferences ADD COLUMN favorite_wines TEXT")
-                logger.info("✅ Columna 'favorite_wines' añadida a la tabla 'user_preferences'")
-            except sqlite3.OperationalError as e:
-                if "duplicate column name" in str(e):
-                    logger.info("ℹ️ Columna 'favorite_wines' ya existe en 'user_preferences'")
-                else:
-                    raise
-            
-            # 6. Añadir last_session_id a user_preferences si no existe
-            try:
-                cursor.execute("ALTER TABLE user_preferences ADD COLUMN last_session_id TEXT")
-                logger.info("✅ Columna 'last_session_id' añadida a la tabla 'user_preferences'")
-            except sqlite3.OperationalError as e:
-                if "duplicate column name" in str(e):
-                    logger.info("ℹ️ Columna 'last_session_id' ya existe en 'user_preferences'")
-                else:
-                    raise
-            
+            version = cursor.execute("PRAGMA user_version").fetchone()[0]
+            if version >= SCHEMA_VERSION:
+                logger.info(f"ℹ️ Esquema de la base de datos al día (versión {version})")
+                return False
+
+            tables = {row[0] for row in cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+            columns = {
+                table: {row[1] for row in cursor.execute(f"PRAGMA table_info({table})")} for table in tables
+            }
+            for migration_version, table, column, definition in MIGRATIONS:
+                if migration_version > version and table in tables and column not in columns[table]:
+                    _add_column(cursor, table, column, definition)
+
+            cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
             conn.commit()
-            logger.info("🎉 Migración de base de datos completada exitosamente")
-            
+            logger.info(f"🎉 Migración de base de datos completada exitosamente (versión {version} → {SCHEMA_VERSION})")
+            return True
+
     except Exception as e:
         logger.error(f"❌ Error durante la migración: {e}")
         raise
 
 if __name__ == "__main__":
-    migrate_database() 
\ No newline at end of file
+    migrate_database()
@@ -0,0 +1,233 @@
+# sumiller-service/prompt_builder.py
+
+# Composición de prompts con presupuesto de tokens por categoría.
+import os
+import json
+import logging
+from typing import Any, Dict, List, Optional
+
+from prompt_registry import prompt_registry
+
+logger = logging.getLogger(__name__)
+
+# Presupuestos (tokens estimados) por sección y categoría. Se pueden sobrescribir
+# con PROMPT_TOKEN_BUDGETS='{"WINE_SEARCH": {"wines": 900}}'
+DEFAULT_TOKEN_BUDGETS: Dict[str, Dict[str, int]] = {
+    "WINE_SEARCH": {"wines": 700, "history": 400, "context": 200},
+    "WINE_THEORY": {"wines": 800, "history": 300, "context": 80},
+    "OFF_TOPIC": {"wines": 0, "history": 200, "context": 40},
+    "SECRET_MESSAGE": {"wines": 0, "history": 150, "context": 40},
+    "DEFAULT": {"wines": 600, "history": 300, "context": 150},
+}
+
+# Campos de cada vino que necesita la respuesta, en orden de importancia
+WINE_FIELDS = ("name", "type", "winery", "region", "grape", "crianza", "price", "rating", "pairing", "description")
+KNOWLEDGE_FIELDS = ("category", "section_title", "subsection_title", "keywords")
+HISTORY_MAX_MESSAGES = int(os.getenv("PROMPT_HISTORY_MAX_MESSAGES", "8"))
+HISTORY_MESSAGE_MAX_CHARS = int(os.getenv("PROMPT_HISTORY_MESSAGE_MAX_CHARS", "600"))
+
+
+def estimate_tokens(text: str) -> int:
+    # Aproximadamente 4 caracteres por token (misma estimación que el RAG Service)
+    return (len(text) + 3) // 4
+
+
+def _load_budgets() -> Dict[str, Dict[str, int]]:
+    budgets = {category: dict(sections) for category, sections in DEFAULT_TOKEN_BUDGETS.items()}
+    raw = os.getenv("PROMPT_TOKEN_BUDGETS")
+    if raw:
+        try:
+            for category, sections in json.loads(raw).items():
+                budgets.setdefault(category, dict(budgets["DEFAULT"])).update(sections)
+        except (ValueError, AttributeError) as e:
+            logger.error(f"❌ PROMPT_TOKEN_BUDGETS no es un JSON válido, usando valores por defecto: {e}")
+    return budgets
+
+
+def _truncate(text: str, max_chars: int) -> str:
+    text = " ".join(str(text).split())
+    return text if len(text) <= max_chars else text[:max_chars - 1].rstrip() + "…"
+
+
+def _compact(value: Any) -> str:
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+
+class PromptBuilder:
+    """Único punto de composición de prompts para streaming y no streaming.
+
+    Proyecta los vinos a los campos útiles, recorta historial y contexto al
+    presupuesto de la categoría y serializa en formato compacto. Cada llamada
+    devuelve el tamaño del prompt para poder seguir la reducción.
+    """
+
+    def __init__(self, budgets: Optional[Dict[str, Dict[str, int]]] = None):
+        self.budgets = budgets or _load_budgets()
+        self._stats: Dict[str, Dict[str, float]] = {}
+
+    def budget(self, category: Optional[str]) -> Dict[str, int]:
+        return self.budgets.get(category or "", self.budgets["DEFAULT"])
+
+    # --- Secciones ---
+    def render_wines(self, wines: List[Dict], budget: int) -> str:
+        if not wines or budget <= 0:
+            return "No se encontraron vinos específicos."
+        lines: List[str] = []
+        used = 0
+        # El RAG ya devuelve los resultados ordenados por relevancia
+        for item in wines:
+            if item.get("type") == "knowledge":
+                fields = {k: item[k] for k in KNOWLEDGE_FIELDS if item.get(k)}
+                line = "- Conocimiento: " + _compact(fields)
+            else:
+                parts = []
+                for field in WINE_FIELDS:
+                    value = item.get(field)
+                    if value in (None, ""):
+                        continue
+                    if field == "description":
+                        value = _truncate(value, 200)
+                    parts.append(f"{field}={value}")
+                line = "- " + "; ".join(parts)
+            cost = estimate_tokens(line)
+            if used + cost > budget and lines:
+                break
+            lines.append(line)
+            used += cost
+        return "Vinos encontrados:\n" + "\n".join(lines)
+
+    def render_history(self, conversation_history: List[Any], budget: int,
+                       summary: Optional[Dict[str, Any]] = None) -> str:
+        if budget <= 0:
+            return ""
+        summary_text = ""
+        # El resumen de la sesión sustituye a los mensajes que ya cubre
+        if summary and summary.get("summary") and summary.get("messages_summarized", 0) <= len(conversation_history):
+            conversation_history = conversation_history[summary["messages_summarized"]:]
+            summary_text = "Resumen de la conversación anterior: " + _truncate(summary["summary"], budget * 2)
+            budget -= estimate_tokens(summary_text)
+        selected: List[str] = []
+        used = 0
+        # Los mensajes más recientes son los más relevantes: se recorren del final al principio
+        for message in reversed(conversation_history[-HISTORY_MAX_MESSAGES:]):
+            if isinstance(message, dict):
+                role, content = message.get("role", ""), message.get("content", "")
+            else:
+                role, content = message.role, message.content
+            line = f"{role}: {_truncate(content, HISTORY_MESSAGE_MAX_CHARS)}"
+            cost = estimate_tokens(line)
+            if used + cost > budget:
+                break
+            selected.append(line)
+            used += cost
+        return "\n".join(([summary_text] if summary_text else []) + list(reversed(selected)))
+
+    def render_context(self, context: Dict[str, Any], budget: int) -> str:
+        if budget <= 0 or not context:
+            return "{}"
+        # De las conversaciones pasadas solo interesan las consultas y los vinos citados,
+        # no las respuestas completas
+        recent = []
+        for conversation in context.get("recent_conversations", []):
+            wines = conversation.get("wines_recommended")
+            if isinstance(wines, str):
+                try:
+                    wines = json.loads(wines)
+                except ValueError:
+                    wines = []
+            names = [w.get("name") for w in wines or [] if isinstance(w, dict) and w.get("name")]
+            entry = {"q": _truncate(conversation.get("query", ""), 120)}
+            if names:
+                entry["vinos"] = names[:3]
+            recent.append(entry)
+
+        projected: Dict[str, Any] = {}
+        for key in ("sender_name", "preferences", "favorite_wines", "top_rated_wines"):
+            if context.get(key):
+                projected[key] = context[key]
+        text = _compact(projected)
+        for entry in recent:
+            candidate = {**projected, "recent_queries": projected.get("recent_queries", []) + [entry]}
+            candidate_text = _compact(candidate)
+            if estimate_tokens(candidate_text) > budget:
+                break
+            projected, text = candidate, candidate_text
+        if estimate_tokens(text) > budget:
+            text = _truncate(text, budget * 4)
+        return text
+
+    # --- Prompts completos ---
+    def build_generation(self, query: str, wines: List[Dict], context: Dict, conversation_history: List[Any],
+                         category: Optional[str] = None, trace: Optional[Dict[str, Any]] = None) -> str:
+        """Compone el prompt de generación a partir de las plantillas precargadas."""
+        budget = self.budget(category)
+        # Usar prompt específico según la categoría
+        if category == "SECRET_MESSAGE":
+            base_prompt = prompt_registry.text("secret_message_generation.txt")
+        elif category == "OFF_TOPIC":
+            base_prompt = prompt_registry.text("off_topic_response.txt")
+        else:
+            base_prompt = prompt_registry.text("sumiller_generacion.txt")
+
+        sections = {
+            "user_context": self.render_context(context, budget["context"]),
+            "history": self.render_history(conversation_history, budget["history"], context.get("session_summary")),
+        }
+
+        # Para mensajes secretos, incluir información específica
+        if category == "SECRET_MESSAGE":
+            # El destinatario SIEMPRE es Vicky, el remitente es quien hace la consulta
+            sender_name = context.get('sender_name', 'Tu sumiller')
+            sender_first_name = sender_name.split()[0] if sender_name else "Tu sumiller"
+            prompt = prompt_registry.render(
+                "layout_mensaje_secreto.txt",
+                base_prompt=base_prompt, sender_first_name=sender_first_name, query=query, **sections
+            )
+        else:
+            sections["wines"] = self.render_wines(wines, budget["wines"])
+            prompt = prompt_registry.render("layout_generacion.txt", base_prompt=base_prompt, query=query, **sections)
+
+        self._record(category, prompt, sections, trace)
+        return prompt
+
+    def build_merged(self, query: str, context: Dict, conversation_history: List[Any],
+                     trace: Optional[Dict[str, Any]] = None) -> str:
+        """Prompt del modo unificado (clasificación + respuesta)."""
+        budget = self.budget("DEFAULT")
+        sections = {
+            "user_context": self.render_context(context, budget["context"]),
+            "history": self.render_history(conversation_history, budget["history"], context.get("session_summary")),
+        }
+        prompt = prompt_registry.render(
+            "sumiller_unificado.txt",
+            generation_prompt=prompt_registry.text("sumiller_generacion.txt"), query=query, **sections
+        )
+        self._record("MERGED", prompt, sections, trace)
+        return prompt
+
+    # --- Métricas ---
+    def _record(self, category: Optional[str], prompt: str, sections: Dict[str, str], trace: Optional[Dict[str, Any]]):
+        tokens = estimate_tokens(prompt)
+        stats = self._stats.setdefault(category or "UNKNOWN", {"prompts": 0, "tokens_total": 0, "tokens_max": 0})
+        stats["prompts"] += 1
+        stats["tokens_total"] += tokens
+        stats["tokens_max"] = max(stats["tokens_max"], tokens)
+        if trace is not None:
+            trace["prompt"] = {
+                "chars": len(prompt),
+                "tokens_est": tokens,
+                "sections_tokens_est": {name: estimate_tokens(text) for name, text in sections.items()},
+            }
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            category: {
+                "prompts": stats["prompts"],
+                "avg_tokens_est": round(stats["tokens_total"] / stats["prompts"], 1),
+                "max_tokens_est": stats["tokens_max"],
+            }
+            for category, stats in self._stats.items()
+        }
+
+
+prompt_builder = PromptBuilder()
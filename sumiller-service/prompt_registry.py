@@ -0,0 +1,199 @@
+# sumiller-service/prompt_registry.py
+
+# Registro de prompts: se cargan una vez y se sirven desde memoria.
+import os
+import time
+import asyncio
+import hashlib
+import logging
+from string import Template
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+PROMPTS_DIR = Path(__file__).parent / "prompts"
+PROMPT_RELOAD_INTERVAL = float(os.getenv("PROMPT_RELOAD_INTERVAL", "5"))
+
+
+class PromptTemplate:
+    """Plantilla de prompt precompilada (string.Template con marcadores $nombre)."""
+
+    def __init__(self, name: str, text: str, mtime: float):
+        self.name = name
+        self.text = text
+        self.mtime = mtime
+        self.version = hashlib.sha256(text.encode("utf-8")).hexdigest()[:12]
+        self.compiled = Template(text)
+        self.load_ms = 0.0
+
+    def render(self, **values: Any) -> str:
+        return self.compiled.safe_substitute(**values)
+
+
+class PromptRegistry:
+    """Carga todas las plantillas de `prompts/` al arrancar y las recarga por mtime.
+
+    Las peticiones solo leen del diccionario en memoria. La comprobación de mtime
+    la hace una tarea en segundo plano (o una recarga explícita desde admin), de
+    modo que ningún camino de petición toca el sistema de ficheros.
+    """
+
+    def __init__(self, directory: Path = PROMPTS_DIR):
+        self.directory = directory
+        self._templates: Dict[str, PromptTemplate] = {}
+        self._listeners: List[Callable[[List[str]], None]] = []
+        self._watcher: Optional[asyncio.Task] = None
+        self._stats = {
+            "loads": 0,
+            "reloads": 0,
+            "load_ms_total": 0.0,
+            "renders": 0,
+            "render_ms_total": 0.0,
+            "misses": 0,
+        }
+        self.reload()
+
+    def _load_file(self, path: Path) -> PromptTemplate:
+        start = time.perf_counter()
+        with open(path, 'r', encoding='utf-8') as f:
+            text = f.read()
+        template = PromptTemplate(path.name, text, path.stat().st_mtime)
+        template.load_ms = (time.perf_counter() - start) * 1000
+        return template
+
+    def _scan(self, mtimes: Dict[str, float], force: bool = False) -> Optional[Tuple[Dict[str, PromptTemplate], Set[str]]]:
+        """Lee del disco las plantillas nuevas o con otro mtime. Solo E/S: se puede llamar desde un hilo.
+
+        Devuelve (plantillas leídas, nombres presentes en el directorio), o None si no se pudo listar.
+        """
+        try:
+            paths = sorted(self.directory.glob("*.txt"))
+        except OSError as e:
+            logger.error(f"❌ No se pudo listar el directorio de prompts {self.directory}: {e}")
+            return None
+
+        loaded: Dict[str, PromptTemplate] = {}
+        seen: Set[str] = set()
+        for path in paths:
+            seen.add(path.name)
+            try:
+                if not force and mtimes.get(path.name) == path.stat().st_mtime:
+                    continue
+                loaded[path.name] = self._load_file(path)
+            except OSError as e:
+                logger.error(f"❌ Error cargando el prompt {path}: {e}")
+        return loaded, seen
+
+    def _apply(self, scanned: Optional[Tuple[Dict[str, PromptTemplate], Set[str]]]) -> List[str]:
+        """Sustituye el diccionario de plantillas y avisa a los listeners (en el hilo del event loop)."""
+        if scanned is None:
+            return []
+        loaded, seen = scanned
+        changed = []
+        templates = {name: t for name, t in self._templates.items() if name in seen}
+        for name, template in loaded.items():
+            self._stats["loads"] += 1
+            self._stats["load_ms_total"] += template.load_ms
+            current = templates.get(name)
+            if current is None or current.version != template.version:
+                changed.append(name)
+            templates[name] = template
+        changed.extend(name for name in self._templates if name not in seen)
+        # Un único cambio de referencia: las peticiones nunca ven un diccionario a medias
+        self._templates = templates
+
+        if changed:
+            self._stats["reloads"] += 1
+            logger.info(f"📝 Prompts cargados/recargados: {', '.join(changed)}")
+            for listener in self._listeners:
+                try:
+                    listener(changed)
+                except Exception as e:
+                    logger.error(f"Error notificando la recarga de prompts: {e}")
+        return changed
+
+    def _mtimes(self) -> Dict[str, float]:
+        return {name: t.mtime for name, t in self._templates.items()}
+
+    def reload(self, force: bool = False) -> List[str]:
+        """Recarga las plantillas nuevas o cuyo mtime ha cambiado. Devuelve las recargadas.
+
+        Versión síncrona para el arranque; con el event loop en marcha usar `reload_async`.
+        """
+        return self._apply(self._scan(self._mtimes(), force))
+
+    async def reload_async(self, force: bool = False) -> List[str]:
+        """Como `reload`, pero los stat() y lecturas se hacen en un hilo y el cambio en el event loop."""
+        scanned = await asyncio.to_thread(self._scan, self._mtimes(), force)
+        return self._apply(scanned)
+
+    def on_reload(self, listener: Callable[[List[str]], None]):
+        """Registra una función a la que se avisa con los nombres recargados."""
+        self._listeners.append(listener)
+
+    def get(self, name: str) -> Optional[PromptTemplate]:
+        template = self._templates.get(name)
+        if template is None:
+            self._stats["misses"] += 1
+            logger.error(f"FATAL: Prompt no registrado: {name}")
+        return template
+
+    def text(self, name: str) -> str:
+        template = self.get(name)
+        return template.text if template else ""
+
+    def version(self, name: Optional[str] = None) -> str:
+        """Versión de una plantilla o, sin nombre, del conjunto completo."""
+        if name is not None:
+            template = self._templates.get(name)
+            return template.version if template else ""
+        digest = hashlib.sha256()
+        for key in sorted(self._templates):
+            digest.update(f"{key}:{self._templates[key].version};".encode("utf-8"))
+        return digest.hexdigest()[:12]
+
+    def render(self, name: str, **values: Any) -> str:
+        template = self.get(name)
+        if template is None:
+            return ""
+        start = time.perf_counter()
+        rendered = template.render(**values)
+        self._stats["renders"] += 1
+        self._stats["render_ms_total"] += (time.perf_counter() - start) * 1000
+        return rendered
+
+    async def _watch(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            await self.reload_async()
+
+    def start_watcher(self, interval: float = PROMPT_RELOAD_INTERVAL):
+        if self._watcher is None and interval > 0:
+            self._watcher = asyncio.create_task(self._watch(interval))
+
+    async def stop_watcher(self):
+        if self._watcher is not None:
+            self._watcher.cancel()
+            try:
+                await self._watcher
+            except asyncio.CancelledError:
+                pass
+            self._watcher = None
+
+    def get_stats(self) -> Dict[str, Any]:
+        renders = self._stats["renders"]
+        loads = self._stats["loads"]
+        return {
+            "templates": {name: t.version for name, t in sorted(self._templates.items())},
+            "version": self.version(),
+            "loads": loads,
+            "reloads": self._stats["reloads"],
+            "avg_load_ms": round(self._stats["load_ms_total"] / loads, 3) if loads else 0.0,
+            "renders": renders,
+            "avg_render_ms": round(self._stats["render_ms_total"] / renders, 4) if renders else 0.0,
+            "misses": self._stats["misses"],
+        }
+
+
+prompt_registry = PromptRegistry()
@@ -1,31 +1,46 @@
 # sumiller-service/query_filter.py
 import os
 import json
+import time
+import asyncio
 import logging
-from typing import Dict, Any, Tuple
-from pathlib import Path
-import vertexai
-from vertexai.generative_models import GenerativeModel
+from collections import deque
+from typing import Dict, Any, Tuple, Optional, List
+
+from text_similarity import normalize_text, text_vector, cosine
+from cache import TTLCache, SingleFlight
+from prompt_registry import prompt_registry
+from prompt_builder import estimate_tokens
+from resilience import with_deadline
+from hedging import get_hedger
+from admission import AdmissionRejected, classification_admission
+from usage import extract_usage, record_usage
+from llm import LazyModel
 
 logger = logging.getLogger(__name__)
 
-# --- INICIALIZACIÓN DE VERTEX AI ---
-PROJECT_ID = os.getenv("GCP_PROJECT")
-LOCATION = os.getenv("GCP_REGION", "europe-west1")
-vertexai.init(project=PROJECT_ID, location=LOCATION)
+# Cliente compartido con la generación (llm.py); Vertex AI se inicializa en la primera llamada
+CLASSIFICATION_MODEL = "gemini-2.0-flash"
+classification_model = LazyModel(CLASSIFICATION_MODEL)
+
+# Clasificador local: resuelve sin Gemini las consultas claras
+LOCAL_CLASSIFIER_ENABLED = os.getenv("LOCAL_CLASSIFIER_ENABLED", "true").lower() == "true"
+LOCAL_CLASSIFIER_THRESHOLD = float(os.getenv("LOCAL_CLASSIFIER_THRESHOLD", "0.85"))
+LOCAL_CLASSIFIER_K = int(os.getenv("LOCAL_CLASSIFIER_K", "5"))
+
+# Caché de clasificaciones: una consulta popular cuesta una llamada por ventana de TTL
+CLASSIFICATION_CACHE_TTL = float(os.getenv("CLASSIFICATION_CACHE_TTL", "600"))
+CLASSIFICATION_CACHE_SIZE = int(os.getenv("CLASSIFICATION_CACHE_SIZE", "2048"))
 
-# Cargar el modelo de IA una sola vez
-classification_model = GenerativeModel("gemini-2.0-flash")
+# Clasificación por lotes: las consultas que llegan dentro de la ventana comparten una llamada
+CLASSIFICATION_BATCHING = os.getenv("CLASSIFICATION_BATCHING", "false").lower() == "true"
+CLASSIFICATION_BATCH_WINDOW_MS = float(os.getenv("CLASSIFICATION_BATCH_WINDOW_MS", "25"))
+CLASSIFICATION_BATCH_MAX_SIZE = int(os.getenv("CLASSIFICATION_BATCH_MAX_SIZE", "8"))
 
 
 def load_prompt_from_file(file_name: str) -> str:
-    prompt_path = Path(__file__).parent / "prompts" / file_name
-    try:
-        with open(prompt_path, 'r', encoding='utf-8') as f:
-            return f.read()
-    except FileNotFoundError:
-        logger.error(f"FATAL: Archivo de prompt no encontrado: {prompt_path}")
-        return ""
+    # Servido desde el registro en memoria: no hay lectura de disco por petición
+    return prompt_registry.text(file_name)
 
 # (El resto de funciones de carga de keywords y fallback se mantienen igual)
 def load_romantic_keywords() -> Tuple[Dict[str, float], float, float]:
@@ -33,56 +48,330 @@ def load_romantic_keywords() -> Tuple[Dict[str, float], float, float]:
     min_confidence = 0.7
     exact_match_bonus = 0.1
     try:
-        keywords_file = Path(__file__).parent / "prompts" / "romantic_keywords.txt"
-        with open(keywords_file, 'r', encoding='utf-8') as f:
-            for line in f:
-                line_without_comment = line.split('#')[0].strip()
-                if not line_without_comment or '=' not in line_without_comment:
-                    continue
-                key, value = line_without_comment.split('=', 1)
-                key, value = key.strip(), value.strip()
-                if key == 'MIN_CONFIDENCE': min_confidence = float(value)
-                elif key == 'EXACT_MATCH_BONUS': exact_match_bonus = float(value)
-                else: keywords[key] = float(value)
+        for line in load_prompt_from_file("romantic_keywords.txt").splitlines():
+            line_without_comment = line.split('#')[0].strip()
+            if not line_without_comment or '=' not in line_without_comment:
+                continue
+            key, value = line_without_comment.split('=', 1)
+            key, value = key.strip(), value.strip()
+            if key == 'MIN_CONFIDENCE': min_confidence = float(value)
+            elif key == 'EXACT_MATCH_BONUS': exact_match_bonus = float(value)
+            else: keywords[key] = float(value)
         return keywords, min_confidence, exact_match_bonus
     except Exception as e:
         logger.error(f"Error cargando palabras clave románticas: {e}")
         return {}, 0.7, 0.1
 
+class RomanticKeywordMatcher:
+    """Autómata Aho-Corasick sobre las palabras clave románticas.
+
+    Encuentra todas las palabras clave presentes en una sola pasada por la
+    consulta y aplica las mismas reglas que la búsqueda lineal original: gana
+    la primera palabra clave (en orden del fichero) que coincide exactamente o
+    cuya confianza como subcadena alcanza el mínimo.
+    """
+
+    def __init__(self, keywords: Dict[str, float], min_confidence: float, exact_match_bonus: float):
+        self.keywords = [kw for kw in keywords if kw]
+        self.exact_confidence = [min(1.0, keywords[kw] + exact_match_bonus) for kw in self.keywords]
+        self.substring_confidence = [keywords[kw] + min(0.2, len(kw) / 50) for kw in self.keywords]
+        self.qualifies = [conf >= min_confidence for conf in self.substring_confidence]
+        self._build()
+
+    def _build(self):
+        # Trie: transiciones, enlaces de fallo y salidas (índices de keyword) por estado
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[List[int]] = [[]]
+        for index, kw in enumerate(self.keywords):
+            state = 0
+            for char in kw:
+                nxt = self._goto[state].get(char)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[state][char] = nxt
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append([])
+                state = nxt
+            self._out[state].append(index)
+
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, nxt in self._goto[state].items():
+                queue.append(nxt)
+                fallback = self._fail[state]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                candidate = self._goto[fallback].get(char, 0)
+                self._fail[nxt] = candidate if candidate != nxt else 0
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+    def match(self, user_query: str) -> Tuple[bool, str, float]:
+        query_lower = user_query.lower()
+        best = None
+        state = 0
+        for char in query_lower:
+            while state and char not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(char, 0)
+            for index in self._out[state]:
+                if best is not None and index >= best:
+                    continue
+                if self.qualifies[index] or self.keywords[index] == query_lower:
+                    best = index
+        if best is None:
+            return False, "", 0.0
+        kw = self.keywords[best]
+        if kw == query_lower:
+            return True, kw, self.exact_confidence[best]
+        return True, kw, self.substring_confidence[best]
+
+
+_romantic_matcher: Optional[RomanticKeywordMatcher] = None
+_romantic_matcher_version = ""
+
+def get_romantic_matcher() -> RomanticKeywordMatcher:
+    """Devuelve el matcher compilado, reconstruyéndolo solo si el fichero cambió."""
+    global _romantic_matcher, _romantic_matcher_version
+    version = prompt_registry.version("romantic_keywords.txt")
+    if _romantic_matcher is None or version != _romantic_matcher_version:
+        _romantic_matcher = RomanticKeywordMatcher(*load_romantic_keywords())
+        _romantic_matcher_version = version
+    return _romantic_matcher
+
 def is_romantic_query_manual(user_query: str) -> Tuple[bool, str, float]:
-    keywords, min_confidence, exact_match_bonus = load_romantic_keywords()
-    query_lower = user_query.lower()
-    for kw, base_conf in keywords.items():
-        if kw == query_lower: return True, kw, min(1.0, base_conf + exact_match_bonus)
-        if kw in query_lower:
-            conf = base_conf + min(0.2, len(kw) / 50)
-            if conf >= min_confidence: return True, kw, conf
-    return False, "", 0.0
+    return get_romantic_matcher().match(user_query)
 
-def _fallback_classification(user_query: str) -> Dict[str, Any]:
+def _keyword_classification(user_query: str) -> Optional[Dict[str, Any]]:
     is_romantic, keyword, score = is_romantic_query_manual(user_query)
     if is_romantic: return {"category": "SECRET_MESSAGE", "confidence": score, "reasoning": f"Coincidencia con '{keyword}'"}
     query_lower = user_query.lower()
     if any(kw in query_lower for kw in ['recomienda', 'sugiere', 'maridaje', 'vino']): return {"category": "WINE_SEARCH", "confidence": 0.7, "reasoning": "Fallback: keywords de búsqueda"}
     if any(kw in query_lower for kw in ['qué es', 'explica', 'diferencia', 'taninos']): return {"category": "WINE_THEORY", "confidence": 0.7, "reasoning": "Fallback: keywords de teoría"}
     if any(kw in query_lower for kw in ['hola', 'buenos', 'saludos']): return {"category": "GREETING", "confidence": 0.6, "reasoning": "Fallback: keywords de saludo"}
-    return {"category": "OFF_TOPIC", "confidence": 0.5, "reasoning": "Fallback: no se detectaron keywords"}
+    return None
+
+def _fallback_classification(user_query: str) -> Dict[str, Any]:
+    return _keyword_classification(user_query) or {"category": "OFF_TOPIC", "confidence": 0.5, "reasoning": "Fallback: no se detectaron keywords"}
+
+
+def load_classification_examples() -> List[Tuple[str, str]]:
+    """Lee los ejemplos etiquetados (CATEGORIA | consulta) del clasificador local."""
+    examples = []
+    for line in load_prompt_from_file("classification_examples.txt").splitlines():
+        line = line.split('#')[0].strip()
+        if '|' not in line:
+            continue
+        category, query = line.split('|', 1)
+        examples.append((category.strip(), query.strip()))
+    return examples
+
+
+# Un saludo local no puede tener más palabras que estas ni ninguna fuera del vocabulario de saludos
+GREETING_MAX_WORDS = 5
+GREETING_FILLER_WORDS = {"hola", "buenas", "buenos", "dias", "tardes", "noches", "hey", "que", "tal", "sumy", "saludos", "muy"}
+
+# Una respuesta local de vinos exige al menos uno de estos términos (normalizados, en singular):
+# "¿qué es el fútbol?" se parece a "¿qué es la crianza?" en la forma pero no en el tema
+WINE_DOMAIN_TERMS = {
+    "vino", "vinico", "uva", "tinto", "rosado", "espumoso", "cava", "champan", "champagne", "crianza",
+    "reserva", "tanino", "maridaje", "maridar", "marida", "cata", "catar", "bodega", "barrica", "añada",
+    "cosecha", "terroir", "fermentacion", "malolactica", "decanta", "decantar", "decantacion", "decantador",
+    "denominacion", "enologia", "enologo", "sumiller", "sommelier", "varietal", "rioja", "ribera", "rueda",
+    "priorat", "jerez", "albariño", "verdejo", "godello", "tempranillo", "garnacha", "monastrell", "merlot",
+    "syrah", "malbec", "cabernet", "chardonnay", "sauvignon", "moscatel", "pinot", "sulfito",
+}
+WINE_CATEGORIES = {"WINE_THEORY", "WINE_SEARCH"}
+
+
+def has_wine_term(user_query: str) -> bool:
+    for word in normalize_text(user_query).split():
+        if word in WINE_DOMAIN_TERMS or (word.endswith("s") and (word[:-1] in WINE_DOMAIN_TERMS
+                                                                 or word[:-2] in WINE_DOMAIN_TERMS)):
+            return True
+    return False
+
+
+class LocalQueryClassifier:
+    """Clasificador local: reglas de keywords + voto de vecinos más cercanos.
+
+    La confianza es la del voto de vecinos; las reglas de keywords solo vetan
+    (categoría contradictoria) salvo la coincidencia romántica, que es específica
+    y sí se combina. Las categorías de vinos exigen además un término del dominio.
+    Si no se supera el umbral devuelve None y la consulta va a Gemini.
+    """
+
+    def __init__(self, threshold: float = LOCAL_CLASSIFIER_THRESHOLD, k: int = LOCAL_CLASSIFIER_K):
+        self.threshold = threshold
+        self.k = k
+        examples = load_classification_examples()
+        self.examples = [(category, text_vector(query)) for category, query in examples]
+        # Palabras de los saludos de ejemplo: un saludo solo se resuelve en local si no añade nada más
+        self.greeting_words = {
+            word for category, query in examples if category == "GREETING" for word in normalize_text(query).split()
+        } | GREETING_FILLER_WORDS
+        logger.info(f"🧭 Clasificador local con {len(self.examples)} ejemplos (umbral {threshold})")
+
+    def _neighbour_vote(self, user_query: str) -> Tuple[Optional[str], float]:
+        query_vector = text_vector(user_query)
+        if not query_vector or not self.examples:
+            return None, 0.0
+        neighbours = sorted(
+            ((cosine(query_vector, vector), category) for category, vector in self.examples),
+            reverse=True
+        )[:self.k]
+        votes: Dict[str, float] = {}
+        for similarity, category in neighbours:
+            votes[category] = votes.get(category, 0.0) + similarity
+        total = sum(votes.values())
+        if not total:
+            return None, 0.0
+        best = max(votes, key=votes.get)
+        best_similarity = max(sim for sim, category in neighbours if category == best)
+        # Acuerdo entre vecinos ponderado por lo cerca que está el más parecido
+        return best, (votes[best] / total) * min(1.0, best_similarity / 0.6)
+
+    def is_greeting_only(self, user_query: str) -> bool:
+        words = normalize_text(user_query).split()
+        return 0 < len(words) <= GREETING_MAX_WORDS and all(word in self.greeting_words for word in words)
+
+    def classify(self, user_query: str, has_history: bool = False) -> Optional[Dict[str, Any]]:
+        knn_category, knn_confidence = self._neighbour_vote(user_query)
+        if knn_category is None or knn_confidence < 0.5:
+            return None
+        if knn_category == "GREETING" and has_history:
+            return None  # Con historial un saludo es una continuación: lo decide Gemini
+        if knn_category == "GREETING" and not self.is_greeting_only(user_query):
+            return None  # "hola, ¿cómo funciona...?" lleva una pregunta detrás del saludo
+        if knn_category in WINE_CATEGORIES and not has_wine_term(user_query):
+            return None  # Misma forma que una pregunta de vinos pero sin tema de vinos
+        rule = _keyword_classification(user_query)
+        if rule is not None and rule["category"] != knn_category:
+            return None  # Señales contradictorias: que decida Gemini
+
+        confidence = knn_confidence
+        # Las keywords genéricas ("qué es", "explica"...) no son una señal independiente de los
+        # vecinos: solo la coincidencia con una palabra clave romántica refuerza la confianza
+        corroborated = rule is not None and rule["category"] == "SECRET_MESSAGE"
+        if corroborated:
+            # Combinación tipo noisy-OR de dos señales independientes que coinciden
+            confidence = 1 - (1 - knn_confidence) * (1 - min(rule["confidence"], 0.99))
+        if confidence < self.threshold:
+            return None
+        return {
+            "category": knn_category,
+            "confidence": round(confidence, 3),
+            "reasoning": "Clasificador local: " + (f"vecinos y {rule['reasoning'].lower()}" if corroborated else "vecinos más cercanos")
+        }
+
+
+_local_classifier: Optional[LocalQueryClassifier] = None
+
+def get_local_classifier() -> LocalQueryClassifier:
+    global _local_classifier
+    if _local_classifier is None:
+        _local_classifier = LocalQueryClassifier()
+    return _local_classifier
+
+
+# Métricas del clasificador (local vs Gemini)
+_classifier_stats = {
+    "total": 0,
+    "local_hits": 0,
+    "llm_calls": 0,
+    "llm_latency_ms_avg": 0.0,
+    "local_latency_ms_total": 0.0,
+}
+
+def _record_llm_latency(elapsed_ms: float):
+    _classifier_stats["llm_calls"] += 1
+    # Media móvil exponencial para estimar el coste de una llamada a Gemini
+    previous = _classifier_stats["llm_latency_ms_avg"]
+    _classifier_stats["llm_latency_ms_avg"] = elapsed_ms if not previous else previous * 0.9 + elapsed_ms * 0.1
+
+def get_classifier_stats() -> Dict[str, Any]:
+    total = _classifier_stats["total"]
+    local_hits = _classifier_stats["local_hits"]
+    saved_ms = local_hits * _classifier_stats["llm_latency_ms_avg"] - _classifier_stats["local_latency_ms_total"]
+    return {
+        "total": total,
+        "local_hits": local_hits,
+        "llm_calls": _classifier_stats["llm_calls"],
+        "local_fraction": round(local_hits / total, 3) if total else 0.0,
+        "llm_latency_ms_avg": round(_classifier_stats["llm_latency_ms_avg"], 2),
+        "estimated_latency_saved_ms": round(max(0.0, saved_ms), 2),
+    }
 
 
 class IntelligentQueryFilter:
     def __init__(self):
         self.model = classification_model
-        self.classification_prompt_template = load_prompt_from_file("sumiller_clasificacion.txt")
 
-    async def classify_query(self, user_query: str) -> Dict[str, Any]:
-        if not self.classification_prompt_template:
-            return _fallback_classification(user_query)
+    @property
+    def classification_prompt_template(self) -> str:
+        # Se lee del registro en cada uso para recoger las recargas en caliente
+        return load_prompt_from_file("sumiller_clasificacion.txt")
+
+    async def classify_query(self, user_query: str, has_history: bool = False) -> Dict[str, Any]:
+        classification, _ = await self._classify(user_query, has_history)
+        return classification
 
+    async def _classify(self, user_query: str, has_history: bool,
+                        trace: Optional[Dict[str, Any]] = None) -> Tuple[Dict[str, Any], str]:
+        """Clasifica la consulta e indica el origen: "local", "llm" o "fallback"."""
+        _classifier_stats["total"] += 1
+        local = self._classify_local(user_query, has_history)
+        if local is not None:
+            return local, "local"
+        return await self._classify_remote(user_query, has_history, trace)
+
+    async def _classify_remote(self, user_query: str, has_history: bool,
+                               trace: Optional[Dict[str, Any]] = None) -> Tuple[Dict[str, Any], str]:
+        """Clasificación con Gemini, agrupada en lotes si está activado."""
+        if CLASSIFICATION_BATCHING and self.classification_prompt_template:
+            return await get_classification_batcher().classify(user_query, has_history, trace)
+        return await self._classify_llm(user_query, has_history, trace)
+
+    def single_prompt(self, user_query: str, has_history: bool) -> str:
         full_prompt = self.classification_prompt_template + f'\nConsulta: "{user_query}"'
+        if has_history:
+            full_prompt += " (con historial de conversación existente)"
+        return full_prompt
+
+    def _classify_local(self, user_query: str, has_history: bool) -> Optional[Dict[str, Any]]:
+        if not LOCAL_CLASSIFIER_ENABLED:
+            return None
+        start = time.perf_counter()
+        local = get_local_classifier().classify(user_query, has_history)
+        _classifier_stats["local_latency_ms_total"] += (time.perf_counter() - start) * 1000
+        if local is not None:
+            _classifier_stats["local_hits"] += 1
+            logger.info(f"⚡ Clasificación local: {local['category']} (Confianza: {local['confidence']})")
+        return local
+
+    async def _classify_llm(self, user_query: str, has_history: bool,
+                            trace: Optional[Dict[str, Any]] = None) -> Tuple[Dict[str, Any], str]:
+        if not self.classification_prompt_template:
+            return _fallback_classification(user_query), "fallback"
+
+        full_prompt = self.single_prompt(user_query, has_history)
         
         try:
             # --- LLAMADA A VERTEX AI ---
-            response = await self.model.generate_content_async(full_prompt)
+            start = time.perf_counter()
+            # Si Gemini no responde dentro del plazo de la etapa se usa el fallback por keywords;
+            # si no hay hueco para la llamada, la petición se rechaza (503) en vez de esperar
+            async with classification_admission.slot():
+                response = await with_deadline(
+                    get_hedger("classification").call(
+                        lambda: self.model.generate_content_async(full_prompt), admission=classification_admission
+                    ),
+                    "classification"
+                )
+            _record_llm_latency((time.perf_counter() - start) * 1000)
+            record_usage(trace, "classification", extract_usage(response, full_prompt, response.text, CLASSIFICATION_MODEL))
             
             # Limpiar y parsear la respuesta JSON del modelo
             json_text = response.text.strip().replace("```json", "").replace("```", "").strip()
@@ -90,22 +379,284 @@ class IntelligentQueryFilter:
 
             if "category" in classification and "confidence" in classification:
                 logger.info(f"✅ Clasificación Vertex AI: {classification['category']} (Confianza: {classification['confidence']})")
-                return classification
+                return classification, "llm"
             raise ValueError("Formato JSON de clasificación incompleto.")
+        except AdmissionRejected:
+            raise
+        except asyncio.TimeoutError:
+            return _fallback_classification(user_query), "fallback"
         except Exception as e:
             logger.error(f"❌ Error en la llamada de clasificación a Vertex AI: {e}")
-            return _fallback_classification(user_query)
+            return _fallback_classification(user_query), "fallback"
+
+class ClassificationBatcher:
+    """Agrupa las clasificaciones que llegan juntas en una sola llamada a Gemini.
+
+    Las consultas se acumulan durante `window_ms` (o hasta `max_size`) y se
+    clasifican con un único prompt que devuelve un array JSON. El prompt fijo de
+    clasificación, que es la mayor parte del coste, se paga una vez por lote. Las
+    consultas que falten en la respuesta, o todo el lote si la llamada falla, se
+    clasifican de una en una.
+    """
+
+    def __init__(self, query_filter: "IntelligentQueryFilter", window_ms: float = CLASSIFICATION_BATCH_WINDOW_MS,
+                 max_size: int = CLASSIFICATION_BATCH_MAX_SIZE):
+        self.query_filter = query_filter
+        self.window_ms = window_ms
+        self.max_size = max_size
+        # (consulta, historial, futuro, traza de la petición para repartir el uso del lote)
+        self._pending: List[Tuple[str, bool, asyncio.Future, Optional[Dict[str, Any]]]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks = set()
+        self._stats = {
+            "batches": 0, "batched_queries": 0, "max_batch_size": 0, "singles": 0,
+            "missing_fallbacks": 0, "batch_failures": 0,
+            "tokens_est_individual": 0, "tokens_est_batched": 0,
+        }
+        self._size_histogram: Dict[int, int] = {}
+
+    async def classify(self, user_query: str, has_history: bool,
+                       trace: Optional[Dict[str, Any]] = None) -> Tuple[Dict[str, Any], str]:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((user_query, has_history, future, trace))
+        if len(self._pending) >= self.max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window_ms / 1000, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch = [item for item in self._pending if not item[2].done()]
+        self._pending = []
+        if not batch:
+            return
+        # El lote se resuelve en su propia tarea: si un solicitante se cancela, el resto sigue
+        task = asyncio.ensure_future(self._run(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: List[Tuple[str, bool, asyncio.Future, Optional[Dict[str, Any]]]]):
+        size = len(batch)
+        self._size_histogram[size] = self._size_histogram.get(size, 0) + 1
+        try:
+            if size == 1:
+                self._stats["singles"] += 1
+                results = {0: await self.query_filter._classify_llm(batch[0][0], batch[0][1], batch[0][3])}
+            else:
+                results = await self._classify_batch(batch)
+                missing = [i for i in range(size) if i not in results]
+                if missing:
+                    self._stats["missing_fallbacks"] += len(missing)
+                    singles = await asyncio.gather(
+                        *(self.query_filter._classify_llm(batch[i][0], batch[i][1], batch[i][3]) for i in missing),
+                        return_exceptions=True
+                    )
+                    results.update(zip(missing, singles))
+        except Exception as e:
+            results = {i: e for i in range(size)}
+        for i, (_, _, future, _) in enumerate(batch):
+            if future.done():
+                continue
+            result = results[i]
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def _batch_prompt(self, batch: List[Tuple[str, bool, asyncio.Future, Optional[Dict[str, Any]]]]) -> str:
+        lines = []
+        for i, (user_query, has_history, _, _) in enumerate(batch, start=1):
+            # Cadena JSON: comillas y saltos de línea de la consulta no pueden romper la lista
+            line = f"{i}. {json.dumps(user_query, ensure_ascii=False)}"
+            if has_history:
+                line += " (con historial de conversación existente)"
+            lines.append(line)
+        return prompt_registry.render(
+            "clasificacion_lote.txt",
+            classification_prompt=self.query_filter.classification_prompt_template,
+            queries="\n".join(lines)
+        )
+
+    async def _classify_batch(self, batch: List[Tuple[str, bool, asyncio.Future, Optional[Dict[str, Any]]]]) -> Dict[int, Tuple[Dict[str, Any], str]]:
+        """Clasifica el lote con una llamada; devuelve solo las consultas con respuesta válida."""
+        full_prompt = self._batch_prompt(batch)
+        self._stats["batches"] += 1
+        self._stats["batched_queries"] += len(batch)
+        self._stats["max_batch_size"] = max(self._stats["max_batch_size"], len(batch))
+        self._stats["tokens_est_batched"] += estimate_tokens(full_prompt)
+        self._stats["tokens_est_individual"] += sum(
+            estimate_tokens(self.query_filter.single_prompt(user_query, has_history)) for user_query, has_history, _, _ in batch
+        )
+        try:
+            start = time.perf_counter()
+            async with classification_admission.slot():
+                response = await with_deadline(
+                    get_hedger("classification_batch").call(
+                        lambda: self.query_filter.model.generate_content_async(full_prompt),
+                        admission=classification_admission
+                    ),
+                    "classification"
+                )
+            _record_llm_latency((time.perf_counter() - start) * 1000)
+            # Cada petición del lote paga una parte igual de la llamada
+            usage = extract_usage(response, full_prompt, response.text, CLASSIFICATION_MODEL)
+            for _, _, _, trace in batch:
+                record_usage(trace, "classification", usage, share=1 / len(batch))
+            items = json.loads(response.text.strip().replace("```json", "").replace("```", "").strip())
+        except AdmissionRejected:
+            raise
+        except Exception as e:
+            # Lote fallido o ilegible: todas las consultas pasan a clasificarse de una en una
+            self._stats["batch_failures"] += 1
+            logger.error(f"❌ Error en la clasificación por lotes ({len(batch)} consultas): {e}")
+            return {}
+
+        entries: Dict[int, List[Dict[str, Any]]] = {}
+        for item in items if isinstance(items, list) else []:
+            if not isinstance(item, dict) or "category" not in item or "confidence" not in item:
+                continue
+            try:
+                index = int(item.get("id")) - 1
+            except (TypeError, ValueError):
+                continue
+            if 0 <= index < len(batch):
+                entries.setdefault(index, []).append(item)
+        # Solo vale una respuesta por consulta; con varias no se sabe cuál es la buena
+        # y la consulta se clasifica de forma individual
+        results: Dict[int, Tuple[Dict[str, Any], str]] = {
+            index: ({k: found[0][k] for k in ("category", "confidence", "reasoning") if k in found[0]}, "batch")
+            for index, found in entries.items() if len(found) == 1
+        }
+        duplicated = len(entries) - len(results)
+        if duplicated:
+            logger.warning(f"⚠️ Clasificación por lotes: {duplicated} consultas con respuestas repetidas")
+        logger.info(f"📦 Clasificación por lotes: {len(results)}/{len(batch)} consultas en una llamada")
+        return results
+
+    def get_stats(self) -> Dict[str, Any]:
+        batches = self._stats["batches"]
+        individual = self._stats["tokens_est_individual"]
+        saved = individual - self._stats["tokens_est_batched"]
+        return {
+            "enabled": CLASSIFICATION_BATCHING,
+            "window_ms": self.window_ms,
+            "max_size": self.max_size,
+            **self._stats,
+            "avg_batch_size": round(self._stats["batched_queries"] / batches, 2) if batches else 0.0,
+            "batch_size_histogram": dict(sorted(self._size_histogram.items())),
+            "tokens_est_saved": saved,
+            "tokens_saved_fraction": round(saved / individual, 3) if individual else 0.0,
+        }
+
 
 CATEGORY_RESPONSES = {
     "GREETING": "¡Hola! Soy Sumy, tu sumiller virtual personal. 🍷 Estoy aquí para ayudarte a descubrir el vino perfecto para cualquier ocasión, resolver tus dudas sobre el fascinante mundo del vino o encontrar el maridaje ideal. ¿En qué puedo ayudarte hoy?"
 }
 
-async def filter_and_classify_query(user_query: str) -> Dict[str, Any]:
-    filter_instance = IntelligentQueryFilter()
-    classification = await filter_instance.classify_query(user_query)
+_query_filter: Optional[IntelligentQueryFilter] = None
+_classification_batcher: Optional[ClassificationBatcher] = None
+_classification_cache = TTLCache(CLASSIFICATION_CACHE_SIZE, CLASSIFICATION_CACHE_TTL)
+_classification_flight = SingleFlight()
+
+def _on_prompts_reloaded(changed: List[str]):
+    global _local_classifier
+    if "classification_examples.txt" in changed:
+        _local_classifier = None
+    if changed:
+        # Un prompt o ejemplo nuevo puede cambiar la clasificación
+        _classification_cache.clear()
+
+prompt_registry.on_reload(_on_prompts_reloaded)
+
+def get_query_filter() -> IntelligentQueryFilter:
+    global _query_filter
+    if _query_filter is None:
+        _query_filter = IntelligentQueryFilter()
+    return _query_filter
+
+def get_classification_batcher() -> ClassificationBatcher:
+    global _classification_batcher
+    if _classification_batcher is None:
+        _classification_batcher = ClassificationBatcher(get_query_filter())
+    return _classification_batcher
+
+def get_classification_batch_stats() -> Dict[str, Any]:
+    if _classification_batcher is None:
+        return {"enabled": CLASSIFICATION_BATCHING}
+    return _classification_batcher.get_stats()
+
+def get_classification_cache_stats() -> Dict[str, Any]:
+    return {**_classification_cache.get_stats(), "single_flight": _classification_flight.get_stats()}
+
+def _cache_key(user_query: str, has_history: bool) -> Tuple[str, bool]:
+    # Las reglas del prompt solo dependen de la consulta y de si hay historial
+    return normalize_text(user_query), has_history
+
+def _with_rag_flag(cached: Dict[str, Any]) -> Dict[str, Any]:
+    # Copia: cada petición añade sus propios campos sin tocar la entrada cacheada
+    classification = dict(cached)
     # Usar RAG para búsquedas de vinos Y para teoría del vino
     classification["should_use_rag"] = (
         classification.get("category") in ["WINE_SEARCH", "WINE_THEORY"] 
         and classification.get("confidence", 0) > 0.6
     )
     return classification
+
+async def _classify_and_cache(key: Tuple[str, bool], classify) -> Tuple[Dict[str, Any], str]:
+    classification, source = await classify()
+    # Los resultados del fallback por error de Vertex no se cachean, para no
+    # fijar una clasificación degradada durante toda la ventana de TTL
+    if source != "fallback":
+        _classification_cache.set(key, classification)
+    return classification, source
+
+async def filter_and_classify_query(user_query: str, has_history: bool = False, trace: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    key = _cache_key(user_query, has_history)
+    cached = _classification_cache.get(key)
+    source = "cache"
+    if cached is None:
+        shared = _classification_flight.is_inflight(key)
+        # El uso de la llamada se anota en la traza de quien la lanza, no en las que la comparten
+        cached, source = await _classification_flight.do(
+            key, lambda: _classify_and_cache(key, lambda: get_query_filter()._classify(user_query, has_history, trace))
+        )
+        if shared:
+            source = "single_flight"
+    if trace is not None:
+        trace["classification_source"] = source
+    return _with_rag_flag(cached)
+
+def peek_classification(user_query: str, has_history: bool = False, trace: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+    """Clasificación sin llamar a Gemini (caché o clasificador local), o None."""
+    key = _cache_key(user_query, has_history)
+    cached = _classification_cache.get(key)
+    source = "cache"
+    if cached is None:
+        _classifier_stats["total"] += 1
+        cached = get_query_filter()._classify_local(user_query, has_history)
+        if cached is None:
+            return None
+        _classification_cache.set(key, cached)
+        source = "local"
+    if trace is not None:
+        trace["classification_source"] = source
+    return _with_rag_flag(cached)
+
+async def classify_with_llm(user_query: str, has_history: bool = False, trace: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Clasificación directa con Gemini (tras un peek_classification sin resultado)."""
+    key = _cache_key(user_query, has_history)
+    classification, source = await _classification_flight.do(
+        key, lambda: _classify_and_cache(key, lambda: get_query_filter()._classify_remote(user_query, has_history, trace))
+    )
+    if trace is not None:
+        trace["classification_source"] = source
+    return _with_rag_flag(classification)
+
+def remember_classification(user_query: str, has_history: bool, classification: Dict[str, Any]):
+    """Guarda en caché una clasificación obtenida por otra vía (p. ej. modo unificado)."""
+    entry = {k: classification[k] for k in ("category", "confidence", "reasoning") if k in classification}
+    _classification_cache.set(_cache_key(user_query, has_history), entry)
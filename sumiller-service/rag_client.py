@@ -0,0 +1,135 @@
+# sumiller-service/rag_client.py
+
+# Cliente HTTP compartido hacia el RAG Service.
+import os
+import time
+import logging
+from typing import Dict, Any, Optional, Tuple
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+RAG_HTTP_MAX_CONNECTIONS = int(os.getenv("RAG_HTTP_MAX_CONNECTIONS", "20"))
+RAG_HTTP_MAX_KEEPALIVE = int(os.getenv("RAG_HTTP_MAX_KEEPALIVE", "10"))
+RAG_HTTP_KEEPALIVE_EXPIRY = float(os.getenv("RAG_HTTP_KEEPALIVE_EXPIRY", "60"))
+RAG_HTTP2 = os.getenv("RAG_HTTP2", "false").lower() == "true"
+RAG_TIMEOUT = float(os.getenv("RAG_TIMEOUT", "10.0"))
+
+
+class RAGClient:
+    """Cliente httpx de larga vida con pool de conexiones y métricas por llamada.
+
+    Se crea una sola vez al arrancar la aplicación, de forma que las consultas
+    reutilizan conexiones TCP/TLS abiertas hacia el RAG Service.
+    """
+
+    def __init__(self, base_url: Optional[str]):
+        self.base_url = base_url
+        self._client: Optional[httpx.AsyncClient] = None
+        self._stats = {
+            "calls": 0,
+            "errors": 0,
+            "new_connections": 0,
+            "connect_ms_total": 0.0,
+            "request_ms_total": 0.0,
+            "cold_total_ms": 0.0,
+            "warm_total_ms": 0.0,
+        }
+
+    async def start(self):
+        if self._client is not None or not self.base_url:
+            return
+        http2 = RAG_HTTP2
+        if http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                logger.warning("⚠️ RAG_HTTP2 activado pero el paquete 'h2' no está instalado; usando HTTP/1.1")
+                http2 = False
+        self._client = httpx.AsyncClient(
+            base_url=self.base_url,
+            http2=http2,
+            timeout=RAG_TIMEOUT,
+            limits=httpx.Limits(
+                max_connections=RAG_HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=RAG_HTTP_MAX_KEEPALIVE,
+                keepalive_expiry=RAG_HTTP_KEEPALIVE_EXPIRY,
+            ),
+        )
+        logger.info(f"🔌 Cliente RAG iniciado ({'HTTP/2' if http2 else 'HTTP/1.1'}, pool={RAG_HTTP_MAX_CONNECTIONS})")
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+            logger.info("🔌 Cliente RAG cerrado")
+
+    async def post(self, path: str, payload: Dict[str, Any], timeout: Optional[float] = None) -> Tuple[httpx.Response, Dict[str, float]]:
+        """Hace un POST al RAG Service y devuelve la respuesta y sus tiempos.
+
+        Los tiempos distinguen el establecimiento de conexión (TCP + TLS, 0 si
+        la conexión del pool se reutiliza) del tiempo total de la petición.
+        """
+        if self._client is None:
+            await self.start()
+
+        marks: Dict[str, float] = {}
+
+        async def trace(event_name: str, info: Dict[str, Any]):
+            if event_name == "connection.connect_tcp.started":
+                marks["connect_start"] = time.perf_counter()
+            elif event_name in ("connection.connect_tcp.complete", "connection.start_tls.complete"):
+                marks["connect_end"] = time.perf_counter()
+
+        start = time.perf_counter()
+        try:
+            response = await self._client.post(
+                path, json=payload, timeout=timeout or RAG_TIMEOUT, extensions={"trace": trace}
+            )
+        except Exception:
+            self._stats["errors"] += 1
+            raise
+        total_ms = (time.perf_counter() - start) * 1000
+
+        connect_ms = 0.0
+        if "connect_start" in marks and "connect_end" in marks:
+            connect_ms = (marks["connect_end"] - marks["connect_start"]) * 1000
+
+        timings = {
+            "connect_ms": round(connect_ms, 2),
+            "request_ms": round(total_ms - connect_ms, 2),
+            "total_ms": round(total_ms, 2),
+            "connection_reused": connect_ms == 0.0,
+        }
+        self._record(timings)
+        return response, timings
+
+    def _record(self, timings: Dict[str, float]):
+        self._stats["calls"] += 1
+        self._stats["connect_ms_total"] += timings["connect_ms"]
+        self._stats["request_ms_total"] += timings["request_ms"]
+        if timings["connection_reused"]:
+            self._stats["warm_total_ms"] += timings["total_ms"]
+        else:
+            self._stats["new_connections"] += 1
+            self._stats["cold_total_ms"] += timings["total_ms"]
+
+    def get_stats(self) -> Dict[str, Any]:
+        calls = self._stats["calls"]
+        cold = self._stats["new_connections"]
+        warm = calls - cold
+        avg_cold = self._stats["cold_total_ms"] / cold if cold else 0.0
+        avg_warm = self._stats["warm_total_ms"] / warm if warm else 0.0
+        return {
+            "calls": calls,
+            "errors": self._stats["errors"],
+            "new_connections": cold,
+            "reused_connections": warm,
+            "avg_connect_ms": round(self._stats["connect_ms_total"] / calls, 2) if calls else 0.0,
+            "avg_request_ms": round(self._stats["request_ms_total"] / calls, 2) if calls else 0.0,
+            "avg_cold_call_ms": round(avg_cold, 2),
+            "avg_warm_call_ms": round(avg_warm, 2),
+            # Ahorro medio por consulta cuando la conexión ya estaba abierta
+            "warm_savings_ms": round(avg_cold - avg_warm, 2) if cold and warm else 0.0,
+        }
@@ -0,0 +1,167 @@
+# sumiller-service/resilience.py
+
+# Plazos por etapa, circuit breaker e inyección de fallos para pruebas locales.
+import os
+import time
+import random
+import asyncio
+import logging
+from typing import Any, Awaitable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Presupuesto de latencia por etapa del pipeline (ms); 0 desactiva el plazo
+STAGE_DEADLINES_MS: Dict[str, float] = {
+    "classification": float(os.getenv("DEADLINE_CLASSIFICATION_MS", "4000")),
+    "rag": float(os.getenv("DEADLINE_RAG_MS", "2500")),
+    "memory": float(os.getenv("DEADLINE_MEMORY_MS", "1000")),
+    "generation": float(os.getenv("DEADLINE_GENERATION_MS", "20000")),
+}
+
+_deadline_stats: Dict[str, Dict[str, int]] = {stage: {"calls": 0, "missed": 0} for stage in STAGE_DEADLINES_MS}
+
+
+def stage_deadline(stage: str) -> Optional[float]:
+    """Plazo de la etapa en segundos, o None si no tiene."""
+    deadline_ms = STAGE_DEADLINES_MS.get(stage, 0)
+    return deadline_ms / 1000 if deadline_ms > 0 else None
+
+
+async def with_deadline(awaitable: Awaitable[Any], stage: str, timeout: Optional[float] = None) -> Any:
+    """Espera `awaitable` dentro del plazo de la etapa; lanza asyncio.TimeoutError si no llega."""
+    stats = _deadline_stats.setdefault(stage, {"calls": 0, "missed": 0})
+    stats["calls"] += 1
+    try:
+        return await asyncio.wait_for(awaitable, timeout if timeout is not None else stage_deadline(stage))
+    except asyncio.TimeoutError:
+        stats["missed"] += 1
+        logger.warning(f"⏱️ La etapa '{stage}' ha superado su plazo")
+        raise
+
+
+def mark_degraded(trace: Optional[Dict[str, Any]], stage: str):
+    """Anota en la traza que una etapa ha respondido en modo degradado."""
+    if trace is not None and stage not in trace.setdefault("degraded", []):
+        trace["degraded"].append(stage)
+
+
+class CircuitOpenError(Exception):
+    """El circuito está abierto: no se llama al servicio."""
+
+
+class CircuitBreaker:
+    """Circuit breaker clásico: cerrado -> abierto -> semiabierto.
+
+    Tras `failure_threshold` fallos consecutivos deja de llamar al servicio
+    durante `reset_timeout` segundos. Pasado ese tiempo deja pasar una única
+    petición de prueba: si va bien se cierra, si falla vuelve a abrirse.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+        self._stats = {"calls": 0, "failures": 0, "rejected": 0, "opened": 0, "probes": 0}
+
+    def allow(self) -> bool:
+        """Indica si se puede llamar al servicio (y reserva la prueba en semiabierto)."""
+        if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = self.HALF_OPEN
+            logger.info(f"🔌 Circuito '{self.name}' semiabierto: se prueba el servicio")
+        if self.state == self.CLOSED or (self.state == self.HALF_OPEN and not self._probe_in_flight):
+            if self.state == self.HALF_OPEN:
+                self._probe_in_flight = True
+                self._stats["probes"] += 1
+            self._stats["calls"] += 1
+            return True
+        self._stats["rejected"] += 1
+        return False
+
+    def record_success(self):
+        if self.state != self.CLOSED:
+            logger.info(f"✅ Circuito '{self.name}' cerrado de nuevo")
+        self.state = self.CLOSED
+        self.failures = 0
+        self._probe_in_flight = False
+
+    def release(self):
+        """Libera la prueba reservada por `allow()` cuando la llamada terminó sin resultado (p. ej. cancelada)."""
+        self._probe_in_flight = False
+
+    def record_failure(self):
+        self._stats["failures"] += 1
+        self.failures += 1
+        self._probe_in_flight = False
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                self._stats["opened"] += 1
+                logger.warning(f"🚫 Circuito '{self.name}' abierto tras {self.failures} fallos")
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "failure_threshold": self.failure_threshold,
+            "reset_timeout_seconds": self.reset_timeout,
+            **self._stats,
+        }
+
+
+class FaultInjector:
+    """Latencia y errores artificiales para probar la degradación en local."""
+
+    def __init__(self, name: str, latency_ms: float = 0.0, jitter_ms: float = 0.0, error_rate: float = 0.0):
+        self.name = name
+        self.configure(latency_ms, jitter_ms, error_rate)
+        self.injected_errors = 0
+        self.injected_delays = 0
+
+    def configure(self, latency_ms: float = 0.0, jitter_ms: float = 0.0, error_rate: float = 0.0):
+        self.latency_ms = max(latency_ms, 0.0)
+        self.jitter_ms = max(jitter_ms, 0.0)
+        self.error_rate = min(max(error_rate, 0.0), 1.0)
+        if self.enabled:
+            logger.warning(
+                f"🧪 Inyección de fallos en '{self.name}': {self.latency_ms}±{self.jitter_ms} ms, "
+                f"{self.error_rate:.0%} de errores"
+            )
+
+    @property
+    def enabled(self) -> bool:
+        return self.latency_ms > 0 or self.jitter_ms > 0 or self.error_rate > 0
+
+    async def inject(self):
+        if not self.enabled:
+            return
+        delay = self.latency_ms + random.uniform(0, self.jitter_ms)
+        if delay > 0:
+            self.injected_delays += 1
+            await asyncio.sleep(delay / 1000)
+        if random.random() < self.error_rate:
+            self.injected_errors += 1
+            raise RuntimeError(f"Fallo inyectado en '{self.name}'")
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "latency_ms": self.latency_ms,
+            "jitter_ms": self.jitter_ms,
+            "error_rate": self.error_rate,
+            "injected_delays": self.injected_delays,
+            "injected_errors": self.injected_errors,
+        }
+
+
+def get_deadline_stats() -> Dict[str, Any]:
+    return {
+        stage: {"deadline_ms": STAGE_DEADLINES_MS.get(stage, 0), **stats}
+        for stage, stats in _deadline_stats.items()
+    }
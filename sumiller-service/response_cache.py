@@ -0,0 +1,174 @@
+# sumiller-service/response_cache.py
+
+# Caché semántica de respuestas que no dependen del usuario.
+import os
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Any, AsyncGenerator, Dict, List, Optional
+
+from text_similarity import cosine, text_vector
+
+logger = logging.getLogger(__name__)
+
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "true").lower() == "true"
+# Categorías cuya respuesta no depende del usuario
+RESPONSE_CACHE_CATEGORIES = {
+    c.strip() for c in os.getenv("RESPONSE_CACHE_CATEGORIES", "WINE_THEORY").split(",") if c.strip()
+}
+RESPONSE_CACHE_THRESHOLD = float(os.getenv("RESPONSE_CACHE_THRESHOLD", "0.9"))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "21600"))
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "512"))
+# Tamaño aproximado de cada fragmento al reproducir una respuesta cacheada en streaming
+RESPONSE_CACHE_CHUNK_CHARS = int(os.getenv("RESPONSE_CACHE_CHUNK_CHARS", "48"))
+
+
+class CachedResponse:
+    def __init__(self, query: str, response: str, category: str, version: tuple):
+        self.query = query
+        self.vector = text_vector(query)
+        self.response = response
+        self.category = category
+        self.version = version
+        self.created_at = time.monotonic()
+
+
+class SemanticResponseCache:
+    """Respuestas generadas indexadas por similitud de la consulta.
+
+    Una entrada solo sirve para consultas de la misma categoría generadas con la
+    misma versión de prompts y del índice de conocimiento. Al cambiar cualquiera
+    de las dos se vacía la caché. La búsqueda es lineal: con unos cientos de
+    entradas cuesta mucho menos que una generación.
+    """
+
+    def __init__(self, max_size: int = RESPONSE_CACHE_SIZE, ttl: float = RESPONSE_CACHE_TTL,
+                 threshold: float = RESPONSE_CACHE_THRESHOLD, categories=RESPONSE_CACHE_CATEGORIES):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.threshold = threshold
+        self.categories = set(categories)
+        self._entries: "OrderedDict[int, CachedResponse]" = OrderedDict()
+        self._next_id = 0
+        self._index_version: Optional[str] = None
+        self._stats = {"lookups": 0, "hits": 0, "stores": 0, "evictions": 0, "expirations": 0,
+                       "invalidations": 0, "similarity_total": 0.0}
+        self._by_category: Dict[str, Dict[str, int]] = {}
+
+    @property
+    def index_version(self) -> Optional[str]:
+        """Última versión del índice de conocimiento vista en una respuesta del RAG."""
+        return self._index_version
+
+    def is_shareable(self, category: str, has_history: bool) -> bool:
+        """Solo categorías no personalizadas y sin conversación previa que condicione la respuesta.
+
+        Con session_id el historial se rellena desde el servidor: dentro de una
+        sesión solo la primera consulta puede servirse desde la caché.
+        """
+        return category in self.categories and not has_history
+
+    def is_cacheable(self, category: str, has_history: bool) -> bool:
+        return RESPONSE_CACHE_ENABLED and self.is_shareable(category, has_history)
+
+    def observe_index_version(self, index_version: Optional[str]):
+        """Vacía la caché si el índice de conocimiento del RAG ha cambiado."""
+        if not index_version:
+            return
+        if self._index_version is not None and index_version != self._index_version:
+            self.invalidate(f"índice RAG {self._index_version} -> {index_version}")
+        self._index_version = index_version
+
+    def invalidate(self, reason: str):
+        if self._entries:
+            logger.info(f"🧹 Caché de respuestas invalidada ({len(self._entries)} entradas): {reason}")
+        self._entries.clear()
+        self._stats["invalidations"] += 1
+
+    def lookup(self, query: str, category: str, version: tuple) -> Optional[Dict[str, Any]]:
+        self._stats["lookups"] += 1
+        counters = self._by_category.setdefault(category, {"lookups": 0, "hits": 0})
+        counters["lookups"] += 1
+
+        vector = text_vector(query)
+        now = time.monotonic()
+        best_id, best_score = None, 0.0
+        for entry_id, entry in list(self._entries.items()):
+            if now - entry.created_at > self.ttl:
+                del self._entries[entry_id]
+                self._stats["expirations"] += 1
+                continue
+            if entry.category != category or entry.version != version:
+                continue
+            score = cosine(vector, entry.vector)
+            if score > best_score:
+                best_id, best_score = entry_id, score
+
+        if best_id is None or best_score < self.threshold:
+            return None
+        entry = self._entries[best_id]
+        self._entries.move_to_end(best_id)
+        self._stats["hits"] += 1
+        self._stats["similarity_total"] += best_score
+        counters["hits"] += 1
+        return {
+            "response": entry.response,
+            "similarity": round(best_score, 3),
+            "cached_query": entry.query,
+            "age_seconds": round(now - entry.created_at, 1),
+        }
+
+    def store(self, query: str, response: str, category: str, version: tuple):
+        self._entries[self._next_id] = CachedResponse(query, response, category, version)
+        self._next_id += 1
+        self._stats["stores"] += 1
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self._stats["evictions"] += 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        lookups, hits = self._stats["lookups"], self._stats["hits"]
+        return {
+            "enabled": RESPONSE_CACHE_ENABLED,
+            "categories": sorted(self.categories),
+            "threshold": self.threshold,
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl_seconds": self.ttl,
+            "index_version": self._index_version,
+            "lookups": lookups,
+            "hits": hits,
+            "hit_rate": round(hits / lookups, 3) if lookups else 0.0,
+            "avg_hit_similarity": round(self._stats["similarity_total"] / hits, 3) if hits else 0.0,
+            "stores": self._stats["stores"],
+            "evictions": self._stats["evictions"],
+            "expirations": self._stats["expirations"],
+            "invalidations": self._stats["invalidations"],
+            "by_category": {
+                category: {**c, "hit_rate": round(c["hits"] / c["lookups"], 3) if c["lookups"] else 0.0}
+                for category, c in self._by_category.items()
+            },
+        }
+
+
+def split_chunks(text: str, size: int = RESPONSE_CACHE_CHUNK_CHARS) -> List[str]:
+    """Trocea un texto en fragmentos de ~`size` caracteres cortando en espacios."""
+    chunks: List[str] = []
+    start = 0
+    while start < len(text):
+        end = start + size
+        if end < len(text):
+            space = text.find(" ", end)
+            end = len(text) if space == -1 else space + 1
+        chunks.append(text[start:end])
+        start = end
+    return chunks
+
+
+async def stream_cached(text: str) -> AsyncGenerator[str, None]:
+    """Reproduce una respuesta cacheada en fragmentos, como haría el modelo."""
+    for chunk in split_chunks(text):
+        yield chunk
+        # Cede el event loop entre fragmentos para que se envíen por separado
+        await asyncio.sleep(0)
@@ -0,0 +1,166 @@
+# sumiller-service/scheduler.py
+
+# Planificador justo para la etapa de generación: deficit round robin entre
+# usuarios, con carriles de prioridad (predefinidas > streaming > batch).
+import os
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, Optional, Tuple
+
+from admission import (
+    AdmissionController, ADMISSION_GENERATION_CONCURRENCY, ADMISSION_GENERATION_QUEUE, ADMISSION_MAX_WAIT_MS
+)
+from hedging import LatencyTracker
+
+logger = logging.getLogger(__name__)
+
+# Crédito (tokens estimados de prompt) que recibe cada usuario por ronda
+SCHEDULER_QUANTUM_TOKENS = float(os.getenv("SCHEDULER_QUANTUM_TOKENS", "1500"))
+# Peticiones en cola por usuario: el resto se rechaza sin afectar a los demás
+SCHEDULER_MAX_QUEUED_PER_USER = int(os.getenv("SCHEDULER_MAX_QUEUED_PER_USER", "4"))
+SCHEDULER_TRACKED_USERS = int(os.getenv("SCHEDULER_TRACKED_USERS", "256"))
+
+# Orden estricto de servicio entre carriles
+LANES = ("predefined", "stream", "batch")
+ANONYMOUS_USER = "anonymous"
+
+
+class FairScheduler(AdmissionController):
+    """Control de admisión con cola justa por usuario.
+
+    Mismos límites que AdmissionController (llamadas en vuelo, cola total, espera
+    máxima), pero al liberar un hueco no se sirve al más antiguo: se recorren los
+    carriles por prioridad y, dentro de cada uno, los usuarios por deficit round
+    robin: en cada turno un usuario recibe `quantum` de crédito y, si le alcanza
+    para el coste de su siguiente petición (tokens estimados del prompt), se le
+    sirve. Un usuario con muchas peticiones en cola solo se retrasa a sí mismo y
+    los prompts grandes consumen más turnos que los pequeños.
+    """
+
+    def __init__(self, stage: str, max_in_flight: int, queue_size: int, max_wait_ms: float = ADMISSION_MAX_WAIT_MS,
+                 quantum: float = SCHEDULER_QUANTUM_TOKENS, max_queued_per_user: int = SCHEDULER_MAX_QUEUED_PER_USER):
+        super().__init__(stage, max_in_flight, queue_size, max_wait_ms)
+        self.quantum = quantum
+        self.max_queued_per_user = max_queued_per_user
+        self._stats["shed_user_queue_full"] = 0
+        # Por carril, usuarios activos en orden de turno con sus peticiones pendientes
+        self._lanes: Dict[str, "OrderedDict[str, Deque[Tuple[asyncio.Future, float]]]"] = {
+            lane: OrderedDict() for lane in LANES
+        }
+        self._deficit: Dict[Tuple[str, str], float] = {}
+        self._depth = 0
+        self._user_depth: Dict[str, int] = {}
+        self._lane_waits = {lane: LatencyTracker(window=500) for lane in LANES}
+        self._user_waits: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+
+    @staticmethod
+    def _ticket(ticket: Dict[str, Any]) -> Tuple[str, str, float]:
+        lane = ticket.get("lane") if ticket.get("lane") in LANES else "batch"
+        return lane, ticket.get("user_id") or ANONYMOUS_USER, max(float(ticket.get("cost", 1.0)), 1.0)
+
+    @property
+    def queue_depth(self) -> int:
+        return self._depth
+
+    def _check_ticket(self, ticket: Dict[str, Any]):
+        _, user, _ = self._ticket(ticket)
+        if self.max_queued_per_user > 0 and self._user_depth.get(user, 0) >= self.max_queued_per_user:
+            self._shed("user_queue_full")
+
+    def _enqueue(self, waiter: asyncio.Future, ticket: Dict[str, Any]):
+        lane, user, cost = self._ticket(ticket)
+        self._lanes[lane].setdefault(user, deque()).append((waiter, cost))
+        self._depth += 1
+        self._user_depth[user] = self._user_depth.get(user, 0) + 1
+
+    def _dequeued(self, lane: str, user: str):
+        self._depth -= 1
+        self._user_depth[user] -= 1
+        if not self._user_depth[user]:
+            del self._user_depth[user]
+        if not self._lanes[lane][user]:
+            # Un usuario que se queda sin peticiones pierde el crédito acumulado
+            del self._lanes[lane][user]
+            self._deficit.pop((lane, user), None)
+
+    def _discard(self, waiter: asyncio.Future, ticket: Dict[str, Any]):
+        lane, user, _ = self._ticket(ticket)
+        pending = self._lanes[lane].get(user)
+        for entry in pending or ():
+            if entry[0] is waiter:
+                pending.remove(entry)
+                self._dequeued(lane, user)
+                return
+
+    def _next_waiter(self) -> Optional[asyncio.Future]:
+        for lane in LANES:
+            users = self._lanes[lane]
+            while users:
+                user, pending = next(iter(users.items()))
+                waiter, cost = pending[0]
+                key = (lane, user)
+                if waiter.done():
+                    pending.popleft()
+                    self._dequeued(lane, user)
+                    continue
+                # Cada turno sirve como mucho una petición y pasa al siguiente usuario;
+                # sin crédito suficiente recibe el quantum de la ronda y espera su turno
+                users.move_to_end(user)
+                if self._deficit.get(key, 0.0) >= cost:
+                    self._deficit[key] -= cost
+                    pending.popleft()
+                    self._dequeued(lane, user)
+                    return waiter
+                # El crédito no se acumula más allá de una ronda (ni de la petición más cara)
+                self._deficit[key] = min(self._deficit.get(key, 0.0) + self.quantum, max(self.quantum, cost))
+        return None
+
+    def _record_wait(self, wait_ms: float, ticket: Dict[str, Any]):
+        super()._record_wait(wait_ms, ticket)
+        lane, user, _ = self._ticket(ticket)
+        self._lane_waits[lane].record(wait_ms)
+        stats = self._user_waits.pop(user, None) or {"served": 0, "waits": LatencyTracker(window=100)}
+        stats["served"] += 1
+        stats["waits"].record(wait_ms)
+        self._user_waits[user] = stats
+        while len(self._user_waits) > SCHEDULER_TRACKED_USERS:
+            self._user_waits.popitem(last=False)
+
+    def user_wait_percentile(self, user_id: Optional[str], q: float = 0.95) -> Optional[float]:
+        stats = self._user_waits.get(user_id or ANONYMOUS_USER)
+        return stats["waits"].percentile(q) if stats else None
+
+    def get_stats(self, top_users: int = 10) -> Dict[str, Any]:
+        def rounded(value: Optional[float]) -> Optional[float]:
+            return round(value, 2) if value is not None else None
+
+        # Los usuarios que más esperan, que son los que interesa vigilar
+        users = sorted(
+            self._user_waits.items(), key=lambda item: item[1]["waits"].percentile(0.95) or 0.0, reverse=True
+        )[:top_users]
+        return {
+            **super().get_stats(),
+            "quantum_tokens": self.quantum,
+            "max_queued_per_user": self.max_queued_per_user,
+            "lanes": {
+                lane: {
+                    "queued": sum(len(pending) for pending in self._lanes[lane].values()),
+                    "active_users": len(self._lanes[lane]),
+                    "wait_p95_ms": rounded(self._lane_waits[lane].percentile(0.95)),
+                }
+                for lane in LANES
+            },
+            "users": {
+                user: {
+                    "queued": self._user_depth.get(user, 0),
+                    "served": stats["served"],
+                    "wait_p50_ms": rounded(stats["waits"].percentile(0.5)),
+                    "wait_p95_ms": rounded(stats["waits"].percentile(0.95)),
+                }
+                for user, stats in users
+            },
+        }
+
+
+generation_scheduler = FairScheduler("generation", ADMISSION_GENERATION_CONCURRENCY, ADMISSION_GENERATION_QUEUE)
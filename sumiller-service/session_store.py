@@ -0,0 +1,79 @@
+# sumiller-service/session_store.py
+
+# Estado de sesión en el servidor: últimos turnos de cada conversación.
+import os
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+from cache import TTLCache
+from memory import SumillerMemory
+
+logger = logging.getLogger(__name__)
+
+# Mensajes (usuario + asistente) que se conservan por sesión
+SESSION_MAX_MESSAGES = int(os.getenv("SESSION_MAX_MESSAGES", "16"))
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", "1024"))
+SESSION_CACHE_TTL = float(os.getenv("SESSION_CACHE_TTL", "3600"))
+
+
+class SessionState:
+    """Cola de los mensajes más recientes de una sesión.
+
+    `offset` es la posición del primer mensaje guardado dentro de la sesión
+    completa; permite alinear el historial con el resumen acumulado.
+    """
+
+    def __init__(self, messages: List[Dict[str, str]], offset: int):
+        self.messages = messages
+        self.offset = offset
+
+    def append(self, role: str, content: str):
+        self.messages.append({"role": role, "content": content})
+        overflow = len(self.messages) - SESSION_MAX_MESSAGES
+        if overflow > 0:
+            del self.messages[:overflow]
+            self.offset += overflow
+
+
+class SessionStore:
+    """Caché acotada en memoria de sesiones, respaldada por la tabla `conversations`.
+
+    Si una sesión no está en memoria (reinicio, expulsión o réplica distinta)
+    se reconstruye con los últimos turnos guardados en SQLite.
+    """
+
+    def __init__(self, memory: SumillerMemory, max_size: int = SESSION_CACHE_SIZE, ttl: float = SESSION_CACHE_TTL):
+        self.memory = memory
+        self._cache = TTLCache(max_size, ttl)
+        self.db_loads = 0
+
+    async def get(self, session_id: str, user_id: Optional[str]) -> SessionState:
+        key = (user_id, session_id)
+        state = self._cache.get(key)
+        if state is None:
+            turns, total_turns = await self.memory.get_session_turns(
+                session_id, user_id, limit=(SESSION_MAX_MESSAGES + 1) // 2
+            )
+            messages: List[Dict[str, str]] = []
+            for turn in turns:
+                messages.append({"role": "user", "content": turn["query"]})
+                messages.append({"role": "assistant", "content": turn["response"]})
+            state = SessionState(messages[-SESSION_MAX_MESSAGES:], 0)
+            state.offset = total_turns * 2 - len(state.messages)
+            self.db_loads += 1
+            self._cache.set(key, state)
+        return state
+
+    def append_turn(self, session_id: Optional[str], user_id: Optional[str], query: str, response: str):
+        """Añade el turno a la sesión en memoria (si no está cargada, se leerá de SQLite)."""
+        if not session_id:
+            return
+        state = self._cache.pop((user_id, session_id))
+        if state is None:
+            return
+        state.append("user", query)
+        state.append("assistant", response)
+        self._cache.set((user_id, session_id), state)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {**self._cache.get_stats(), "db_loads": self.db_loads, "max_messages": SESSION_MAX_MESSAGES}
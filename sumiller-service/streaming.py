@@ -0,0 +1,233 @@
+# sumiller-service/streaming.py
+
+# Etapa de streaming: agrupa los fragmentos del modelo en tramas y limita el búfer.
+import os
+import time
+import asyncio
+import logging
+from typing import Any, AsyncGenerator, AsyncIterator, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Se envía una trama al acumular STREAM_FRAME_BYTES o al pasar STREAM_FRAME_MS desde el primer fragmento pendiente
+STREAM_FRAME_BYTES = int(os.getenv("STREAM_FRAME_BYTES", "64"))
+STREAM_FRAME_MS = float(os.getenv("STREAM_FRAME_MS", "30"))
+# Fragmentos que pueden esperar entre el modelo y el socket antes de dejar de leer del modelo
+STREAM_QUEUE_SIZE = int(os.getenv("STREAM_QUEUE_SIZE", "16"))
+
+_stats = {
+    "responses": 0,
+    "chunks": 0,
+    "frames": 0,
+    "bytes": 0,
+    "size_flushes": 0,
+    "time_flushes": 0,
+    "backpressure_waits": 0,
+    "max_queue_depth": 0,
+    "disconnects": 0,
+}
+
+
+class _EndOfStream:
+    def __init__(self, error: Optional[BaseException] = None):
+        self.error = error
+
+
+async def _pump(source: AsyncIterator[str], queue: asyncio.Queue):
+    """Lee del modelo hacia la cola; si la cola está llena espera (contrapresión)."""
+    try:
+        async for chunk in source:
+            if not chunk:
+                continue
+            _stats["chunks"] += 1
+            if queue.full():
+                _stats["backpressure_waits"] += 1
+            await queue.put(chunk)
+            _stats["max_queue_depth"] = max(_stats["max_queue_depth"], queue.qsize())
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        await queue.put(_EndOfStream(e))
+        return
+    await queue.put(_EndOfStream())
+
+
+async def coalesce_frames(source: AsyncIterator[str], max_bytes: int = STREAM_FRAME_BYTES,
+                          max_delay_ms: float = STREAM_FRAME_MS,
+                          queue_size: int = STREAM_QUEUE_SIZE) -> AsyncGenerator[str, None]:
+    """Agrupa los fragmentos de `source` en tramas por tamaño y por tiempo.
+
+    La primera trama sale en cuanto llega el primer fragmento para no retrasar
+    el primer byte. La lectura del modelo y el envío al cliente se desacoplan con
+    una cola acotada: si el cliente es lento, la cola se llena y se deja de leer
+    del modelo en lugar de acumular la respuesta en memoria.
+    """
+    queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+    producer = asyncio.create_task(_pump(source, queue))
+    loop = asyncio.get_running_loop()
+    max_delay = max_delay_ms / 1000
+    pending: List[str] = []
+    pending_bytes = 0
+    deadline = 0.0
+    first = True
+    getter: Optional[asyncio.Future] = None
+    frames = 0
+    completed = False
+
+    def flush() -> str:
+        nonlocal pending, pending_bytes, frames
+        frame = "".join(pending)
+        _stats["frames"] += 1
+        _stats["bytes"] += pending_bytes
+        frames += 1
+        pending, pending_bytes = [], 0
+        return frame
+
+    try:
+        while True:
+            if getter is None:
+                getter = asyncio.ensure_future(queue.get())
+            if pending:
+                # El get sigue vivo entre iteraciones: no se pierde ningún fragmento por el timeout
+                done, _ = await asyncio.wait({getter}, timeout=max(deadline - loop.time(), 0))
+                if not done:
+                    _stats["time_flushes"] += 1
+                    yield flush()
+                    continue
+            item = await getter
+            getter = None
+
+            if isinstance(item, _EndOfStream):
+                if pending:
+                    yield flush()
+                if item.error is not None:
+                    raise item.error
+                completed = True
+                break
+
+            if not pending:
+                deadline = loop.time() + max_delay
+            pending.append(item)
+            pending_bytes += len(item.encode("utf-8"))
+            if first or pending_bytes >= max_bytes:
+                if not first:
+                    _stats["size_flushes"] += 1
+                first = False
+                yield flush()
+    finally:
+        if getter is not None:
+            getter.cancel()
+        producer.cancel()
+        await asyncio.gather(producer, return_exceptions=True)
+        _stats["responses"] += 1
+        if not completed:
+            _stats["disconnects"] += 1
+        logger.debug(f"📦 Streaming: {frames} tramas")
+
+
+class SharedStream:
+    """Una generación en streaming que pueden leer varios suscriptores.
+
+    La fuente se consume en su propia tarea y los fragmentos se guardan (una
+    respuesta ocupa unos pocos KB), así que quien se suscribe tarde recibe la
+    respuesta desde el principio. Si todos los suscriptores se van antes de que
+    termine, la generación se cancela.
+    """
+
+    def __init__(self, source: AsyncIterator[str]):
+        self.chunks: List[str] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self._changed = asyncio.Event()
+        self._task = asyncio.ensure_future(self._consume(source))
+
+    async def _consume(self, source: AsyncIterator[str]):
+        try:
+            async for chunk in source:
+                self.chunks.append(chunk)
+                self._notify()
+        except asyncio.CancelledError:
+            self.error = asyncio.CancelledError()
+            raise
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+            self._notify()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def subscribe(self) -> AsyncGenerator[str, None]:
+        # Se cuenta al suscribirse, no al empezar a leer, para no cancelar la
+        # generación entre la suscripción y la primera lectura
+        self.subscribers += 1
+        return self._read()
+
+    async def _read(self) -> AsyncGenerator[str, None]:
+        index = 0
+        try:
+            while True:
+                if index < len(self.chunks):
+                    index += 1
+                    yield self.chunks[index - 1]
+                    continue
+                if self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                await self._changed.wait()
+        finally:
+            self.subscribers -= 1
+            if not self.subscribers and not self.done:
+                self._task.cancel()
+
+
+class StreamFlight:
+    """Agrupa las generaciones idénticas en curso: la primera genera y el resto se suscribe."""
+
+    def __init__(self):
+        self._inflight: Dict[Any, SharedStream] = {}
+        self._stats = {"executions": 0, "coalesced": 0, "max_subscribers": 0}
+
+    def join(self, key: Any, factory) -> Tuple[AsyncGenerator[str, None], bool]:
+        """Devuelve el stream de la generación de `key` y si se comparte con una ya en curso."""
+        shared = self._inflight.get(key)
+        coalesced = shared is not None and not shared.done
+        if coalesced:
+            self._stats["coalesced"] += 1
+        else:
+            shared = SharedStream(factory())
+            self._inflight[key] = shared
+            self._stats["executions"] += 1
+            shared._task.add_done_callback(lambda _, key=key, shared=shared: self._done(key, shared))
+        subscription = shared.subscribe()
+        self._stats["max_subscribers"] = max(self._stats["max_subscribers"], shared.subscribers)
+        return subscription, coalesced
+
+    def is_inflight(self, key: Any) -> bool:
+        shared = self._inflight.get(key)
+        return shared is not None and not shared.done
+
+    def _done(self, key: Any, shared: SharedStream):
+        if self._inflight.get(key) is shared:
+            del self._inflight[key]
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {"in_flight": len(self._inflight), **self._stats}
+
+
+def get_streaming_stats() -> Dict[str, Any]:
+    responses = _stats["responses"]
+    frames = _stats["frames"]
+    return {
+        "frame_bytes": STREAM_FRAME_BYTES,
+        "frame_ms": STREAM_FRAME_MS,
+        "queue_size": STREAM_QUEUE_SIZE,
+        **_stats,
+        "avg_frames_per_response": round(frames / responses, 2) if responses else 0.0,
+        "avg_bytes_per_frame": round(_stats["bytes"] / frames, 1) if frames else 0.0,
+        "avg_chunks_per_frame": round(_stats["chunks"] / frames, 2) if frames else 0.0,
+    }
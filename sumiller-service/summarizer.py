@@ -0,0 +1,120 @@
+# sumiller-service/summarizer.py
+
+# Resumen incremental de la conversación por sesión, fuera del camino de respuesta.
+import os
+import time
+import asyncio
+import logging
+from typing import Any, Dict, List, Optional
+
+from memory import SumillerMemory
+from prompt_registry import prompt_registry
+from usage import extract_usage, summarize_usage
+
+logger = logging.getLogger(__name__)
+
+# Mensajes más recientes que se envían siempre literalmente (no se resumen)
+SUMMARY_KEEP_MESSAGES = int(os.getenv("SUMMARY_KEEP_MESSAGES", "4"))
+# Mensajes nuevos sin resumir necesarios para lanzar una actualización
+SUMMARY_MIN_NEW_MESSAGES = int(os.getenv("SUMMARY_MIN_NEW_MESSAGES", "2"))
+SUMMARY_MAX_WORDS = int(os.getenv("SUMMARY_MAX_WORDS", "120"))
+SUMMARY_MESSAGE_MAX_CHARS = 800
+# Categoría con la que se anota el uso de Gemini de los resúmenes
+SUMMARY_USAGE_CATEGORY = "SESSION_SUMMARY"
+
+
+class ConversationSummarizer:
+    """Mantiene en SumillerMemory un resumen acumulado de cada sesión.
+
+    Tras cada turno se programa una tarea en segundo plano que incorpora al
+    resumen los mensajes que ya no caben entre los últimos SUMMARY_KEEP_MESSAGES.
+    Solo hay una actualización en curso por sesión; si llegan turnos mientras
+    tanto, se procesa el más reciente al terminar.
+    """
+
+    def __init__(self, model, memory: SumillerMemory, model_name: str = "gemini-2.0-flash"):
+        self.model = model
+        self.memory = memory
+        self.model_name = model_name
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._pending: Dict[str, tuple] = {}
+        self._stats = {"scheduled": 0, "updates": 0, "skipped": 0, "failures": 0, "update_ms_total": 0.0}
+
+    def schedule(self, session_id: Optional[str], user_id: Optional[str], messages: List[Dict[str, str]], offset: int = 0):
+        """Programa la actualización del resumen con el historial tras el turno.
+
+        `offset` es la posición de `messages[0]` dentro de la sesión completa
+        (distinto de cero cuando el historial viene del estado de sesión acotado).
+        """
+        if not session_id:
+            return
+        self._stats["scheduled"] += 1
+        self._pending[session_id] = (user_id, messages, offset)
+        if session_id not in self._tasks:
+            self._tasks[session_id] = asyncio.create_task(self._run(session_id))
+
+    async def _run(self, session_id: str):
+        try:
+            while session_id in self._pending:
+                user_id, messages, offset = self._pending.pop(session_id)
+                try:
+                    await self._update(session_id, user_id, messages, offset)
+                except Exception as e:
+                    self._stats["failures"] += 1
+                    logger.error(f"❌ Error actualizando el resumen de la sesión {session_id}: {e}")
+        finally:
+            self._tasks.pop(session_id, None)
+
+    async def _update(self, session_id: str, user_id: Optional[str], messages: List[Dict[str, str]], offset: int):
+        current = await self.memory.get_session_summary(session_id, user_id)
+        summarized = current["messages_summarized"] if current else 0
+        previous = current["summary"] if current else ""
+        if summarized > offset + len(messages):
+            # El cliente ha reiniciado el historial: se empieza un resumen nuevo
+            summarized, previous = 0, ""
+
+        # Posiciones absolutas dentro de la sesión; lo anterior a `offset` ya no está disponible
+        target = offset + len(messages) - SUMMARY_KEEP_MESSAGES
+        if target - summarized < SUMMARY_MIN_NEW_MESSAGES:
+            self._stats["skipped"] += 1
+            return
+
+        start = time.perf_counter()
+        new_messages = "\n".join(
+            f"{m['role']}: {m['content'][:SUMMARY_MESSAGE_MAX_CHARS]}" for m in messages[max(summarized - offset, 0):target - offset]
+        )
+        prompt = prompt_registry.render(
+            "resumen_conversacion.txt",
+            summary=previous or "(vacío)",
+            messages=new_messages,
+            max_words=SUMMARY_MAX_WORDS
+        )
+        response = await self.model.generate_content_async(prompt)
+        usage = extract_usage(response, prompt, response.text, self.model_name)
+        await self.memory.record_usage(user_id, SUMMARY_USAGE_CATEGORY, summarize_usage({"summary": usage}))
+        summary = response.text.strip()
+        if not summary:
+            raise ValueError("resumen vacío")
+        await self.memory.save_session_summary(session_id, user_id, summary, target)
+        self._stats["updates"] += 1
+        self._stats["update_ms_total"] += (time.perf_counter() - start) * 1000
+
+    async def close(self):
+        """Cancela las actualizaciones pendientes al apagar el servicio."""
+        self._pending.clear()
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def get_stats(self) -> Dict[str, Any]:
+        updates = self._stats["updates"]
+        return {
+            "keep_messages": SUMMARY_KEEP_MESSAGES,
+            "in_progress": len(self._tasks),
+            "scheduled": self._stats["scheduled"],
+            "updates": updates,
+            "skipped": self._stats["skipped"],
+            "failures": self._stats["failures"],
+            "avg_update_ms": round(self._stats["update_ms_total"] / updates, 2) if updates else 0.0,
+        }
@@ -0,0 +1,46 @@
+# sumiller-service/text_similarity.py
+
+# Representación vectorial ligera de textos cortos (sin modelos externos).
+import math
+import re
+import unicodedata
+from collections import Counter
+from typing import Dict
+
+_NON_ALNUM = re.compile(r"[^a-z0-9ñ ]+")
+_SPACES = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    """Minúsculas, sin tildes (conservando la ñ), sin signos y con espacios simples."""
+    text = text.lower().replace("ñ", "\0")
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(c for c in text if not unicodedata.combining(c)).replace("\0", "ñ")
+    text = _NON_ALNUM.sub(" ", text)
+    return _SPACES.sub(" ", text).strip()
+
+
+def text_vector(text: str) -> Dict[str, float]:
+    """Vector disperso normalizado con trigramas de caracteres y palabras completas.
+
+    Los trigramas toleran erratas y variaciones de género/número; las palabras
+    completas pesan más para que el vocabulario compartido domine la similitud.
+    """
+    normalized = normalize_text(text)
+    counts: Counter = Counter()
+    for word in normalized.split():
+        counts["w:" + word] += 2.0
+        padded = f" {word} "
+        for i in range(len(padded) - 2):
+            counts[padded[i:i + 3]] += 1.0
+    norm = math.sqrt(sum(v * v for v in counts.values()))
+    if not norm:
+        return {}
+    return {k: v / norm for k, v in counts.items()}
+
+
+def cosine(a: Dict[str, float], b: Dict[str, float]) -> float:
+    """Similitud coseno entre dos vectores ya normalizados."""
+    if len(a) > len(b):
+        a, b = b, a
+    return sum(v * b.get(k, 0.0) for k, v in a.items())
@@ -0,0 +1,103 @@
+# sumiller-service/usage.py
+
+# Contabilidad de tokens y coste de cada llamada a Gemini.
+import os
+import json
+import logging
+from typing import Any, Dict, Optional
+
+from prompt_builder import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+# Precio en USD por millón de tokens (entrada, salida). Se puede sobrescribir con
+# LLM_PRICES_PER_MTOK='{"gemini-2.0-flash": [0.10, 0.40]}'
+DEFAULT_PRICES_PER_MTOK: Dict[str, tuple] = {
+    "gemini-2.0-flash": (0.10, 0.40),
+    "gemini-2.0-flash-lite": (0.075, 0.30),
+}
+
+
+def _load_prices() -> Dict[str, tuple]:
+    prices = dict(DEFAULT_PRICES_PER_MTOK)
+    overrides = os.getenv("LLM_PRICES_PER_MTOK")
+    if overrides:
+        try:
+            prices.update({model: (float(p[0]), float(p[1])) for model, p in json.loads(overrides).items()})
+        except (ValueError, TypeError, IndexError, AttributeError) as e:
+            logger.error(f"❌ LLM_PRICES_PER_MTOK no es válido, usando precios por defecto: {e}")
+    return prices
+
+
+LLM_PRICES_PER_MTOK = _load_prices()
+
+
+def estimate_cost(model: str, prompt_tokens: float, output_tokens: float) -> float:
+    input_price, output_price = LLM_PRICES_PER_MTOK.get(model, (0.0, 0.0))
+    return (prompt_tokens * input_price + output_tokens * output_price) / 1_000_000
+
+
+def extract_usage(response: Any, prompt: str, output_text: str, model: str) -> Dict[str, Any]:
+    """Tokens de una llamada según `usage_metadata` de Vertex AI.
+
+    Si la respuesta no los trae (modelo local, stream cortado antes del último
+    fragmento) se estiman a partir del texto y se marca como `estimated`.
+    """
+    metadata = getattr(response, "usage_metadata", None)
+    prompt_tokens = getattr(metadata, "prompt_token_count", None) if metadata is not None else None
+    output_tokens = getattr(metadata, "candidates_token_count", None) if metadata is not None else None
+    estimated = False
+    if not prompt_tokens:
+        prompt_tokens = estimate_tokens(prompt)
+        estimated = True
+    if output_tokens is None:
+        output_tokens = estimate_tokens(output_text)
+        estimated = True
+    return {
+        "model": model,
+        "calls": 1,
+        "prompt_tokens": int(prompt_tokens),
+        "output_tokens": int(output_tokens),
+        "cost_usd": estimate_cost(model, prompt_tokens, output_tokens),
+        "estimated": estimated,
+    }
+
+
+def record_usage(trace: Optional[Dict[str, Any]], stage: str, usage: Dict[str, Any], share: float = 1.0):
+    """Suma el uso de una llamada a la traza de la petición.
+
+    `share` reparte una llamada compartida (un lote de clasificación) entre las
+    peticiones que la originaron.
+    """
+    if trace is None:
+        return
+    entry = trace.setdefault("usage", {}).setdefault(stage, {
+        "model": usage["model"], "calls": 0.0, "prompt_tokens": 0.0, "output_tokens": 0.0,
+        "cost_usd": 0.0, "estimated": False
+    })
+    for field in ("calls", "prompt_tokens", "output_tokens", "cost_usd"):
+        entry[field] += usage[field] * share
+    entry["estimated"] = entry["estimated"] or usage["estimated"]
+
+
+def summarize_usage(*stages: Optional[Dict[str, Dict[str, Any]]]) -> Dict[str, Any]:
+    """Totales de la petición a partir del uso por etapa de una o varias trazas."""
+    by_stage: Dict[str, Dict[str, Any]] = {}
+    for usage in stages:
+        for stage, entry in (usage or {}).items():
+            by_stage[stage] = {
+                "model": entry["model"],
+                "calls": round(entry["calls"], 3),
+                "prompt_tokens": round(entry["prompt_tokens"]),
+                "output_tokens": round(entry["output_tokens"]),
+                "cost_usd": round(entry["cost_usd"], 8),
+                "estimated": entry["estimated"],
+            }
+    return {
+        "llm_calls": round(sum(e["calls"] for e in by_stage.values()), 3),
+        "prompt_tokens": sum(e["prompt_tokens"] for e in by_stage.values()),
+        "output_tokens": sum(e["output_tokens"] for e in by_stage.values()),
+        "cost_usd": round(sum(e["cost_usd"] for e in by_stage.values()), 8),
+        "estimated": any(e["estimated"] for e in by_stage.values()),
+        "by_stage": by_stage,
+    }
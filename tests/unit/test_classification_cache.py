@@ -0,0 +1,129 @@
+"""
+Tests unitarios para la caché de clasificaciones (TTL + LRU)
+"""
+import asyncio
+import sys
+import os
+
+import pytest
+
+# Añadir el directorio del sumiller service al path
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../sumiller-service'))
+
+import cache
+import query_filter
+from cache import TTLCache, SingleFlight
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(cache.time, "monotonic", fake)
+    return fake
+
+
+class CountingFilter:
+    """Sustituye al filtro con Gemini: cuenta las llamadas y devuelve un origen fijo."""
+
+    def __init__(self, source="llm", delay=0.0):
+        self.source = source
+        self.delay = delay
+        self.calls = []
+
+    async def _classify(self, user_query, has_history, trace=None):
+        self.calls.append((user_query, has_history))
+        await asyncio.sleep(self.delay)
+        return {"category": "WINE_THEORY", "confidence": 0.9, "reasoning": "test"}, self.source
+
+
+@pytest.fixture
+def classifier(monkeypatch):
+    stub = CountingFilter()
+    monkeypatch.setattr(query_filter, "_query_filter", stub)
+    monkeypatch.setattr(query_filter, "_classification_cache", TTLCache(8, 60))
+    monkeypatch.setattr(query_filter, "_classification_flight", SingleFlight())
+    return stub
+
+
+def _classify(query, has_history=False):
+    trace = {}
+    classification = asyncio.run(query_filter.filter_and_classify_query(query, has_history, trace))
+    return classification, trace["classification_source"]
+
+
+class TestTTLCache:
+    def test_entries_expire_after_ttl(self, clock):
+        ttl_cache = TTLCache(max_size=4, ttl=10)
+        ttl_cache.set("k", "v")
+        clock.now += 9
+        assert ttl_cache.get("k") == "v"
+        clock.now += 1
+        assert ttl_cache.get("k") is None
+        assert ttl_cache.get_stats()["expirations"] == 1
+
+    def test_evicts_least_recently_used(self, clock):
+        ttl_cache = TTLCache(max_size=2, ttl=10)
+        ttl_cache.set("a", 1)
+        ttl_cache.set("b", 2)
+        ttl_cache.get("a")
+        ttl_cache.set("c", 3)
+        assert ttl_cache.get("b") is None
+        assert ttl_cache.get("a") == 1 and ttl_cache.get("c") == 3
+        assert ttl_cache.get_stats()["evictions"] == 1
+
+
+class TestClassificationCache:
+    def test_normalized_query_shares_entry(self, classifier):
+        _, source = _classify("¿Qué es la crianza?")
+        assert source == "llm"
+        classification, source = _classify("que es la CRIANZA")
+        assert source == "cache"
+        assert classification["should_use_rag"] is True
+        assert len(classifier.calls) == 1
+
+    def test_history_state_is_part_of_the_key(self, classifier):
+        _classify("¿Qué es la crianza?")
+        _, source = _classify("¿Qué es la crianza?", has_history=True)
+        assert source == "llm"
+        assert len(classifier.calls) == 2
+
+    def test_fallback_is_not_cached(self, classifier):
+        classifier.source = "fallback"
+        _classify("¿Qué es la crianza?")
+        _, source = _classify("¿Qué es la crianza?")
+        assert source == "fallback"
+        assert len(classifier.calls) == 2
+
+    def test_concurrent_misses_share_one_call(self, classifier):
+        classifier.delay = 0.01
+
+        async def scenario():
+            traces = [{}, {}, {}]
+            await asyncio.gather(*(
+                query_filter.filter_and_classify_query("¿Qué es la crianza?", False, trace) for trace in traces
+            ))
+            return [trace["classification_source"] for trace in traces]
+
+        sources = asyncio.run(scenario())
+        assert sorted(sources) == ["llm", "single_flight", "single_flight"]
+        assert len(classifier.calls) == 1
+
+    def test_returned_classification_is_a_copy(self, classifier):
+        classification, _ = _classify("¿Qué es la crianza?")
+        classification["category"] = "OFF_TOPIC"
+        assert _classify("¿Qué es la crianza?")[0]["category"] == "WINE_THEORY"
+
+    def test_prompt_reload_clears_the_cache(self, classifier):
+        _classify("¿Qué es la crianza?")
+        query_filter._on_prompts_reloaded(["sumiller_clasificacion.txt"])
+        _, source = _classify("¿Qué es la crianza?")
+        assert source == "llm"
+        assert len(classifier.calls) == 2
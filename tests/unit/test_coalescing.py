@@ -0,0 +1,205 @@
+"""
+Tests unitarios para la agrupación de peticiones idénticas en curso
+"""
+import asyncio
+import sys
+import os
+
+import pytest
+
+# Añadir el directorio del sumiller service al path
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../sumiller-service'))
+
+from cache import SingleFlight
+from streaming import StreamFlight
+
+
+@pytest.fixture
+def main(monkeypatch, tmp_path):
+    # main crea ./database al importarse
+    monkeypatch.chdir(tmp_path)
+    import main as sumiller_main
+    monkeypatch.setattr(sumiller_main, "COALESCE_REQUESTS", True)
+    return sumiller_main
+
+
+def _prepared(category="WINE_THEORY", user_context=None):
+    return {"category": category, "user_context": user_context or {}, "rag_metadata": {}, "timings": {}}
+
+
+class TestGenerationKey:
+    def test_shared_generation_is_coalesced(self, main):
+        request = main.QueryRequest(query="¿Qué es la crianza?", user_id="u1")
+        other = main.QueryRequest(query="¿que es la CRIANZA", user_id="u2")
+        key = main._generation_key(request, _prepared())
+        assert key is not None
+        assert main._generation_key(other, _prepared()) == key
+
+    def test_personal_category_is_not_coalesced(self, main):
+        request = main.QueryRequest(query="Recomiéndame un tinto", user_id="u1")
+        assert main._generation_key(request, _prepared("WINE_SEARCH")) is None
+
+    def test_generation_with_user_context_is_not_coalesced(self, main):
+        """Un prompt con preferencias o favoritos del usuario no se comparte con otros."""
+        request = main.QueryRequest(query="¿Qué es la crianza?", user_id="u1")
+        prepared = _prepared(user_context={"favorite_wines": ["Viña Ardanza"]})
+        assert main._generation_key(request, prepared) is None
+
+    def test_generation_with_history_is_not_coalesced(self, main):
+        request = main.QueryRequest(
+            query="¿Qué es la crianza?", user_id="u1",
+            conversation_history=[{"role": "user", "content": "hola"}]
+        )
+        assert main._generation_key(request, _prepared()) is None
+
+
+async def _chunks(parts, started=None, delay=0.01):
+    if started is not None:
+        started.append(True)
+    for part in parts:
+        await asyncio.sleep(delay)
+        yield part
+
+
+class TestSingleFlight:
+    def test_concurrent_calls_share_one_execution(self):
+        flight = SingleFlight()
+        calls = []
+
+        async def fetch():
+            calls.append(True)
+            await asyncio.sleep(0.01)
+            return "resultado"
+
+        async def scenario():
+            return await asyncio.gather(*(flight.do("k", fetch) for _ in range(3)))
+
+        assert asyncio.run(scenario()) == ["resultado"] * 3
+        assert len(calls) == 1
+        assert flight.get_stats()["deduplicated"] == 2
+
+    def test_cancelled_waiter_does_not_cancel_the_others(self):
+        flight = SingleFlight(cancel_when_abandoned=True)
+
+        async def fetch():
+            await asyncio.sleep(0.02)
+            return "resultado"
+
+        async def scenario():
+            first = asyncio.create_task(flight.do("k", fetch))
+            second = asyncio.create_task(flight.do("k", fetch))
+            await asyncio.sleep(0)
+            first.cancel()
+            return await second
+
+        assert asyncio.run(scenario()) == "resultado"
+
+    def test_abandoned_execution_is_cancelled(self):
+        flight = SingleFlight(cancel_when_abandoned=True)
+        cancelled = []
+
+        async def fetch():
+            try:
+                await asyncio.sleep(1)
+            except asyncio.CancelledError:
+                cancelled.append(True)
+                raise
+
+        async def scenario():
+            waiter = asyncio.create_task(flight.do("k", fetch))
+            await asyncio.sleep(0)
+            waiter.cancel()
+            await asyncio.gather(waiter, return_exceptions=True)
+            await asyncio.sleep(0)
+
+        asyncio.run(scenario())
+        assert cancelled == [True]
+        assert not flight.is_inflight("k")
+
+
+class TestStreamFlight:
+    def test_late_subscriber_gets_every_chunk_in_order(self):
+        """Quien se une a una generación en curso la recibe completa desde el principio."""
+        flight = StreamFlight()
+        parts = ["La ", "crianza ", "es ", "el ", "envejecimiento."]
+        started = []
+
+        async def scenario():
+            leader, coalesced = flight.join("k", lambda: _chunks(parts, started))
+            assert not coalesced
+            first = await leader.__anext__()
+            await asyncio.sleep(0.025)
+            follower, coalesced = flight.join("k", lambda: _chunks(parts, started))
+            assert coalesced and flight.is_inflight("k")
+            rest = [chunk async for chunk in leader]
+            return [first, *rest], [chunk async for chunk in follower]
+
+        leader_chunks, follower_chunks = asyncio.run(scenario())
+        assert leader_chunks == parts
+        assert follower_chunks == parts
+        assert len(started) == 1
+        assert flight.get_stats()["executions"] == 1
+
+    def test_finished_generation_is_not_joined(self):
+        flight = StreamFlight()
+
+        async def scenario():
+            chunks, _ = flight.join("k", lambda: _chunks(["a", "b"]))
+            assert [chunk async for chunk in chunks] == ["a", "b"]
+            await asyncio.sleep(0)
+            assert not flight.is_inflight("k")
+            _, coalesced = flight.join("k", lambda: _chunks(["c"]))
+            return coalesced
+
+        assert asyncio.run(scenario()) is False
+        assert flight.get_stats()["executions"] == 2
+
+    def test_error_reaches_every_subscriber(self):
+        flight = StreamFlight()
+
+        async def failing():
+            yield "a"
+            await asyncio.sleep(0.01)
+            raise RuntimeError("fallo del modelo")
+
+        async def read(chunks):
+            received = []
+            with pytest.raises(RuntimeError):
+                async for chunk in chunks:
+                    received.append(chunk)
+            return received
+
+        async def scenario():
+            first, _ = flight.join("k", failing)
+            second, coalesced = flight.join("k", failing)
+            assert coalesced
+            return await asyncio.gather(read(first), read(second))
+
+        assert asyncio.run(scenario()) == [["a"], ["a"]]
+
+    def test_generation_cancelled_when_every_subscriber_leaves(self):
+        flight = StreamFlight()
+        cancelled = []
+
+        async def slow():
+            try:
+                yield "a"
+                await asyncio.sleep(1)
+                yield "b"
+            except asyncio.CancelledError:
+                cancelled.append(True)
+                raise
+
+        async def scenario():
+            first, _ = flight.join("k", slow)
+            second, _ = flight.join("k", slow)
+            assert await first.__anext__() == "a"
+            assert await second.__anext__() == "a"
+            await first.aclose()
+            assert not cancelled
+            await second.aclose()
+            await asyncio.sleep(0)
+
+        asyncio.run(scenario())
+        assert cancelled == [True]
+        assert not flight.is_inflight("k")
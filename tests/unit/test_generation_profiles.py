@@ -0,0 +1,90 @@
+"""
+Tests unitarios para los perfiles de generación por categoría y el pool de respuestas
+"""
+import asyncio
+import sys
+import os
+
+import pytest
+
+# Añadir el directorio del sumiller service al path
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../sumiller-service'))
+
+import llm
+from generation_profiles import BASELINE_MODEL, BASELINE_PROFILE, GenerationProfiles
+
+
+@pytest.fixture
+def profiles_from_env(monkeypatch):
+    def build(overrides=None, rollout=1.0):
+        if overrides is None:
+            monkeypatch.delenv("GENERATION_PROFILES", raising=False)
+        else:
+            monkeypatch.setenv("GENERATION_PROFILES", overrides)
+        return GenerationProfiles(lambda name: f"modelo:{name}", rollout=rollout)
+    return build
+
+
+class TestProfileResolution:
+    def test_categories_inherit_from_default(self, profiles_from_env):
+        profiles = profiles_from_env()
+        theory = profiles.select("WINE_THEORY")
+        assert (theory.model, theory.max_output_tokens, theory.temperature) == (BASELINE_MODEL, 600, 0.4)
+        assert profiles.select("OFF_TOPIC").model == "gemini-2.0-flash-lite"
+        assert profiles.select("DESCONOCIDA") is profiles.profiles["DEFAULT"]
+
+    def test_env_override_is_merged(self, profiles_from_env):
+        profiles = profiles_from_env('{"WINE_THEORY": {"max_output_tokens": 400}}')
+        theory = profiles.select("WINE_THEORY")
+        assert theory.max_output_tokens == 400
+        assert theory.temperature == 0.4
+
+    def test_invalid_json_uses_defaults(self, profiles_from_env):
+        profiles = profiles_from_env("no es json")
+        assert profiles.select("WINE_THEORY").max_output_tokens == 600
+
+    def test_invalid_profile_falls_back_to_default(self, profiles_from_env):
+        profiles = profiles_from_env('{"WINE_THEORY": {"top_k": 3}}')
+        assert profiles.select("WINE_THEORY") is profiles.profiles["DEFAULT"]
+
+    def test_rollout_zero_uses_the_baseline(self, profiles_from_env):
+        profiles = profiles_from_env(rollout=0.0)
+        assert profiles.select("WINE_THEORY") is BASELINE_PROFILE
+        assert BASELINE_PROFILE.request_kwargs() == {}
+
+    def test_one_client_per_model_name(self, profiles_from_env):
+        profiles = profiles_from_env()
+        assert profiles.model(profiles.select("WINE_THEORY")) is profiles.model(profiles.select("WINE_SEARCH"))
+        assert profiles.model(profiles.select("OFF_TOPIC")) == "modelo:gemini-2.0-flash-lite"
+
+    def test_request_kwargs_are_built_once(self, profiles_from_env, monkeypatch):
+        monkeypatch.setattr(llm, "USE_FAKE_LLM", True)
+        profiles = profiles_from_env()
+        theory = profiles.select("WINE_THEORY")
+        assert not theory.prepared
+        kwargs = asyncio.run(profiles.request_kwargs(theory))
+        assert theory.prepared
+        assert kwargs == {"generation_config": {"max_output_tokens": 600, "temperature": 0.4}}
+        assert asyncio.run(profiles.request_kwargs(theory)) is kwargs
+        profiles.prepare()
+        assert all(profile.prepared for profile in profiles.profiles.values())
+
+
+class TestResponsePool:
+    def test_pool_is_off_by_default(self, profiles_from_env):
+        """Sin activarlo en el perfil, OFF_TOPIC se genera en vivo."""
+        profiles = profiles_from_env()
+        assert profiles.pooled_response("OFF_TOPIC", "¿quién ganó el partido de fútbol?") is None
+        assert not profiles.select("OFF_TOPIC").response_pool
+
+    def test_pool_is_opt_in_per_profile(self, profiles_from_env):
+        profiles = profiles_from_env('{"OFF_TOPIC": {"response_pool": true}}')
+        response = profiles.pooled_response("OFF_TOPIC", "¿quién ganó el partido de fútbol?")
+        assert "partido" in response
+        assert profiles.pooled_response("WINE_THEORY", "¿qué es la crianza?") is None
+        assert profiles.get_stats()["response_pool"]["served"] == 1
+
+    def test_unmatched_topic_gets_a_generic_answer(self, profiles_from_env):
+        profiles = profiles_from_env('{"OFF_TOPIC": {"response_pool": true}}')
+        response = profiles.pooled_response("OFF_TOPIC", "xyzzy")
+        assert response in profiles.pool._generic
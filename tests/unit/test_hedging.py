@@ -0,0 +1,200 @@
+"""
+Tests unitarios para el hedging de llamadas a Gemini (sin conexión, con modelo falso)
+"""
+import asyncio
+import sys
+import os
+
+import pytest
+
+# Añadir el directorio del sumiller service al path
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../sumiller-service'))
+
+from hedging import Hedger, LatencyTracker
+from admission import AdmissionController
+from fake_model import FakeGenerativeModel
+
+
+def _warm_up(hedger, latency_ms=10.0, samples=20):
+    for _ in range(samples):
+        hedger.latencies.record(latency_ms)
+        hedger._recent_hedges.append(False)
+
+
+class SlowThenFast:
+    """Primera llamada lenta, las siguientes rápidas."""
+
+    def __init__(self, slow=0.5, fast=0.01):
+        self.slow = slow
+        self.fast = fast
+        self.started = 0
+        self.cancelled = 0
+
+    async def __call__(self):
+        self.started += 1
+        delay = self.slow if self.started == 1 else self.fast
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        return f"llamada {self.started}"
+
+
+class TestLatencyTracker:
+    def test_percentile(self):
+        tracker = LatencyTracker(window=100)
+        for value in range(1, 101):
+            tracker.record(float(value))
+        assert tracker.percentile(0.95) == 95.0
+        assert tracker.percentile(0.5) == 50.0
+
+    def test_empty(self):
+        assert LatencyTracker().percentile(0.95) is None
+
+
+class TestHedger:
+    def test_no_hedge_without_samples(self):
+        """Sin muestras suficientes no se estima el p95 ni se duplica la llamada."""
+        hedger = Hedger("test", enabled=True, min_samples=20, min_delay_ms=1)
+        factory = SlowThenFast(slow=0.05)
+        result = asyncio.run(hedger.call(factory))
+        assert result == "llamada 1"
+        assert factory.started == 1
+        assert hedger.get_stats()["hedges_fired"] == 0
+
+    def test_disabled(self):
+        hedger = Hedger("test", enabled=False, min_samples=1, min_delay_ms=1)
+        _warm_up(hedger)
+        factory = SlowThenFast(slow=0.05)
+        asyncio.run(hedger.call(factory))
+        assert factory.started == 1
+
+    def test_hedge_wins_and_loser_cancelled(self):
+        """Una llamada más lenta que el p95 lanza una copia; gana la copia y se cancela la original."""
+        hedger = Hedger("test", enabled=True, max_rate=0.5, min_samples=20, min_delay_ms=1)
+        _warm_up(hedger, latency_ms=20.0)
+        factory = SlowThenFast(slow=1.0, fast=0.01)
+
+        result = asyncio.run(hedger.call(factory))
+
+        assert result == "llamada 2"
+        assert factory.started == 2
+        assert factory.cancelled == 1
+        stats = hedger.get_stats()
+        assert stats["hedges_fired"] == 1
+        assert stats["hedges_won"] == 1
+        assert stats["losers_cancelled"] == 1
+
+    def test_hedge_rate_cap(self):
+        """Con el límite de ritmo agotado no se lanzan más copias."""
+        hedger = Hedger("test", enabled=True, max_rate=0.1, min_samples=20, min_delay_ms=1)
+        _warm_up(hedger, latency_ms=5.0)
+        hedger._recent_hedges.extend([True] * 5)
+        factory = SlowThenFast(slow=0.05)
+
+        asyncio.run(hedger.call(factory))
+
+        assert factory.started == 1
+        assert hedger.get_stats()["hedges_skipped_rate"] == 1
+
+    def test_error_propagates_when_all_fail(self):
+        hedger = Hedger("test", enabled=True, min_samples=1)
+
+        async def failing():
+            raise RuntimeError("fallo")
+
+        with pytest.raises(RuntimeError):
+            asyncio.run(hedger.call(failing))
+        assert hedger.get_stats()["errors"] == 1
+
+    def test_discard_closes_finished_loser(self):
+        """Si las dos llamadas terminan a la vez, el resultado perdedor se entrega a discard."""
+        hedger = Hedger("test", enabled=True, max_rate=1.0, min_samples=20, min_delay_ms=1)
+        _warm_up(hedger, latency_ms=5.0)
+        discarded = []
+
+        async def scenario():
+            started = []
+
+            async def factory():
+                started.append(len(started))
+                # Ambas terminan en el mismo ciclo del event loop
+                await asyncio.sleep(0.05 if len(started) == 1 else 0.045)
+                return len(started)
+
+            async def discard(result):
+                discarded.append(result)
+
+            return await hedger.call(factory, discard=discard)
+
+        asyncio.run(scenario())
+        assert hedger.get_stats()["hedges_fired"] == 1
+        assert len(discarded) <= 1
+
+    def test_hedge_skipped_without_free_slot(self):
+        """La copia no espera en la cola: sin hueco libre no se lanza."""
+        hedger = Hedger("test", enabled=True, max_rate=1.0, min_samples=20, min_delay_ms=1)
+        _warm_up(hedger, latency_ms=5.0)
+        admission = AdmissionController("test", max_in_flight=1, queue_size=4)
+        factory = SlowThenFast(slow=0.05)
+
+        async def scenario():
+            async with admission.slot():
+                return await hedger.call(factory, admission=admission)
+
+        assert asyncio.run(scenario()) == "llamada 1"
+        assert factory.started == 1
+        assert hedger.get_stats()["hedges_skipped_admission"] == 1
+        assert admission.in_flight == 0
+
+    def test_hedge_holds_its_own_slot(self):
+        """La copia ocupa su propio hueco mientras dura y lo libera al terminar."""
+        hedger = Hedger("test", enabled=True, max_rate=1.0, min_samples=20, min_delay_ms=1)
+        _warm_up(hedger, latency_ms=5.0)
+        admission = AdmissionController("test", max_in_flight=2, queue_size=4)
+        in_flight = []
+
+        async def factory():
+            in_flight.append(admission.in_flight)
+            await asyncio.sleep(0.5 if len(in_flight) == 1 else 0.01)
+            return len(in_flight)
+
+        async def scenario():
+            async with admission.slot():
+                result = await hedger.call(factory, admission=admission)
+                assert admission.in_flight == 1
+                return result
+
+        assert asyncio.run(scenario()) == 2
+        assert in_flight == [1, 2]
+        assert admission.in_flight == 0
+        assert hedger.get_stats()["hedges_fired"] == 1
+
+
+class TestFakeModelTailLatency:
+    def test_hedging_cuts_tail_latency(self):
+        """Con una distribución de cola pesada, el hedging reduce el p99 observado."""
+        def run(enabled):
+            model = FakeGenerativeModel(latency_ms=10, jitter_ms=2, tail_ms=300, tail_probability=0.03, seed=7)
+            hedger = Hedger("test", enabled=enabled, max_rate=0.3, min_samples=10, min_delay_ms=1)
+            observed = LatencyTracker(window=1000)
+
+            async def scenario():
+                loop = asyncio.get_running_loop()
+                for _ in range(200):
+                    start = loop.time()
+                    await hedger.call(lambda: model.generate_content_async("¿Qué vino con paella?"))
+                    observed.record((loop.time() - start) * 1000)
+
+            asyncio.run(scenario())
+            return observed.percentile(0.99), hedger.get_stats(), model.calls
+
+        p99_plain, _, calls_plain = run(enabled=False)
+        p99_hedged, stats, calls_hedged = run(enabled=True)
+
+        assert p99_plain > 250
+        assert p99_hedged < p99_plain / 2
+        assert stats["hedges_won"] > 0
+        assert stats["hedge_rate"] <= 0.3
+        assert calls_hedged > calls_plain
@@ -0,0 +1,94 @@
+"""
+Tests unitarios para la creación perezosa y compartida de los clientes de Gemini
+"""
+import asyncio
+import sys
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+# Añadir el directorio del sumiller service al path
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../sumiller-service'))
+
+import llm
+from fake_model import FakeGenerativeModel
+
+
+class SlowFakeModel(FakeGenerativeModel):
+    """Modelo falso cuya construcción tarda, para abrir la ventana de carrera."""
+
+    instances = 0
+
+    @classmethod
+    def from_env(cls):
+        time.sleep(0.05)
+        cls.instances += 1
+        return cls(latency_ms=0, jitter_ms=0, tail_probability=0, text="Respuesta")
+
+
+@pytest.fixture(autouse=True)
+def fresh_llm(monkeypatch):
+    SlowFakeModel.instances = 0
+    monkeypatch.setattr(llm, "USE_FAKE_LLM", True)
+    monkeypatch.setattr(llm, "FakeGenerativeModel", SlowFakeModel)
+    monkeypatch.setattr(llm, "_models", {})
+    monkeypatch.setattr(llm, "_fake_model", None)
+    monkeypatch.setattr(llm, "_stats", {"vertex_init_ms": None, "models_created": 0})
+
+
+class TestGetModel:
+    def test_model_is_created_on_first_use(self):
+        assert llm.get_llm_stats()["models"] == []
+        model = llm.get_model("gemini-2.0-flash")
+        assert llm.get_model("gemini-2.0-flash") is model
+        assert llm.get_llm_stats()["models_created"] == 1
+
+    def test_concurrent_callers_share_one_model(self):
+        """El calentamiento en un hilo y las peticiones a la vez no crean clientes duplicados."""
+        barrier = threading.Barrier(8)
+
+        def get():
+            barrier.wait()
+            return llm.get_model("gemini-2.0-flash")
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            models = list(pool.map(lambda _: get(), range(8)))
+
+        assert all(model is models[0] for model in models)
+        assert SlowFakeModel.instances == 1
+        assert llm.get_llm_stats()["models_created"] == 1
+
+    def test_fake_mode_shares_one_model_across_names(self):
+        assert llm.get_model("gemini-2.0-flash") is llm.get_model("gemini-2.0-flash-lite")
+        assert SlowFakeModel.instances == 1
+        stats = llm.get_llm_stats()
+        assert stats["models"] == ["gemini-2.0-flash", "gemini-2.0-flash-lite"]
+        assert stats["fake"] is True and stats["vertex_init_ms"] is None
+
+    def test_warm_up_creates_the_requested_models(self):
+        assert llm.warm_up("gemini-2.0-flash", "gemini-2.0-flash-lite") >= 0
+        assert llm.get_llm_stats()["models_created"] == 2
+
+
+class TestLazyModel:
+    def test_client_is_not_created_until_the_first_call(self):
+        lazy = llm.LazyModel("gemini-2.0-flash")
+        assert llm.get_llm_stats()["models_created"] == 0
+
+        response = asyncio.run(lazy.generate_content_async("hola"))
+
+        assert response.text == "Respuesta"
+        assert llm.get_llm_stats()["models"] == ["gemini-2.0-flash"]
+
+    def test_concurrent_first_calls_create_one_client(self):
+        lazy = llm.LazyModel("gemini-2.0-flash")
+
+        async def scenario():
+            return await asyncio.gather(*(lazy.generate_content_async("hola") for _ in range(5)))
+
+        assert len(asyncio.run(scenario())) == 5
+        assert SlowFakeModel.instances == 1
+        assert llm.get_llm_stats()["models_created"] == 1
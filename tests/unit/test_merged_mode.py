@@ -0,0 +1,101 @@
+"""
+Tests unitarios para el modo unificado (clasificación + respuesta en una llamada) con el modelo falso
+"""
+import sys
+import os
+
+import pytest
+from fastapi.testclient import TestClient
+
+# Añadir el directorio del sumiller service al path
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../sumiller-service'))
+
+import llm
+import query_filter
+from cache import TTLCache
+from fake_model import FakeGenerativeModel
+from response_cache import SemanticResponseCache
+
+ANSWER = "El terroir es el conjunto de suelo, clima y manos que da carácter a un vino."
+
+
+@pytest.fixture
+def fake_llm(monkeypatch):
+    model = FakeGenerativeModel(latency_ms=0, jitter_ms=0, tail_probability=0, text=ANSWER)
+    monkeypatch.setattr(llm, "USE_FAKE_LLM", True)
+    monkeypatch.setattr(llm, "_models", {})
+    monkeypatch.setattr(llm, "_fake_model", model)
+    return model
+
+
+@pytest.fixture
+def main(monkeypatch, tmp_path, fake_llm):
+    # main crea ./database al importarse
+    monkeypatch.chdir(tmp_path)
+    import main as sumiller_main
+    monkeypatch.setattr(sumiller_main.memory, "db_path", tmp_path / "sumiller.db")
+    monkeypatch.setattr(sumiller_main, "LLM_WARMUP", False)
+    monkeypatch.setattr(sumiller_main, "SEARCH_SERVICE_URL", None)
+    monkeypatch.setattr(sumiller_main, "MERGED_CLASSIFY_ANSWER", True)
+    monkeypatch.setattr(sumiller_main, "response_cache", SemanticResponseCache())
+    monkeypatch.setattr(sumiller_main, "_pipeline_stats", {
+        mode: {"requests": 0, "llm_calls": 0, "total_ms": 0.0, "second_calls": 0, "parse_failures": 0}
+        for mode in ("two_stage", "merged")
+    })
+    # Que la clasificación no se resuelva sin Gemini
+    monkeypatch.setattr(query_filter, "LOCAL_CLASSIFIER_ENABLED", False)
+    monkeypatch.setattr(query_filter, "_classification_cache", TTLCache(8, 60))
+    return sumiller_main
+
+
+@pytest.fixture
+def client(main):
+    with TestClient(main.app) as test_client:
+        yield test_client
+
+
+class TestParseMergedResponse:
+    def test_header_and_body(self, main):
+        header, body = main.parse_merged_response('{"category": "WINE_THEORY", "confidence": 0.9}\n---\nRespuesta')
+        assert header["category"] == "WINE_THEORY"
+        assert body == "Respuesta"
+
+    def test_unreadable_header(self, main):
+        assert main.parse_merged_response("Sin cabecera")[0] is None
+        assert main.parse_merged_response('{"category": "WINE_THEORY"}\n---\nFalta la confianza')[0] is None
+
+
+class TestMergedMode:
+    def test_query_is_answered_with_a_single_call(self, main, client, fake_llm):
+        response = client.post("/query", json={"query": "¿Qué es el terroir?", "user_id": "u1"})
+        assert response.status_code == 200
+        body = response.json()
+        assert body["response"] == ANSWER
+        assert body["metadata"]["response_source"] == "vertex_ai"
+        assert body["metadata"]["classification"]["category"] == "WINE_THEORY"
+        assert body["metadata"]["stage_timings"]["classification_source"] == "merged"
+        assert fake_llm.calls == 1
+
+        stats = main.get_pipeline_stats()["merged"]
+        assert stats["requests"] == 1
+        assert stats["llm_calls"] == 1
+        assert stats["second_calls"] == 0
+
+    def test_classification_is_remembered_for_the_next_request(self, main, client, fake_llm):
+        client.post("/query", json={"query": "¿Qué es el terroir?", "user_id": "u1"})
+        client.post("/query", json={"query": "¿Qué es el terroir?", "user_id": "u2"})
+        # La segunda clasificación sale de la caché: ya no se usa el prompt unificado
+        assert main.get_pipeline_stats()["merged"]["requests"] == 2
+        assert main.get_pipeline_stats()["merged"]["llm_calls"] == 2
+
+    def test_stream_is_recorded_as_two_stage(self, main, client, fake_llm):
+        """/query/stream no usa el modo unificado, pero también entra en la comparativa."""
+        response = client.post("/query/stream", json={"query": "¿Qué es el terroir?", "user_id": "u1"})
+        assert response.status_code == 200
+        assert response.text.strip() == ANSWER
+
+        stats = main.get_pipeline_stats()
+        assert stats["two_stage"]["requests"] == 1
+        # Clasificación y generación: dos llamadas
+        assert stats["two_stage"]["llm_calls"] == 2
+        assert stats["merged"]["requests"] == 0
@@ -0,0 +1,132 @@
+"""
+Tests unitarios para las métricas en formato de texto de Prometheus
+"""
+import sys
+import os
+
+import pytest
+from fastapi.testclient import TestClient
+
+# Añadir el directorio del sumiller service al path
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../sumiller-service'))
+
+import llm
+import metrics
+import query_filter
+from cache import TTLCache
+from fake_model import FakeGenerativeModel
+from metrics import Counter, Gauge, Histogram, render_metrics
+from response_cache import SemanticResponseCache
+
+
+class TestHistogram:
+    def test_buckets_are_cumulative(self):
+        histogram = Histogram("latency_seconds", "Latencia.", ("stage",), buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 3.0):
+            histogram.observe(value, "rag")
+
+        assert histogram.render() == [
+            "# HELP latency_seconds Latencia.",
+            "# TYPE latency_seconds histogram",
+            'latency_seconds_bucket{stage="rag",le="0.1"} 2',
+            'latency_seconds_bucket{stage="rag",le="1.0"} 3',
+            'latency_seconds_bucket{stage="rag",le="+Inf"} 4',
+            'latency_seconds_sum{stage="rag"} 3.65',
+            'latency_seconds_count{stage="rag"} 4',
+        ]
+
+    def test_series_are_sorted_by_labels(self):
+        histogram = Histogram("latency_seconds", "Latencia.", ("stage",), buckets=(1.0,))
+        histogram.observe(0.5, "rag")
+        histogram.observe(0.5, "classification")
+        counts = [line for line in histogram.render() if "_count" in line]
+        assert counts == ['latency_seconds_count{stage="classification"} 1', 'latency_seconds_count{stage="rag"} 1']
+
+    def test_without_observations_only_metadata_is_rendered(self):
+        assert len(Histogram("latency_seconds", "Latencia.").render()) == 2
+
+
+class TestCounterAndGauge:
+    def test_counter_accumulates_per_label(self):
+        counter = Counter("requests_total", "Peticiones.", ("endpoint",))
+        counter.inc("/query")
+        counter.inc("/query", amount=2)
+        counter.inc("/query/stream")
+        assert counter.render()[1:] == [
+            "# TYPE requests_total counter",
+            'requests_total{endpoint="/query"} 3.0',
+            'requests_total{endpoint="/query/stream"} 1.0',
+        ]
+
+    def test_counter_without_labels(self):
+        counter = Counter("errors_total", "Errores.")
+        counter.inc()
+        assert counter.render()[-1] == "errors_total 1.0"
+
+    def test_label_values_are_escaped(self):
+        counter = Counter("requests_total", "Peticiones.", ("source",))
+        counter.inc('a"b\\c\nd')
+        assert counter.render()[-1] == 'requests_total{source="a\\"b\\\\c\\nd"} 1.0'
+
+    def test_gauge_is_read_at_render_time(self):
+        depth = {"value": 1}
+        gauge = Gauge("queue_depth", "Cola.", ("stage",), lambda: {("generation",): depth["value"]})
+        depth["value"] = 4
+        assert gauge.render() == [
+            "# HELP queue_depth Cola.",
+            "# TYPE queue_depth gauge",
+            'queue_depth{stage="generation"} 4',
+        ]
+
+
+class TestRecordTimings:
+    def test_only_numeric_ms_keys_are_observed(self, monkeypatch):
+        histogram = Histogram("stage_seconds", "Etapas.", ("endpoint", "stage"), buckets=(1.0,))
+        counter = Counter("requests_total", "Peticiones.", ("endpoint", "response_source"))
+        monkeypatch.setattr(metrics, "stage_duration", histogram)
+        monkeypatch.setattr(metrics, "requests_total", counter)
+
+        metrics.record_timings("/query", {"rag_ms": 250, "total_ms": 900, "pipeline_mode": "staged", "hedged_ms": None},
+                               "vertex_ai")
+
+        assert sorted(stage for _, stage in histogram._series) == ["rag", "total"]
+        assert histogram._series[("/query", "rag")][1] == 0.25
+        assert counter._values == {("/query", "vertex_ai"): 1.0}
+
+    def test_render_metrics_ends_with_a_newline(self):
+        assert render_metrics().endswith("\n")
+
+
+@pytest.fixture
+def client(monkeypatch, tmp_path):
+    # main crea ./database al importarse
+    monkeypatch.chdir(tmp_path)
+    import main
+    model = FakeGenerativeModel(latency_ms=0, jitter_ms=0, tail_probability=0, text="Un albariño.")
+    monkeypatch.setattr(llm, "USE_FAKE_LLM", True)
+    monkeypatch.setattr(llm, "_models", {})
+    monkeypatch.setattr(llm, "_fake_model", model)
+    monkeypatch.setattr(main.memory, "db_path", tmp_path / "sumiller.db")
+    monkeypatch.setattr(main, "LLM_WARMUP", False)
+    monkeypatch.setattr(main, "SEARCH_SERVICE_URL", None)
+    monkeypatch.setattr(main, "response_cache", SemanticResponseCache())
+    monkeypatch.setattr(query_filter, "_classification_cache", TTLCache(8, 60))
+    with TestClient(main.app) as test_client:
+        yield test_client
+
+
+class TestMetricsEndpoint:
+    def test_text_exposition_format(self, client):
+        client.post("/query", json={"query": "¿Qué vino va con el marisco?", "user_id": "u1"})
+        response = client.get("/metrics")
+
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "text/plain; version=0.0.4; charset=utf-8"
+        body = response.text
+        assert "# TYPE sumiller_stage_duration_seconds histogram" in body
+        assert 'sumiller_stage_duration_seconds_count{endpoint="/query",stage="total"}' in body
+        assert 'sumiller_requests_total{endpoint="/query",response_source="vertex_ai"}' in body
+        assert 'sumiller_admission_queue_depth{stage="generation"} 0' in body
+        # Cada línea es un comentario o `nombre{etiquetas} valor`
+        for line in body.strip().splitlines():
+            assert line.startswith("#") or float(line.rsplit(" ", 1)[1]) >= 0
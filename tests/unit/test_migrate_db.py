@@ -0,0 +1,85 @@
+"""
+Tests unitarios para la migración del esquema con PRAGMA user_version
+"""
+import asyncio
+import sqlite3
+import sys
+import os
+
+import pytest
+
+# Añadir el directorio del sumiller service al path
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../sumiller-service'))
+
+from memory import SumillerMemory
+from migrate_db import MIGRATIONS, SCHEMA_VERSION, get_schema_version, migrate_database
+
+
+def _columns(db_path, table):
+    with sqlite3.connect(db_path) as conn:
+        return {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+
+def _create_v1_database(db_path):
+    """Base de datos tal como quedaba con la versión 1 del esquema (sin columnas de uso)."""
+    with sqlite3.connect(db_path) as conn:
+        conn.execute("""
+            CREATE TABLE conversations (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT NOT NULL,
+                user_name TEXT,
+                query TEXT NOT NULL,
+                response TEXT NOT NULL,
+                wines_recommended TEXT,
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                session_id TEXT
+            )
+        """)
+        conn.execute("INSERT INTO conversations (user_id, query, response) VALUES ('u1', '¿Qué vino?', 'Un rioja.')")
+        conn.execute("PRAGMA user_version = 1")
+        conn.commit()
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return tmp_path / "sumiller.db"
+
+
+class TestSchemaVersion:
+    def test_missing_database_is_version_zero(self, db_path):
+        assert get_schema_version(db_path) == 0
+
+    def test_fresh_database_is_created_at_current_version(self, db_path):
+        memory = SumillerMemory(db_path=str(db_path), initialize=False)
+        assert memory.ensure_schema() is True
+        assert get_schema_version(db_path) == SCHEMA_VERSION
+        assert {"category", "cost_usd", "usage_detail"} <= _columns(db_path, "conversations")
+
+    def test_current_schema_is_skipped(self, db_path):
+        memory = SumillerMemory(db_path=str(db_path), initialize=False)
+        memory.ensure_schema()
+        assert memory.ensure_schema() is False
+        assert migrate_database(db_path) is False
+
+    def test_v1_database_is_upgraded(self, db_path):
+        _create_v1_database(db_path)
+        memory = SumillerMemory(db_path=str(db_path), initialize=False)
+
+        assert memory.ensure_schema() is True
+        assert get_schema_version(db_path) == SCHEMA_VERSION
+        v2_columns = {column for version, table, column, _ in MIGRATIONS if version == 2 and table == "conversations"}
+        assert v2_columns <= _columns(db_path, "conversations")
+        # Los datos existentes se conservan y las tablas nuevas ya existen
+        context = asyncio.run(memory.get_user_context("u1"))
+        assert context["recent_conversations"][0]["query"] == "¿Qué vino?"
+        asyncio.run(memory.save_conversation("u1", "¿Y otro?", "Un albariño.", category="WINE_SEARCH",
+                                             usage={"prompt_tokens": 10}))
+        assert asyncio.run(memory.get_usage("category"))[0]["prompt_tokens"] == 10
+
+    def test_migration_skips_tables_that_do_not_exist(self, db_path):
+        """Las tablas que faltan las crea SumillerMemory ya con todas sus columnas."""
+        _create_v1_database(db_path)
+        assert migrate_database(db_path) is True
+        with sqlite3.connect(db_path) as conn:
+            tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        assert "user_preferences" not in tables
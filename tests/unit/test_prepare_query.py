@@ -0,0 +1,103 @@
+"""
+Tests unitarios para la preparación concurrente de /query (clasificación, RAG y contexto)
+"""
+import asyncio
+import sys
+import os
+
+import pytest
+
+# Añadir el directorio del sumiller service al path
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../sumiller-service'))
+
+DELAY = 0.05
+
+
+@pytest.fixture
+def main(monkeypatch, tmp_path):
+    # main crea ./database al importarse
+    monkeypatch.chdir(tmp_path)
+    import main as sumiller_main
+    monkeypatch.setattr(sumiller_main, "SEARCH_SERVICE_URL", "http://rag.test")
+    monkeypatch.setattr(sumiller_main, "RAG_PREFETCH", True)
+    monkeypatch.setattr(sumiller_main, "MERGED_CLASSIFY_ANSWER", False)
+    monkeypatch.setattr(sumiller_main, "RESPONSE_CACHE_ENABLED", False)
+    monkeypatch.setattr(sumiller_main, "COALESCE_REQUESTS", False)
+    return sumiller_main
+
+
+@pytest.fixture
+def stages(main, monkeypatch):
+    """Sustituye cada etapa por una espera fija y registra cuáles terminan o se cancelan."""
+    events = {"category": "WINE_SEARCH", "started": [], "finished": [], "cancelled": [], "log": []}
+
+    def stage(name, result, delay=DELAY):
+        async def run(*args, **kwargs):
+            events["started"].append(name)
+            events["log"].append(("start", name))
+            try:
+                await asyncio.sleep(delay)
+            except asyncio.CancelledError:
+                events["cancelled"].append(name)
+                raise
+            events["finished"].append(name)
+            events["log"].append(("finish", name))
+            return result() if callable(result) else result
+        return run
+
+    classification = lambda: {"category": events["category"], "should_use_rag": events["category"] == "WINE_SEARCH"}
+    monkeypatch.setattr(main, "filter_and_classify_query", stage("classification", classification, DELAY / 5))
+    monkeypatch.setattr(main, "search_wines", stage("rag", ([{"name": "Viña Ardanza"}], {"source": "rag", "rag_used": True})))
+    monkeypatch.setattr(main.memory, "get_user_context", stage("context", {"user_id": "u1", "favorite_wines": []}))
+    return events
+
+
+class TestPrepareQuery:
+    def test_stages_run_concurrently(self, main, stages):
+        request = main.QueryRequest(query="Recomiéndame un rioja", user_id="u1")
+        prepared = asyncio.run(main.prepare_query(request))
+
+        assert sorted(stages["finished"]) == ["classification", "context", "rag"]
+        assert prepared["wines"] == [{"name": "Viña Ardanza"}]
+        assert prepared["user_context"]["user_id"] == "u1"
+        assert prepared["timings"]["rag_prefetch"] == "used"
+        # Las tres etapas se solapan: el total se acerca a una sola espera, no a tres
+        assert prepared["timings"]["preparation_ms"] < DELAY * 1000 * 2
+
+    def test_prefetch_is_cancelled_for_predefined_category(self, main, stages):
+        stages["category"] = "GREETING"
+        request = main.QueryRequest(query="Hola", user_id="u1")
+        prepared = asyncio.run(main.prepare_query(request))
+
+        assert set(stages["cancelled"]) == {"rag", "context"}
+        assert prepared["wines"] == []
+        assert prepared["rag_metadata"]["source"] == "predefined_response"
+        assert prepared["timings"]["rag_prefetch"] == "cancelled"
+
+    def test_prefetch_is_cancelled_when_rag_is_not_needed(self, main, stages):
+        stages["category"] = "WINE_THEORY"
+        request = main.QueryRequest(query="¿Qué es la crianza?", user_id="u1")
+        prepared = asyncio.run(main.prepare_query(request))
+
+        assert stages["cancelled"] == ["rag"]
+        assert prepared["user_context"]["user_id"] == "u1"
+        assert prepared["timings"]["rag_prefetch"] == "cancelled"
+
+    def test_without_prefetch_rag_starts_after_classification(self, main, stages, monkeypatch):
+        monkeypatch.setattr(main, "RAG_PREFETCH", False)
+        request = main.QueryRequest(query="Recomiéndame un rioja", user_id="u1")
+        prepared = asyncio.run(main.prepare_query(request))
+
+        assert stages["log"].index(("start", "rag")) > stages["log"].index(("finish", "classification"))
+        assert prepared["timings"]["rag_prefetch"] == "disabled"
+
+    def test_classification_error_cancels_pending_stages(self, main, stages, monkeypatch):
+        async def failing(*args, **kwargs):
+            await asyncio.sleep(DELAY / 5)
+            raise RuntimeError("fallo de clasificación")
+
+        monkeypatch.setattr(main, "filter_and_classify_query", failing)
+        request = main.QueryRequest(query="Recomiéndame un rioja", user_id="u1")
+        with pytest.raises(RuntimeError):
+            asyncio.run(main.prepare_query(request))
+        assert set(stages["cancelled"]) == {"rag", "context"}
@@ -0,0 +1,113 @@
+"""
+Tests unitarios para la composición de prompts con presupuesto de tokens
+"""
+import sys
+import os
+
+# Añadir el directorio del sumiller service al path
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../sumiller-service'))
+
+import prompt_builder
+from prompt_builder import PromptBuilder, estimate_tokens
+
+
+def _wine(i, description="Tinto con crianza en barrica"):
+    return {"name": f"Vino {i}", "type": "Tinto", "region": "Rioja", "price": 10 + i,
+            "description": description, "internal_id": f"id-{i}"}
+
+
+def _history(n):
+    return [{"role": "user" if i % 2 == 0 else "assistant", "content": f"mensaje {i} " + "x" * 40} for i in range(n)]
+
+
+class TestRenderWines:
+    def test_stops_at_the_budget_keeping_relevance_order(self):
+        builder = PromptBuilder()
+        wines = [_wine(i) for i in range(20)]
+        line_cost = estimate_tokens("- " + "; ".join(f"{k}={v}" for k, v in _wine(0).items() if k != "internal_id"))
+        text = builder.render_wines(wines, budget=line_cost * 3)
+        lines = text.splitlines()[1:]
+        assert [line.split(";")[0] for line in lines] == ["- name=Vino 0", "- name=Vino 1", "- name=Vino 2"]
+
+    def test_first_wine_is_kept_even_over_budget(self):
+        text = PromptBuilder().render_wines([_wine(0)], budget=1)
+        assert "Vino 0" in text
+
+    def test_projects_fields_and_truncates_description(self):
+        text = PromptBuilder().render_wines([_wine(0, description="a " * 300)], budget=1000)
+        assert "internal_id" not in text
+        description = text.split("description=")[1]
+        assert len(description) <= 200 and description.endswith("…")
+
+    def test_zero_budget_omits_wines(self):
+        assert PromptBuilder().render_wines([_wine(0)], budget=0) == "No se encontraron vinos específicos."
+
+
+class TestRenderHistory:
+    def test_keeps_the_most_recent_messages_within_budget(self):
+        history = _history(6)
+        text = PromptBuilder().render_history(history, budget=40)
+        lines = text.splitlines()
+        assert lines, "debería caber al menos un mensaje"
+        assert estimate_tokens(text) <= 40
+        assert lines[-1].startswith("assistant: mensaje 5")
+        assert "mensaje 0" not in text
+
+    def test_caps_message_count(self, monkeypatch):
+        monkeypatch.setattr(prompt_builder, "HISTORY_MAX_MESSAGES", 2)
+        text = PromptBuilder().render_history(_history(6), budget=10_000)
+        assert len(text.splitlines()) == 2
+
+    def test_summary_replaces_summarized_messages(self):
+        summary = {"summary": "El usuario busca un rioja para cordero.", "messages_summarized": 4}
+        text = PromptBuilder().render_history(_history(6), budget=10_000, summary=summary)
+        lines = text.splitlines()
+        assert lines[0].startswith("Resumen de la conversación anterior: El usuario busca un rioja")
+        assert [line.split(" ")[2] for line in lines[1:]] == ["4", "5"]
+
+
+class TestRenderContext:
+    def test_recent_queries_are_added_until_the_budget(self):
+        context = {
+            "preferences": {"tipo": "tinto"},
+            "recent_conversations": [
+                {"query": f"consulta {i} " + "y" * 60, "response": "larga " * 100,
+                 "wines_recommended": '[{"name": "Viña Ardanza"}]'}
+                for i in range(10)
+            ],
+        }
+        text = PromptBuilder().render_context(context, budget=60)
+        assert estimate_tokens(text) <= 60
+        assert '"preferences"' in text
+        assert "consulta 0" in text and "consulta 9" not in text
+        # De las conversaciones pasadas no se copian las respuestas
+        assert "larga" not in text
+
+    def test_oversized_context_is_truncated(self):
+        context = {"favorite_wines": [f"Vino favorito {i}" for i in range(100)]}
+        text = PromptBuilder().render_context(context, budget=20)
+        assert len(text) <= 20 * 4 and text.endswith("…")
+
+
+class TestBudgets:
+    def test_env_override_merges_with_defaults(self, monkeypatch):
+        monkeypatch.setenv("PROMPT_TOKEN_BUDGETS", '{"WINE_SEARCH": {"wines": 900}, "NUEVA": {"history": 10}}')
+        builder = PromptBuilder()
+        assert builder.budget("WINE_SEARCH") == {"wines": 900, "history": 400, "context": 200}
+        assert builder.budget("NUEVA")["history"] == 10
+        assert builder.budget("NUEVA")["wines"] == prompt_builder.DEFAULT_TOKEN_BUDGETS["DEFAULT"]["wines"]
+
+    def test_invalid_override_uses_defaults(self, monkeypatch):
+        monkeypatch.setenv("PROMPT_TOKEN_BUDGETS", "no es json")
+        assert PromptBuilder().budget("WINE_SEARCH") == prompt_builder.DEFAULT_TOKEN_BUDGETS["WINE_SEARCH"]
+
+    def test_generation_prompt_reports_its_size(self):
+        trace = {}
+        prompt = PromptBuilder().build_generation(
+            "¿Qué vino va con cordero?", [_wine(i) for i in range(50)], {}, _history(20), "WINE_SEARCH", trace=trace
+        )
+        assert trace["prompt"]["tokens_est"] == estimate_tokens(prompt)
+        sections = trace["prompt"]["sections_tokens_est"]
+        budget = prompt_builder.DEFAULT_TOKEN_BUDGETS["WINE_SEARCH"]
+        assert sections["wines"] <= budget["wines"] + 5
+        assert sections["history"] <= budget["history"]
@@ -0,0 +1,106 @@
+"""
+Tests unitarios para el registro de prompts con recarga en caliente
+"""
+import asyncio
+import sys
+import os
+from pathlib import Path
+
+import pytest
+
+# Añadir el directorio del sumiller service al path
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../sumiller-service'))
+
+from prompt_registry import PromptRegistry
+
+
+def _write(path: Path, text: str, mtime: float):
+    path.write_text(text, encoding="utf-8")
+    # mtime explícito: dos escrituras seguidas pueden caer en el mismo tic del reloj del sistema
+    os.utime(path, (mtime, mtime))
+
+
+@pytest.fixture
+def prompts_dir(tmp_path):
+    _write(tmp_path / "saludo.txt", "Hola $nombre", 1000)
+    _write(tmp_path / "cata.txt", "Notas de cata", 1000)
+    return tmp_path
+
+
+class TestPromptRegistry:
+    def test_loads_and_renders_templates(self, prompts_dir):
+        registry = PromptRegistry(prompts_dir)
+        assert registry.render("saludo.txt", nombre="Sumy") == "Hola Sumy"
+        # Los marcadores sin valor se conservan en lugar de fallar
+        assert registry.render("saludo.txt") == "Hola $nombre"
+        assert registry.get_stats()["loads"] == 2
+
+    def test_unknown_template_is_a_miss(self, prompts_dir):
+        registry = PromptRegistry(prompts_dir)
+        assert registry.text("no_existe.txt") == ""
+        assert registry.get_stats()["misses"] == 1
+
+    def test_requests_do_not_touch_the_filesystem(self, prompts_dir):
+        registry = PromptRegistry(prompts_dir)
+        _write(prompts_dir / "saludo.txt", "Buenas $nombre", 2000)
+        # Sin recarga se sigue sirviendo la versión en memoria
+        assert registry.render("saludo.txt", nombre="Sumy") == "Hola Sumy"
+
+    def test_reload_async_picks_up_changed_files_and_notifies(self, prompts_dir):
+        registry = PromptRegistry(prompts_dir)
+        notified = []
+        registry.on_reload(notified.append)
+        version = registry.version()
+        _write(prompts_dir / "saludo.txt", "Buenas $nombre", 2000)
+
+        changed = asyncio.run(registry.reload_async())
+
+        assert changed == ["saludo.txt"]
+        assert notified == [["saludo.txt"]]
+        assert registry.render("saludo.txt", nombre="Sumy") == "Buenas Sumy"
+        assert registry.version() != version
+        assert registry.version("cata.txt") != ""
+
+    def test_touched_file_with_same_content_is_not_a_change(self, prompts_dir):
+        registry = PromptRegistry(prompts_dir)
+        notified = []
+        registry.on_reload(notified.append)
+        _write(prompts_dir / "cata.txt", "Notas de cata", 2000)
+        assert asyncio.run(registry.reload_async()) == []
+        assert notified == []
+
+    def test_added_and_removed_files(self, prompts_dir):
+        registry = PromptRegistry(prompts_dir)
+        _write(prompts_dir / "nuevo.txt", "Nuevo", 2000)
+        (prompts_dir / "cata.txt").unlink()
+
+        changed = registry.reload()
+
+        assert sorted(changed) == ["cata.txt", "nuevo.txt"]
+        assert registry.text("nuevo.txt") == "Nuevo"
+        assert registry.get("cata.txt") is None
+
+    def test_failing_listener_does_not_stop_the_others(self, prompts_dir):
+        registry = PromptRegistry(prompts_dir)
+        notified = []
+
+        def failing(changed):
+            raise RuntimeError("listener roto")
+
+        registry.on_reload(failing)
+        registry.on_reload(notified.append)
+        _write(prompts_dir / "saludo.txt", "Buenas", 2000)
+        registry.reload()
+        assert notified == [["saludo.txt"]]
+
+    def test_watcher_reloads_in_background(self, prompts_dir):
+        registry = PromptRegistry(prompts_dir)
+
+        async def scenario():
+            registry.start_watcher(interval=0.01)
+            _write(prompts_dir / "saludo.txt", "Buenas $nombre", 2000)
+            await asyncio.sleep(0.05)
+            await registry.stop_watcher()
+
+        asyncio.run(scenario())
+        assert registry.text("saludo.txt") == "Buenas $nombre"
@@ -0,0 +1,99 @@
+"""
+Tests unitarios para el endpoint SSE /query/events con el modelo falso
+"""
+import json
+import sys
+import os
+
+import pytest
+from fastapi.testclient import TestClient
+
+# Añadir el directorio del sumiller service al path
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../sumiller-service'))
+
+import llm
+import query_filter
+from admission import AdmissionRejected
+from cache import TTLCache
+from fake_model import FakeGenerativeModel
+from response_cache import SemanticResponseCache
+
+ANSWER = "Un albariño fresco va muy bien con el marisco."
+
+
+@pytest.fixture
+def main(monkeypatch, tmp_path):
+    # main crea ./database al importarse
+    monkeypatch.chdir(tmp_path)
+    import main as sumiller_main
+    model = FakeGenerativeModel(latency_ms=0, jitter_ms=0, tail_probability=0, text=ANSWER)
+    monkeypatch.setattr(llm, "USE_FAKE_LLM", True)
+    monkeypatch.setattr(llm, "_models", {})
+    monkeypatch.setattr(llm, "_fake_model", model)
+    monkeypatch.setattr(sumiller_main.memory, "db_path", tmp_path / "sumiller.db")
+    monkeypatch.setattr(sumiller_main, "LLM_WARMUP", False)
+    monkeypatch.setattr(sumiller_main, "SEARCH_SERVICE_URL", None)
+    monkeypatch.setattr(sumiller_main, "response_cache", SemanticResponseCache())
+    monkeypatch.setattr(query_filter, "_classification_cache", TTLCache(8, 60))
+    return sumiller_main
+
+
+@pytest.fixture
+def client(main):
+    with TestClient(main.app) as test_client:
+        yield test_client
+
+
+def _events(response):
+    """Convierte el cuerpo SSE en una lista de (evento, datos)."""
+    events = []
+    for block in response.text.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.splitlines())
+        events.append((lines["event"], json.loads(lines["data"])))
+    return events
+
+
+class TestQueryEvents:
+    def test_event_sequence(self, client):
+        response = client.post("/query/events", json={"query": "¿Qué vino va con el marisco?", "user_id": "u1"})
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/event-stream")
+
+        events = _events(response)
+        names = [name for name, _ in events]
+        assert names[:3] == ["accepted", "classification", "rag"]
+        assert names[-1] == "stats"
+        assert set(names[3:-1]) == {"token"}
+
+        assert events[0][1]["query"] == "¿Qué vino va con el marisco?"
+        assert events[1][1]["category"] == "WINE_SEARCH"
+        assert "".join(data["text"] for name, data in events if name == "token").strip() == ANSWER
+        stats = events[-1][1]
+        assert stats["response_source"] == "vertex_ai"
+        assert "first_token_ms" in stats["stage_timings"]
+        assert stats["usage"]["llm_calls"] >= 1
+
+    def test_predefined_answer_is_a_single_token(self, client):
+        response = client.post("/query/events", json={"query": "hola", "user_id": "u1"})
+        events = _events(response)
+        tokens = [data["text"] for name, data in events if name == "token"]
+        assert len(tokens) == 1
+        assert events[-1][1]["response_source"] == "predefined"
+
+    def test_overload_is_reported_as_an_error_event(self, main, client, monkeypatch):
+        async def rejected(*args, **kwargs):
+            raise AdmissionRejected("classification", "queue_full", 2)
+
+        monkeypatch.setattr(main, "prepare_query", rejected)
+        response = client.post("/query/events", json={"query": "¿Qué vino va con el marisco?", "user_id": "u1"})
+        events = _events(response)
+        assert [name for name, _ in events] == ["accepted", "error"]
+        assert events[1][1] == {"detail": main.BUSY_MESSAGE, "retry_after": 2}
+
+    def test_preparation_failure_is_reported_as_an_error_event(self, main, client, monkeypatch):
+        async def failing(*args, **kwargs):
+            raise RuntimeError("fallo")
+
+        monkeypatch.setattr(main, "prepare_query", failing)
+        response = client.post("/query/events", json={"query": "¿Qué vino va con el marisco?", "user_id": "u1"})
+        assert [name for name, _ in _events(response)] == ["accepted", "error"]
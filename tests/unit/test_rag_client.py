@@ -0,0 +1,104 @@
+"""
+Tests unitarios para el cliente HTTP compartido hacia el RAG Service
+"""
+import asyncio
+import sys
+import os
+
+import httpx
+import pytest
+
+# Añadir el directorio del sumiller service al path
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../sumiller-service'))
+
+import rag_client
+from rag_client import RAGClient
+
+
+@pytest.fixture
+def created(monkeypatch):
+    """Sustituye la red por un MockTransport y registra los clientes httpx creados."""
+    clients = []
+    real_client = httpx.AsyncClient
+
+    def handler(request):
+        if request.url.path == "/fallo":
+            raise httpx.ConnectError("sin conexión", request=request)
+        return httpx.Response(200, json={"path": request.url.path})
+
+    def factory(**kwargs):
+        clients.append(kwargs)
+        return real_client(transport=httpx.MockTransport(handler), **kwargs)
+
+    monkeypatch.setattr(rag_client.httpx, "AsyncClient", factory)
+    return clients
+
+
+class TestRAGClient:
+    def test_reuses_one_pooled_client(self, created):
+        client = RAGClient("http://rag.test")
+
+        async def scenario():
+            await client.start()
+            await client.start()
+            first, _ = await client.post("/search", {"query": "rioja"})
+            second, timings = await client.post("/search", {"query": "ribera"})
+            await client.close()
+            return first, second, timings
+
+        first, second, timings = asyncio.run(scenario())
+        assert len(created) == 1
+        assert created[0]["limits"].max_connections == rag_client.RAG_HTTP_MAX_CONNECTIONS
+        assert first.json() == second.json() == {"path": "/search"}
+        assert set(timings) == {"connect_ms", "request_ms", "total_ms", "connection_reused"}
+        assert client.get_stats()["calls"] == 2
+
+    def test_post_starts_the_client_lazily(self, created):
+        client = RAGClient("http://rag.test")
+
+        async def scenario():
+            response, _ = await client.post("/search", {"query": "rioja"})
+            await client.close()
+            return response
+
+        assert asyncio.run(scenario()).status_code == 200
+        assert len(created) == 1
+
+    def test_errors_are_counted_and_raised(self, created):
+        client = RAGClient("http://rag.test")
+
+        async def scenario():
+            with pytest.raises(httpx.ConnectError):
+                await client.post("/fallo", {})
+            await client.close()
+
+        asyncio.run(scenario())
+        stats = client.get_stats()
+        assert stats["errors"] == 1
+        assert stats["calls"] == 0
+
+    def test_without_base_url_no_client_is_created(self, created):
+        client = RAGClient(None)
+        asyncio.run(client.start())
+        assert created == []
+
+    def test_http2_falls_back_without_h2(self, created, monkeypatch):
+        monkeypatch.setattr(rag_client, "RAG_HTTP2", True)
+        monkeypatch.setitem(sys.modules, "h2", None)
+        client = RAGClient("http://rag.test")
+
+        async def scenario():
+            await client.start()
+            await client.close()
+
+        asyncio.run(scenario())
+        assert created[0]["http2"] is False
+
+    def test_stats_split_cold_and_warm_calls(self):
+        client = RAGClient("http://rag.test")
+        client._record({"connect_ms": 30.0, "request_ms": 10.0, "total_ms": 40.0, "connection_reused": False})
+        client._record({"connect_ms": 0.0, "request_ms": 10.0, "total_ms": 10.0, "connection_reused": True})
+        stats = client.get_stats()
+        assert stats["new_connections"] == 1
+        assert stats["reused_connections"] == 1
+        assert stats["warm_savings_ms"] == 30.0
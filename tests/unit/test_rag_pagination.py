@@ -0,0 +1,170 @@
+"""
+Tests unitarios para la paginación de la carta (/catalog) y de los chunks (/debug/chunks) del RAG service
+"""
+import importlib.util
+import json
+import threading
+import sys
+import os
+from datetime import datetime, timezone
+
+import pytest
+
+pytest.importorskip("chromadb")
+pytest.importorskip("sentence_transformers")
+from fastapi.testclient import TestClient
+
+RAG_SERVICE_DIR = os.path.join(os.path.dirname(__file__), '../../agentic_rag-service')
+
+
+def _load_rag_main():
+    # Se carga con otro nombre: sumiller-service también tiene un main.py
+    if "rag_main" not in sys.modules:
+        spec = importlib.util.spec_from_file_location("rag_main", os.path.join(RAG_SERVICE_DIR, "main.py"))
+        module = importlib.util.module_from_spec(spec)
+        sys.modules["rag_main"] = module
+        spec.loader.exec_module(module)
+    return sys.modules["rag_main"]
+
+
+rag_main = _load_rag_main()
+
+
+class FakeCollection:
+    """Colección en memoria con la parte de la API de ChromaDB que usa el servicio."""
+
+    def __init__(self):
+        self.ids, self.documents, self.metadatas = [], [], []
+
+    def add(self, ids, documents, metadatas):
+        self.ids += ids
+        self.documents += documents
+        self.metadatas += metadatas
+
+    def get(self, offset=None, limit=None, include=None):
+        end = None if limit is None else (offset or 0) + limit
+        window = slice(offset or 0, end)
+        include = include or []
+        return {
+            "ids": self.ids[window],
+            "documents": self.documents[window] if "documents" in include else None,
+            "metadatas": self.metadatas[window] if "metadatas" in include else None,
+        }
+
+    def count(self):
+        return len(self.ids)
+
+
+def _wine(i):
+    return {"type_content": "wine", "name": f"Vino {i}", "type": "Tinto", "region": "Rioja",
+            "grape": "Tempranillo", "price": 10 + i, "description": f"Descripción {i}"}
+
+
+@pytest.fixture
+def service(monkeypatch):
+    collection = FakeCollection()
+    collection.add(
+        ids=[f"vino_{i}" for i in range(5)] + ["conocimiento_0"],
+        documents=[f"Vino {i}" for i in range(5)] + ["La crianza..."],
+        metadatas=[_wine(i) for i in range(5)] + [{"type_content": "knowledge"}],
+    )
+    # Sin modelo de embeddings ni ChromaDB: solo la carta y los chunks
+    svc = rag_main.RAGService.__new__(rag_main.RAGService)
+    svc.collection = collection
+    svc.index_version = ""
+    svc.index_updated_at = datetime.now(timezone.utc)
+    svc._catalog = []
+    svc._catalog_pages = {}
+    svc._catalog_lock = threading.Lock()
+    svc._refresh_index_version()
+    monkeypatch.setattr(rag_main, "rag_service", svc)
+    return svc
+
+
+@pytest.fixture
+def client(service):
+    return TestClient(rag_main.app)
+
+
+class TestCatalog:
+    def test_keyset_cursor_walks_every_wine_once(self, client):
+        seen, cursor = [], None
+        for _ in range(5):
+            params = {"limit": 2, **({"cursor": cursor} if cursor else {})}
+            page = client.get("/catalog", params=params).json()
+            assert page["total"] == 5
+            seen += [wine["id"] for wine in page["wines"]]
+            cursor = page["next_cursor"]
+            if cursor is None:
+                break
+        assert seen == [f"vino_{i}" for i in range(5)]
+
+    def test_field_projection(self, client):
+        page = client.get("/catalog", params={"fields": "name,price"}).json()
+        assert page["wines"][0] == {"id": "vino_0", "name": "Vino 0", "price": 10}
+        assert client.get("/catalog", params={"fields": "name,secreto"}).status_code == 400
+
+    def test_invalid_cursor(self, client):
+        assert client.get("/catalog", params={"cursor": "%%%"}).status_code == 400
+
+    def test_etag_revalidation_returns_304(self, client):
+        first = client.get("/catalog", headers={"Accept-Encoding": "identity"})
+        assert first.status_code == 200
+        etag = first.headers["ETag"]
+        again = client.get("/catalog", headers={"Accept-Encoding": "identity", "If-None-Match": etag})
+        assert again.status_code == 304
+        assert again.headers["ETag"] == etag
+        other = client.get("/catalog", headers={"Accept-Encoding": "identity", "If-None-Match": '"otro"'})
+        assert other.status_code == 200
+
+    def test_gzip_has_its_own_etag_and_honours_q0(self, client):
+        plain = client.get("/catalog", headers={"Accept-Encoding": "identity"})
+        gzipped = client.get("/catalog", headers={"Accept-Encoding": "gzip"})
+        assert gzipped.headers["Content-Encoding"] == "gzip"
+        assert gzipped.headers["ETag"] != plain.headers["ETag"]
+        assert gzipped.json() == plain.json()
+        refused = client.get("/catalog", headers={"Accept-Encoding": "gzip;q=0"})
+        assert "Content-Encoding" not in refused.headers
+
+    def test_default_page_is_precomputed(self, service):
+        key = (service.index_version, None, rag_main.CATALOG_DEFAULT_LIMIT, rag_main.CATALOG_DEFAULT_FIELDS)
+        assert key in service._catalog_pages
+
+    def test_index_change_updates_version_and_etag(self, client, service):
+        before = client.get("/catalog", headers={"Accept-Encoding": "identity"})
+        service.collection.add(ids=["vino_9"], documents=["Vino 9"], metadatas=[_wine(9)])
+        service._refresh_index_version()
+        after = client.get("/catalog", headers={"Accept-Encoding": "identity", "If-None-Match": before.headers["ETag"]})
+        assert after.status_code == 200
+        assert after.json()["total"] == 6
+        assert after.headers["X-Index-Version"] != before.headers["X-Index-Version"]
+
+
+class TestChunks:
+    def test_cursor_walks_every_chunk_once(self, client):
+        seen, cursor = [], None
+        for _ in range(5):
+            params = {"limit": 4, **({"cursor": cursor} if cursor else {})}
+            page = client.get("/debug/chunks", params=params).json()
+            seen += [chunk["id"] for chunk in page["sample_chunks"]]
+            cursor = page["next_cursor"]
+            if cursor is None:
+                break
+        assert seen == [f"vino_{i}" for i in range(5)] + ["conocimiento_0"]
+
+    def test_cursor_from_another_index_version_is_rejected(self, client, service):
+        """Un cursor emitido antes de reindexar no continúa sobre otra colección."""
+        cursor = client.get("/debug/chunks", params={"limit": 2}).json()["next_cursor"]
+        service.collection.add(ids=["vino_9"], documents=["Vino 9"], metadatas=[_wine(9)])
+        service._refresh_index_version()
+        assert client.get("/debug/chunks", params={"cursor": cursor}).status_code == 409
+
+    def test_invalid_cursor(self, client):
+        cursor = rag_main._encode_cursor("sin-offset")
+        assert client.get("/debug/chunks", params={"cursor": cursor}).status_code == 400
+
+    def test_export_streams_one_chunk_per_line(self, client, service):
+        response = client.get("/debug/chunks/export", params={"page_size": 2})
+        lines = [json.loads(line) for line in response.text.splitlines()]
+        assert response.headers["X-Index-Version"] == service.index_version
+        assert [line["id"] for line in lines] == [f"vino_{i}" for i in range(5)] + ["conocimiento_0"]
@@ -0,0 +1,118 @@
+"""
+Tests unitarios para el circuit breaker de la etapa RAG
+"""
+import asyncio
+import sys
+import os
+
+import pytest
+
+# Añadir el directorio del sumiller service al path
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../sumiller-service'))
+
+import resilience
+from resilience import CircuitBreaker
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(resilience.time, "monotonic", fake)
+    return fake
+
+
+def _open(breaker):
+    for _ in range(breaker.failure_threshold):
+        assert breaker.allow()
+        breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+class TestCircuitBreaker:
+    def test_opens_after_consecutive_failures(self, clock):
+        breaker = CircuitBreaker("test", failure_threshold=3, reset_timeout=10)
+        _open(breaker)
+        assert not breaker.allow()
+        assert breaker.get_stats()["rejected"] == 1
+
+    def test_success_resets_failure_count(self, clock):
+        breaker = CircuitBreaker("test", failure_threshold=2, reset_timeout=10)
+        breaker.allow()
+        breaker.record_failure()
+        breaker.allow()
+        breaker.record_success()
+        breaker.allow()
+        breaker.record_failure()
+        assert breaker.state == CircuitBreaker.CLOSED
+
+    def test_open_half_open_closed(self, clock):
+        breaker = CircuitBreaker("test", failure_threshold=2, reset_timeout=10)
+        _open(breaker)
+        clock.now += 9
+        assert not breaker.allow()
+        clock.now += 1
+        # Pasado el plazo solo se deja pasar una petición de prueba
+        assert breaker.allow()
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        assert not breaker.allow()
+        breaker.record_success()
+        assert breaker.state == CircuitBreaker.CLOSED
+        assert breaker.allow() and breaker.allow()
+
+    def test_failed_probe_reopens(self, clock):
+        breaker = CircuitBreaker("test", failure_threshold=2, reset_timeout=10)
+        _open(breaker)
+        clock.now += 10
+        assert breaker.allow()
+        breaker.record_failure()
+        assert breaker.state == CircuitBreaker.OPEN
+        assert not breaker.allow()
+        clock.now += 10
+        assert breaker.allow()
+
+    def test_released_probe_can_be_retried(self, clock):
+        breaker = CircuitBreaker("test", failure_threshold=2, reset_timeout=10)
+        _open(breaker)
+        clock.now += 10
+        assert breaker.allow()
+        breaker.release()
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        assert breaker.allow()
+
+
+def test_cancelled_rag_probe_does_not_stick_the_breaker(clock, monkeypatch, tmp_path):
+    """Una búsqueda de prueba cancelada en semiabierto no deja el circuito bloqueado."""
+    monkeypatch.chdir(tmp_path)
+    import main
+
+    breaker = CircuitBreaker("rag", failure_threshold=1, reset_timeout=10)
+    monkeypatch.setattr(main, "rag_breaker", breaker)
+    monkeypatch.setattr(main, "SEARCH_SERVICE_URL", "http://rag.test")
+
+    async def slow_post(query):
+        await asyncio.sleep(10)
+
+    monkeypatch.setattr(main, "_post_search", slow_post)
+
+    async def scenario():
+        breaker.allow()
+        breaker.record_failure()
+        clock.now += 10
+        probe = asyncio.create_task(main._search_wines("rioja"))
+        await asyncio.sleep(0)
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        probe.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+        # La siguiente petición vuelve a probar el servicio en lugar de ser rechazada
+        assert breaker.allow()
+
+    asyncio.run(scenario())
@@ -0,0 +1,179 @@
+"""
+Tests unitarios para la caché semántica de respuestas
+"""
+import asyncio
+import sys
+import os
+
+import pytest
+
+# Añadir el directorio del sumiller service al path
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../sumiller-service'))
+
+import response_cache
+from response_cache import SemanticResponseCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(response_cache.time, "monotonic", fake)
+    return fake
+
+
+VERSION = ("prompts-v1", "index-v1")
+
+
+class TestSemanticResponseCache:
+    def test_shareable_only_without_history_and_in_listed_categories(self):
+        cache = SemanticResponseCache(categories={"WINE_THEORY"})
+        assert cache.is_shareable("WINE_THEORY", has_history=False)
+        assert not cache.is_shareable("WINE_THEORY", has_history=True)
+        assert not cache.is_shareable("WINE_SEARCH", has_history=False)
+
+    def test_similar_query_hits(self, clock):
+        cache = SemanticResponseCache(categories={"WINE_THEORY"}, threshold=0.9)
+        cache.store("¿Qué es la crianza en barrica?", "La crianza es...", "WINE_THEORY", VERSION)
+        hit = cache.lookup("que es la crianza en barrica", "WINE_THEORY", VERSION)
+        assert hit["response"] == "La crianza es..."
+        assert cache.lookup("¿Qué uva tiene un albariño?", "WINE_THEORY", VERSION) is None
+
+    def test_other_category_or_version_misses(self, clock):
+        cache = SemanticResponseCache(categories={"WINE_THEORY", "OFF_TOPIC"})
+        cache.store("¿Qué es la crianza?", "La crianza es...", "WINE_THEORY", VERSION)
+        assert cache.lookup("¿Qué es la crianza?", "OFF_TOPIC", VERSION) is None
+        assert cache.lookup("¿Qué es la crianza?", "WINE_THEORY", ("prompts-v2", "index-v1")) is None
+
+    def test_entries_expire_after_ttl(self, clock):
+        cache = SemanticResponseCache(categories={"WINE_THEORY"}, ttl=60)
+        cache.store("¿Qué es la crianza?", "La crianza es...", "WINE_THEORY", VERSION)
+        clock.now += 59
+        assert cache.lookup("¿Qué es la crianza?", "WINE_THEORY", VERSION)["age_seconds"] == 59
+        clock.now += 2
+        assert cache.lookup("¿Qué es la crianza?", "WINE_THEORY", VERSION) is None
+        assert cache.get_stats()["expirations"] == 1
+        assert cache.get_stats()["size"] == 0
+
+    def test_evicts_least_recently_used(self, clock):
+        cache = SemanticResponseCache(max_size=2, categories={"WINE_THEORY"})
+        cache.store("¿Qué es la crianza?", "crianza", "WINE_THEORY", VERSION)
+        cache.store("¿Qué es un vino espumoso?", "espumoso", "WINE_THEORY", VERSION)
+        assert cache.lookup("¿Qué es la crianza?", "WINE_THEORY", VERSION) is not None
+        cache.store("¿Qué son los taninos?", "taninos", "WINE_THEORY", VERSION)
+        assert cache.lookup("¿Qué es un vino espumoso?", "WINE_THEORY", VERSION) is None
+        assert cache.lookup("¿Qué es la crianza?", "WINE_THEORY", VERSION) is not None
+
+    def test_new_index_version_invalidates(self, clock):
+        cache = SemanticResponseCache(categories={"WINE_THEORY"})
+        cache.observe_index_version("index-v1")
+        cache.store("¿Qué es la crianza?", "La crianza es...", "WINE_THEORY", VERSION)
+        cache.observe_index_version("index-v1")
+        assert cache.get_stats()["size"] == 1
+        cache.observe_index_version("index-v2")
+        assert cache.get_stats()["size"] == 0
+
+
+@pytest.fixture
+def main(monkeypatch, tmp_path):
+    # main crea ./database al importarse
+    monkeypatch.chdir(tmp_path)
+    import main as sumiller_main
+    cache = SemanticResponseCache(categories={"WINE_THEORY"})
+    cache.observe_index_version("v1")
+    monkeypatch.setattr(sumiller_main, "response_cache", cache)
+    return sumiller_main
+
+
+def _prepared(category="WINE_THEORY", **timings):
+    return {"category": category, "rag_metadata": {"index_version": "v1"}, "timings": dict(timings)}
+
+
+class TestStoreCachedResponse:
+    def test_personal_or_history_requests_are_not_cached(self, main):
+        prepared = _prepared("WINE_SEARCH")
+        request = main.QueryRequest(query="Recomiéndame un tinto", user_id="u1")
+        main._store_cached_response(request, prepared, "Te recomiendo...", {})
+        assert main._lookup_cached_response(request, prepared["category"]) is None
+
+        request = main.QueryRequest(
+            query="¿Qué es la crianza?", user_id="u1", conversation_history=[{"role": "user", "content": "hola"}]
+        )
+        main._store_cached_response(request, _prepared(), "La crianza es...", {})
+        assert main.response_cache.get_stats()["size"] == 0
+
+    def test_generation_error_is_not_cached(self, main):
+        request = main.QueryRequest(query="¿Qué es la crianza en barrica?", user_id="u1")
+        prepared = _prepared()
+        main._store_cached_response(request, prepared, main.GENERATION_ERROR_MESSAGE, {})
+        assert main._lookup_cached_response(request, prepared["category"]) is None
+
+    def test_stores_clean_generation(self, main):
+        request = main.QueryRequest(query="¿Qué es la crianza en barrica?", user_id="u1")
+        prepared = _prepared()
+        main._store_cached_response(request, prepared, "La crianza es...", {})
+        assert main._lookup_cached_response(request, prepared["category"])["response"] == "La crianza es..."
+
+    def test_busy_message_is_never_cached(self, main):
+        """Una generación rechazada por admisión en streaming no se sirve a otros usuarios."""
+        request = main.QueryRequest(query="¿Qué es la crianza en barrica?", user_id="u1")
+        prepared = _prepared()
+        main._store_cached_response(request, prepared, main.BUSY_MESSAGE, {"degraded": ["admission"]})
+        main._store_cached_response(request, prepared, main.BUSY_MESSAGE)
+        assert main._lookup_cached_response(request, prepared["category"]) is None
+
+    def test_degraded_generation_trace_is_not_cached(self, main):
+        request = main.QueryRequest(query="¿Qué es la crianza en barrica?", user_id="u1")
+        prepared = _prepared()
+        main._store_cached_response(request, prepared, "Respuesta parcial", {"degraded": ["generation"]})
+        assert main._lookup_cached_response(request, prepared["category"]) is None
+
+    def test_degraded_preparation_is_not_cached(self, main):
+        request = main.QueryRequest(query="¿Qué es la crianza en barrica?", user_id="u1")
+        prepared = _prepared(degraded=["rag"])
+        main._store_cached_response(request, prepared, "Respuesta sin RAG", {})
+        assert main._lookup_cached_response(request, prepared["category"]) is None
+
+    def test_index_change_during_generation_is_not_cached(self, main):
+        request = main.QueryRequest(query="¿Qué es la crianza en barrica?", user_id="u1")
+        prepared = _prepared()
+        main.response_cache.observe_index_version("v2")
+        main._store_cached_response(request, prepared, "La crianza es...", {})
+        assert main.response_cache.get_stats()["size"] == 0
+
+
+class TestCachedPreparation:
+    def test_hit_does_not_wait_for_rag(self, main, monkeypatch):
+        """Un acierto usa la última versión conocida del índice y cancela la búsqueda RAG."""
+        cancelled = []
+
+        async def slow_search(query):
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.append(True)
+                raise
+
+        async def classify(query, has_history=False, trace=None):
+            return {"category": "WINE_THEORY", "confidence": 0.9, "should_use_rag": True}
+
+        monkeypatch.setattr(main, "SEARCH_SERVICE_URL", "http://rag.test")
+        monkeypatch.setattr(main, "RAG_PREFETCH", True)
+        monkeypatch.setattr(main, "search_wines", slow_search)
+        monkeypatch.setattr(main, "filter_and_classify_query", classify)
+        monkeypatch.setattr(main, "_load_context_within_deadline", lambda *args: asyncio.sleep(10, {}))
+        request = main.QueryRequest(query="¿Qué es la crianza en barrica?", user_id="u1")
+        main._store_cached_response(request, _prepared(), "La crianza es...", {})
+
+        prepared = asyncio.run(asyncio.wait_for(main.prepare_query(request), timeout=1))
+
+        assert prepared["cached_response"]["response"] == "La crianza es..."
+        assert prepared["rag_metadata"]["source"] == "response_cache"
+        assert cancelled == [True]
@@ -0,0 +1,76 @@
+"""
+Tests unitarios para el detector de palabras clave románticas (Aho-Corasick)
+"""
+import sys
+import os
+
+import pytest
+
+# Añadir el directorio del sumiller service al path
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../sumiller-service'))
+
+from query_filter import RomanticKeywordMatcher, load_romantic_keywords
+
+
+def linear_scan(user_query, keywords, min_confidence, exact_match_bonus):
+    """Búsqueda lineal original sobre el diccionario de palabras clave (referencia)."""
+    query_lower = user_query.lower()
+    for kw, base_conf in keywords.items():
+        if kw == query_lower: return True, kw, min(1.0, base_conf + exact_match_bonus)
+        if kw in query_lower:
+            conf = base_conf + min(0.2, len(kw) / 50)
+            if conf >= min_confidence: return True, kw, conf
+    return False, "", 0.0
+
+
+SAMPLE_QUERIES = [
+    "amor",
+    "Vicky",
+    "mensaje secreto",
+    "quiero un mensaje secreto para vicky",
+    "escribe un mensaje de amor",
+    "un mensaje romántico para mi cariño",
+    "dile algo bonito a pedro",
+    "palabras de cariño para alguien especial",
+    "dedícale algo a mi pareja",
+    "unas palabras bonitas",
+    "te quiero mucho",
+    "mensaje para mi madre",
+    "dedicatoria",
+    "qué vino va con paella",
+    "¿qué es la crianza?",
+    "",
+]
+
+
+class TestRomanticKeywordMatcher:
+    @pytest.mark.parametrize("query", SAMPLE_QUERIES)
+    def test_matches_linear_scan_on_keyword_file(self, query):
+        config = load_romantic_keywords()
+        assert config[0], "romantic_keywords.txt debería tener palabras clave"
+        assert RomanticKeywordMatcher(*config).match(query) == linear_scan(query, *config)
+
+    def test_first_keyword_in_file_order_wins(self):
+        config = ({"mensaje": 0.9, "mensaje secreto": 0.95}, 0.7, 0.1)
+        assert RomanticKeywordMatcher(*config).match("un mensaje secreto") == linear_scan("un mensaje secreto", *config)
+        assert RomanticKeywordMatcher(*config).match("un mensaje secreto")[1] == "mensaje"
+
+    def test_exact_match_bonus(self):
+        config = ({"amor": 0.9}, 0.7, 0.1)
+        assert RomanticKeywordMatcher(*config).match("AMOR") == (True, "amor", 1.0)
+        assert RomanticKeywordMatcher(*config).match("mi amor")[2] == pytest.approx(0.9 + 4 / 50)
+
+    def test_min_confidence_filter(self):
+        # "flor" como subcadena no llega al mínimo, pero sí como coincidencia exacta
+        config = ({"flor": 0.5, "rosa": 0.8}, 0.7, 0.1)
+        matcher = RomanticKeywordMatcher(*config)
+        for query in ("una flor", "flor", "una flor y una rosa", "nada"):
+            assert matcher.match(query) == linear_scan(query, *config), query
+        assert matcher.match("una flor y una rosa")[1] == "rosa"
+        assert matcher.match("flor")[1] == "flor"
+
+    def test_overlapping_keywords_use_failure_links(self):
+        config = ({"he": 0.9, "she": 0.9, "hers": 0.9, "his": 0.9}, 0.7, 0.1)
+        matcher = RomanticKeywordMatcher(*config)
+        for query in ("ushers", "ahishers", "sh", "xhex"):
+            assert matcher.match(query) == linear_scan(query, *config), query
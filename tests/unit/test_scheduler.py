@@ -0,0 +1,168 @@
+"""
+Tests unitarios para el control de admisión y el planificador justo de la generación
+"""
+import asyncio
+import sys
+import os
+
+import pytest
+
+# Añadir el directorio del sumiller service al path
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../sumiller-service'))
+
+from admission import AdmissionController, AdmissionRejected
+from scheduler import FairScheduler
+
+
+SERVICE_TIME = 0.01  # Duración simulada de una llamada a Gemini (s)
+
+
+async def _call(controller, results, user_id, lane="batch", cost=100.0):
+    """Simula una llamada al modelo y guarda la espera en cola del usuario."""
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    async with controller.slot(user_id=user_id, lane=lane, cost=cost):
+        results.setdefault(user_id, []).append((loop.time() - start) * 1000)
+        await asyncio.sleep(SERVICE_TIME)
+
+
+def _p95(values):
+    ordered = sorted(values)
+    return ordered[max(0, int(0.95 * len(ordered)) - 1)]
+
+
+async def _mixed_load(controller):
+    """Un usuario ráfaga con 60 peticiones y cinco usuarios normales con peticiones espaciadas."""
+    results = {}
+    tasks = [asyncio.create_task(_call(controller, results, "heavy")) for _ in range(60)]
+
+    async def light_user(user_id):
+        for _ in range(6):
+            await asyncio.sleep(SERVICE_TIME * 2)
+            await _call(controller, results, user_id)
+
+    await asyncio.gather(*tasks, *(light_user(f"light{i}") for i in range(5)))
+    return results
+
+
+class TestAdmissionController:
+    def test_sheds_when_queue_full(self):
+        """Con los huecos ocupados y la cola llena se rechaza en el acto."""
+        controller = AdmissionController("test", max_in_flight=1, queue_size=1, max_wait_ms=1000)
+
+        async def scenario():
+            holder = asyncio.create_task(_call(controller, {}, "a"))
+            queued = asyncio.create_task(_call(controller, {}, "b"))
+            await asyncio.sleep(0)
+            with pytest.raises(AdmissionRejected) as excinfo:
+                await controller.acquire()
+            await asyncio.gather(holder, queued)
+            return excinfo.value
+
+        rejected = asyncio.run(scenario())
+        assert rejected.reason == "queue_full"
+        assert rejected.retry_after >= 1
+        stats = controller.get_stats()
+        assert stats["shed_queue_full"] == 1
+        assert stats["in_flight"] == 0 and stats["queue_depth"] == 0
+
+    def test_sheds_after_max_wait(self):
+        controller = AdmissionController("test", max_in_flight=1, queue_size=4, max_wait_ms=20)
+
+        async def scenario():
+            await controller.acquire()
+            with pytest.raises(AdmissionRejected) as excinfo:
+                await controller.acquire()
+            controller.release()
+            return excinfo.value
+
+        assert asyncio.run(scenario()).reason == "timeout"
+        assert controller.get_stats()["queue_depth"] == 0
+        assert controller.in_flight == 0
+
+
+class TestFairScheduler:
+    def test_lane_priority(self):
+        """Con el hueco ocupado se sirven primero las predefinidas, luego streaming y al final batch."""
+        scheduler = FairScheduler("test", max_in_flight=1, queue_size=10, max_wait_ms=1000, max_queued_per_user=10)
+        order = []
+
+        async def scenario():
+            await scheduler.acquire(user_id="holder")
+
+            async def waiter(lane):
+                async with scheduler.slot(user_id=lane, lane=lane):
+                    order.append(lane)
+
+            tasks = [asyncio.create_task(waiter(lane)) for lane in ("batch", "stream", "predefined")]
+            await asyncio.sleep(0)
+            scheduler.release()
+            await asyncio.gather(*tasks)
+
+        asyncio.run(scenario())
+        assert order == ["predefined", "stream", "batch"]
+
+    def test_per_user_queue_limit(self):
+        """Un usuario que supera su cupo de cola es rechazado sin afectar a otros."""
+        scheduler = FairScheduler("test", max_in_flight=1, queue_size=10, max_wait_ms=1000, max_queued_per_user=2)
+
+        async def scenario():
+            await scheduler.acquire(user_id="holder")
+            tasks = [asyncio.create_task(scheduler.acquire(user_id="noisy")) for _ in range(2)]
+            await asyncio.sleep(0)
+            with pytest.raises(AdmissionRejected) as excinfo:
+                await scheduler.acquire(user_id="noisy")
+            other = asyncio.create_task(scheduler.acquire(user_id="quiet"))
+            await asyncio.sleep(0)
+            assert scheduler.queue_depth == 3
+            for _ in range(4):
+                scheduler.release()
+                await asyncio.sleep(0)
+            await asyncio.gather(*tasks, other)
+            return excinfo.value
+
+        assert asyncio.run(scenario()).reason == "user_queue_full"
+
+    def test_round_robin_between_users(self):
+        """Las peticiones en cola de dos usuarios se alternan aunque uno llegara antes con muchas."""
+        scheduler = FairScheduler("test", max_in_flight=1, queue_size=20, max_wait_ms=1000,
+                                  quantum=100, max_queued_per_user=20)
+        order = []
+
+        async def scenario():
+            await scheduler.acquire(user_id="holder")
+
+            async def waiter(user):
+                async with scheduler.slot(user_id=user, cost=100):
+                    order.append(user)
+
+            tasks = [asyncio.create_task(waiter("heavy")) for _ in range(4)]
+            tasks += [asyncio.create_task(waiter("light")) for _ in range(2)]
+            await asyncio.sleep(0)
+            scheduler.release()
+            await asyncio.gather(*tasks)
+
+        asyncio.run(scenario())
+        assert order[:4] == ["heavy", "light", "heavy", "light"]
+
+    def test_p95_isolation_under_mixed_load(self):
+        """Con FIFO la ráfaga de un usuario retrasa a todos; con DRR solo se retrasa a sí mismo."""
+        fifo = AdmissionController("fifo", max_in_flight=2, queue_size=200, max_wait_ms=60000)
+        fair = FairScheduler("fair", max_in_flight=2, queue_size=200, max_wait_ms=60000, max_queued_per_user=200)
+
+        fifo_results = asyncio.run(_mixed_load(fifo))
+        fair_results = asyncio.run(_mixed_load(fair))
+
+        light_fifo = [w for user, waits in fifo_results.items() if user != "heavy" for w in waits]
+        light_fair = [w for user, waits in fair_results.items() if user != "heavy" for w in waits]
+        assert len(light_fair) == 30
+
+        # Los usuarios normales apenas esperan con el planificador justo
+        assert _p95(light_fair) < _p95(light_fifo) / 3
+        # El usuario ráfaga absorbe su propia cola
+        assert _p95(fair_results["heavy"]) > _p95(light_fair)
+
+        stats = fair.get_stats()
+        assert stats["users"]["heavy"]["served"] == 60
+        assert stats["users"]["heavy"]["wait_p95_ms"] > stats["users"]["light0"]["wait_p95_ms"]
+        assert stats["in_flight"] == 0 and stats["queue_depth"] == 0
@@ -0,0 +1,90 @@
+"""
+Tests unitarios para el estado de sesión en el servidor
+"""
+import asyncio
+import sys
+import os
+
+import pytest
+
+# Añadir el directorio del sumiller service al path
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../sumiller-service'))
+
+import session_store as session_store_module
+from memory import SumillerMemory
+from session_store import SessionStore
+
+
+@pytest.fixture(autouse=True)
+def max_messages(monkeypatch):
+    monkeypatch.setattr(session_store_module, "SESSION_MAX_MESSAGES", 4)
+
+
+@pytest.fixture
+def memory(tmp_path):
+    return SumillerMemory(db_path=str(tmp_path / "sumiller.db"))
+
+
+def _save_turns(memory, n, session_id="s1", user_id="u1"):
+    async def save():
+        for i in range(n):
+            await memory.save_conversation(user_id, f"pregunta {i}", f"respuesta {i}", session_id=session_id)
+    asyncio.run(save())
+
+
+class TestSessionStore:
+    def test_rebuilds_session_from_sqlite(self, memory):
+        """Tras un reinicio la sesión se reconstruye con los últimos turnos guardados."""
+        _save_turns(memory, 3)
+        store = SessionStore(memory)
+
+        state = asyncio.run(store.get("s1", "u1"))
+
+        assert state.messages == [
+            {"role": "user", "content": "pregunta 1"}, {"role": "assistant", "content": "respuesta 1"},
+            {"role": "user", "content": "pregunta 2"}, {"role": "assistant", "content": "respuesta 2"},
+        ]
+        # Los dos mensajes del primer turno ya no están en memoria
+        assert state.offset == 2
+        assert store.db_loads == 1
+
+    def test_second_read_is_served_from_memory(self, memory):
+        _save_turns(memory, 1)
+        store = SessionStore(memory)
+        asyncio.run(store.get("s1", "u1"))
+        asyncio.run(store.get("s1", "u1"))
+        assert store.db_loads == 1
+
+    def test_sessions_are_scoped_by_user(self, memory):
+        _save_turns(memory, 2, user_id="u1")
+        store = SessionStore(memory)
+        assert asyncio.run(store.get("s1", "u2")).messages == []
+
+    def test_append_turn_keeps_the_window_and_advances_offset(self, memory):
+        _save_turns(memory, 2)
+        store = SessionStore(memory)
+        asyncio.run(store.get("s1", "u1"))
+
+        store.append_turn("s1", "u1", "pregunta 2", "respuesta 2")
+        state = asyncio.run(store.get("s1", "u1"))
+
+        assert [m["content"] for m in state.messages] == ["pregunta 1", "respuesta 1", "pregunta 2", "respuesta 2"]
+        assert state.offset == 2
+        assert store.db_loads == 1
+
+    def test_append_to_unloaded_session_is_read_later_from_sqlite(self, memory):
+        store = SessionStore(memory)
+        store.append_turn("s1", "u1", "pregunta 0", "respuesta 0")
+        _save_turns(memory, 1)
+        state = asyncio.run(store.get("s1", "u1"))
+        assert [m["content"] for m in state.messages] == ["pregunta 0", "respuesta 0"]
+
+    def test_evicted_session_is_rebuilt(self, memory):
+        _save_turns(memory, 1, session_id="s1")
+        _save_turns(memory, 1, session_id="s2")
+        store = SessionStore(memory, max_size=1)
+        asyncio.run(store.get("s1", "u1"))
+        asyncio.run(store.get("s2", "u1"))
+        state = asyncio.run(store.get("s1", "u1"))
+        assert state.messages[0]["content"] == "pregunta 0"
+        assert store.db_loads == 3
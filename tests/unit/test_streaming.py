@@ -0,0 +1,125 @@
+"""
+Tests unitarios para la agrupación de fragmentos en tramas y la contrapresión del streaming
+"""
+import asyncio
+import time
+import sys
+import os
+
+import pytest
+
+# Añadir el directorio del sumiller service al path
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../sumiller-service'))
+
+import streaming
+from streaming import coalesce_frames
+
+
+@pytest.fixture(autouse=True)
+def stats(monkeypatch):
+    fresh = {key: 0 for key in streaming._stats}
+    monkeypatch.setattr(streaming, "_stats", fresh)
+    return fresh
+
+
+async def _source(steps, produced=None):
+    """Genera los fragmentos indicados; un número en `steps` es una pausa en segundos."""
+    for step in steps:
+        if isinstance(step, (int, float)):
+            await asyncio.sleep(step)
+            continue
+        if produced is not None:
+            produced.append(step)
+        yield step
+
+
+def _frames(source, **kwargs):
+    async def collect():
+        return [frame async for frame in coalesce_frames(source, **kwargs)]
+    return asyncio.run(collect())
+
+
+class TestCoalesceFrames:
+    def test_first_frame_is_sent_immediately(self):
+        async def scenario():
+            frames = coalesce_frames(_source(["Hola", 0.5, " mundo"]), max_bytes=1000, max_delay_ms=1000)
+            start = time.perf_counter()
+            first = await frames.__anext__()
+            elapsed = time.perf_counter() - start
+            await frames.aclose()
+            return first, elapsed
+
+        first, elapsed = asyncio.run(scenario())
+        assert first == "Hola"
+        assert elapsed < 0.2
+
+    def test_flushes_by_size(self, stats):
+        frames = _frames(_source(["a", "bb", "cc", "dd", "e"]), max_bytes=4, max_delay_ms=1000)
+        assert frames == ["a", "bbcc", "dde"]
+        assert stats["size_flushes"] == 1
+        assert "".join(frames) == "abbccdde"
+
+    def test_flushes_by_time(self, stats):
+        frames = _frames(_source(["a", "b", 0.05, "c"]), max_bytes=1000, max_delay_ms=10)
+        assert frames == ["a", "b", "c"]
+        assert stats["time_flushes"] == 1
+
+    def test_multibyte_chunks_count_bytes(self):
+        frames = _frames(_source(["x", "ñ", "ñ"]), max_bytes=4, max_delay_ms=1000)
+        assert frames == ["x", "ññ"]
+
+    def test_bounded_queue_stops_reading_from_a_slow_client(self, stats):
+        """Con el cliente parado solo se leen del modelo los fragmentos que caben en la cola."""
+        produced = []
+
+        async def scenario():
+            frames = coalesce_frames(_source([f"{i} " for i in range(100)], produced),
+                                     max_bytes=1, max_delay_ms=1000, queue_size=4)
+            await frames.__anext__()
+            await asyncio.sleep(0.05)
+            read_while_blocked = len(produced)
+            rest = [frame async for frame in frames]
+            return read_while_blocked, rest
+
+        read_while_blocked, rest = asyncio.run(scenario())
+        # Primera trama entregada + cola llena + el fragmento que espera a entrar
+        assert read_while_blocked <= 1 + 4 + 1
+        assert len(rest) == 99
+        assert stats["backpressure_waits"] >= 1
+        assert stats["max_queue_depth"] == 4
+
+    def test_source_error_is_raised_after_pending_frames(self):
+        async def failing():
+            yield "a"
+            yield "b"
+            raise RuntimeError("fallo del modelo")
+
+        async def scenario():
+            received = []
+            with pytest.raises(RuntimeError):
+                async for frame in coalesce_frames(failing(), max_bytes=1000, max_delay_ms=1000):
+                    received.append(frame)
+            return received
+
+        assert asyncio.run(scenario()) == ["a", "b"]
+
+    def test_client_disconnect_cancels_the_reader(self, stats):
+        cancelled = []
+
+        async def endless():
+            try:
+                while True:
+                    yield "x"
+                    await asyncio.sleep(0.001)
+            except asyncio.CancelledError:
+                cancelled.append(True)
+                raise
+
+        async def scenario():
+            frames = coalesce_frames(endless(), max_bytes=1, max_delay_ms=1000)
+            await frames.__anext__()
+            await frames.aclose()
+
+        asyncio.run(scenario())
+        assert cancelled == [True]
+        assert stats["disconnects"] == 1
@@ -0,0 +1,134 @@
+"""
+Tests unitarios para el resumen incremental de la conversación por sesión
+"""
+import asyncio
+import sys
+import os
+
+import pytest
+
+# Añadir el directorio del sumiller service al path
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../sumiller-service'))
+
+import summarizer as summarizer_module
+from fake_model import FakeResponse
+from memory import SumillerMemory
+from summarizer import ConversationSummarizer
+
+
+class RecordingModel:
+    """Devuelve resúmenes numerados y guarda los prompts recibidos."""
+
+    def __init__(self, text=None, delay=0.0):
+        self.text = text
+        self.delay = delay
+        self.prompts = []
+
+    async def generate_content_async(self, prompt, **kwargs):
+        self.prompts.append(prompt)
+        await asyncio.sleep(self.delay)
+        text = f"Resumen {len(self.prompts)}" if self.text is None else self.text
+        return FakeResponse(text)
+
+
+def _messages(n, start=0):
+    return [{"role": "user" if i % 2 == 0 else "assistant", "content": f"mensaje {i}"} for i in range(start, start + n)]
+
+
+@pytest.fixture(autouse=True)
+def limits(monkeypatch):
+    monkeypatch.setattr(summarizer_module, "SUMMARY_KEEP_MESSAGES", 4)
+    monkeypatch.setattr(summarizer_module, "SUMMARY_MIN_NEW_MESSAGES", 2)
+
+
+@pytest.fixture
+def memory(tmp_path):
+    return SumillerMemory(db_path=str(tmp_path / "sumiller.db"))
+
+
+def _update(summarizer, messages, offset=0):
+    asyncio.run(summarizer._update("s1", "u1", messages, offset))
+
+
+class TestConversationSummarizer:
+    def test_recent_messages_are_not_summarized(self, memory):
+        model = RecordingModel()
+        summarizer = ConversationSummarizer(model, memory)
+        _update(summarizer, _messages(5))
+        assert model.prompts == []
+        assert summarizer.get_stats()["skipped"] == 1
+        assert asyncio.run(memory.get_session_summary("s1", "u1")) is None
+
+    def test_older_messages_are_summarized(self, memory):
+        model = RecordingModel()
+        summarizer = ConversationSummarizer(model, memory)
+        _update(summarizer, _messages(6))
+
+        summary = asyncio.run(memory.get_session_summary("s1", "u1"))
+        assert summary["summary"] == "Resumen 1"
+        assert summary["messages_summarized"] == 2
+        assert "mensaje 1" in model.prompts[0] and "mensaje 2" not in model.prompts[0]
+
+    def test_summary_is_incremental(self, memory):
+        model = RecordingModel()
+        summarizer = ConversationSummarizer(model, memory)
+        _update(summarizer, _messages(6))
+        _update(summarizer, _messages(8))
+
+        # El segundo prompt parte del resumen anterior y solo añade los mensajes nuevos
+        assert "Resumen 1" in model.prompts[1]
+        assert "mensaje 1" not in model.prompts[1]
+        assert "mensaje 2" in model.prompts[1] and "mensaje 3" in model.prompts[1]
+        assert asyncio.run(memory.get_session_summary("s1", "u1"))["messages_summarized"] == 4
+
+    def test_offset_history_from_bounded_session_state(self, memory):
+        """Con historial acotado, `offset` sitúa los mensajes dentro de la sesión completa."""
+        model = RecordingModel()
+        summarizer = ConversationSummarizer(model, memory)
+        asyncio.run(memory.save_session_summary("s1", "u1", "Resumen previo", 10))
+        _update(summarizer, _messages(8, start=8), offset=8)
+
+        assert "mensaje 10" in model.prompts[0] and "mensaje 11" in model.prompts[0]
+        assert "mensaje 9" not in model.prompts[0]
+        assert asyncio.run(memory.get_session_summary("s1", "u1"))["messages_summarized"] == 12
+
+    def test_restarted_history_starts_a_new_summary(self, memory):
+        model = RecordingModel()
+        summarizer = ConversationSummarizer(model, memory)
+        asyncio.run(memory.save_session_summary("s1", "u1", "Resumen antiguo", 20))
+        _update(summarizer, _messages(6))
+
+        assert "Resumen antiguo" not in model.prompts[0]
+        assert asyncio.run(memory.get_session_summary("s1", "u1"))["messages_summarized"] == 2
+
+    def test_empty_summary_is_not_saved(self, memory):
+        summarizer = ConversationSummarizer(RecordingModel(text="  "), memory)
+
+        async def scenario():
+            summarizer.schedule("s1", "u1", _messages(6))
+            await asyncio.gather(*summarizer._tasks.values())
+
+        asyncio.run(scenario())
+        assert summarizer.get_stats()["failures"] == 1
+        assert asyncio.run(memory.get_session_summary("s1", "u1")) is None
+
+    def test_turns_arriving_during_an_update_keep_only_the_latest(self, memory):
+        model = RecordingModel(delay=0.02)
+        summarizer = ConversationSummarizer(model, memory)
+
+        async def scenario():
+            summarizer.schedule("s1", "u1", _messages(6))
+            await asyncio.sleep(0.005)
+            summarizer.schedule("s1", "u1", _messages(8))
+            summarizer.schedule("s1", "u1", _messages(10))
+            assert summarizer.get_stats()["in_progress"] == 1
+            await asyncio.gather(*summarizer._tasks.values())
+
+        asyncio.run(scenario())
+        assert len(model.prompts) == 2
+        assert asyncio.run(memory.get_session_summary("s1", "u1"))["messages_summarized"] == 6
+
+    def test_requests_without_session_are_ignored(self, memory):
+        summarizer = ConversationSummarizer(RecordingModel(), memory)
+        summarizer.schedule(None, "u1", _messages(6))
+        assert summarizer.get_stats()["scheduled"] == 0
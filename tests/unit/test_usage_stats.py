@@ -0,0 +1,117 @@
+"""
+Tests unitarios para los agregados de uso de Gemini y el endpoint /stats/usage
+"""
+import asyncio
+import sqlite3
+import sys
+import os
+
+import pytest
+from fastapi.testclient import TestClient
+
+# Añadir el directorio del sumiller service al path
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../sumiller-service'))
+
+import llm
+from fake_model import FakeGenerativeModel
+from memory import SumillerMemory
+
+USAGE = {"llm_calls": 2, "prompt_tokens": 300, "output_tokens": 120, "cost_usd": 0.0004}
+
+
+@pytest.fixture
+def memory(tmp_path):
+    return SumillerMemory(db_path=str(tmp_path / "sumiller.db"))
+
+
+def _count(memory, table):
+    with sqlite3.connect(memory.db_path) as conn:
+        return conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+
+def _save(memory, user_id="u1", category="WINE_SEARCH", usage=USAGE):
+    asyncio.run(memory.save_conversation(user_id, "¿Qué vino?", "Un rioja.", category=category, usage=usage))
+
+
+class TestUsageRollups:
+    def test_conversation_updates_both_rollups(self, memory):
+        _save(memory)
+        _save(memory)
+        _save(memory, user_id="u2", category="WINE_THEORY")
+
+        by_category = {row["category"]: row for row in asyncio.run(memory.get_usage("category"))}
+        assert by_category["WINE_SEARCH"]["requests"] == 2
+        assert by_category["WINE_SEARCH"]["prompt_tokens"] == 600
+        assert by_category["WINE_THEORY"]["output_tokens"] == 120
+        by_user = {row["user"]: row for row in asyncio.run(memory.get_usage("user"))}
+        assert by_user["u1"]["llm_calls"] == 4
+        assert by_user["u2"]["cost_usd"] == pytest.approx(0.0004)
+
+    def test_rollup_failure_rolls_back_the_conversation(self, memory, monkeypatch):
+        """Conversación y agregados van en la misma transacción: o se guardan ambos o ninguno."""
+        def failing(conn, *args, **kwargs):
+            raise sqlite3.OperationalError("fallo en el agregado")
+
+        monkeypatch.setattr(memory, "_add_usage_sync", failing)
+        _save(memory)
+        assert _count(memory, "conversations") == 0
+        assert _count(memory, "usage_daily_by_category") == 0
+
+    def test_non_turn_usage_does_not_count_requests(self, memory):
+        asyncio.run(memory.record_usage("u1", "SUMMARY", USAGE))
+        row = asyncio.run(memory.get_usage("category"))[0]
+        assert (row["category"], row["requests"], row["prompt_tokens"]) == ("SUMMARY", 0, 300)
+        assert _count(memory, "conversations") == 0
+
+    def test_limit_caps_the_rows(self, memory):
+        for category in ("WINE_SEARCH", "WINE_THEORY", "OFF_TOPIC"):
+            _save(memory, category=category)
+        assert len(asyncio.run(memory.get_usage("category", limit=2))) == 2
+
+
+@pytest.fixture
+def main(monkeypatch, tmp_path):
+    # main crea ./database al importarse
+    monkeypatch.chdir(tmp_path)
+    import main as sumiller_main
+    monkeypatch.setattr(llm, "USE_FAKE_LLM", True)
+    monkeypatch.setattr(llm, "_models", {})
+    monkeypatch.setattr(llm, "_fake_model", FakeGenerativeModel(latency_ms=0, jitter_ms=0, tail_probability=0))
+    monkeypatch.setattr(sumiller_main.memory, "db_path", tmp_path / "sumiller.db")
+    monkeypatch.setattr(sumiller_main, "LLM_WARMUP", False)
+    monkeypatch.setattr(sumiller_main, "SEARCH_SERVICE_URL", None)
+    monkeypatch.setattr(sumiller_main, "ADMIN_TOKEN", None)
+    return sumiller_main
+
+
+@pytest.fixture
+def client(main):
+    with TestClient(main.app) as test_client:
+        _save(main.memory)
+        yield test_client
+
+
+class TestUsageEndpoint:
+    def test_usage_by_category(self, client):
+        response = client.get("/stats/usage")
+        assert response.status_code == 200
+        assert response.json()["rows"][0]["category"] == "WINE_SEARCH"
+
+    @pytest.mark.parametrize("limit", [-1, 0, 100000])
+    def test_limit_out_of_range_is_rejected(self, client, limit):
+        assert client.get("/stats/usage", params={"limit": limit}).status_code == 422
+
+    def test_per_user_usage_requires_admin_token(self, client):
+        response = client.get("/stats/usage", params={"group_by": "user"})
+        assert response.status_code == 403
+
+    def test_per_user_usage_rejects_a_wrong_token(self, main, client, monkeypatch):
+        monkeypatch.setattr(main, "ADMIN_TOKEN", "secreto")
+        response = client.get("/stats/usage", params={"group_by": "user"}, headers={"X-Admin-Token": "otro"})
+        assert response.status_code == 403
+
+    def test_per_user_usage_with_admin_token(self, main, client, monkeypatch):
+        monkeypatch.setattr(main, "ADMIN_TOKEN", "secreto")
+        response = client.get("/stats/usage", params={"group_by": "user"}, headers={"X-Admin-Token": "secreto"})
+        assert response.status_code == 200
+        assert response.json()["rows"][0]["user"] == "u1"